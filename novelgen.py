@@ -1,4 +1,5 @@
 import requests
+import requests.adapters
 import platform
 import json
 import re
@@ -8,6 +9,29 @@ import threading
 import os
 import subprocess
 import gc
+import zlib
+import socket
+from contextlib import contextmanager, nullcontext, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import hashlib
+import argparse
+import uuid
+import sqlite3
+import random
+import heapq
+import functools
+import io
+import cProfile
+import pstats
+import tracemalloc
+import gzip
+import math
+import itertools
+import mmap
+import queue
+import multiprocessing
 from colorama import Fore, Style
 import time
 import ebooklib
@@ -19,6 +43,246 @@ import signal
 
 keep_alive_running = False
 
+API_URL = "http://localhost:8080/completion"
+
+# Comma-separated list of completion endpoints and the number of parallel slots each one serves
+BACKEND_URLS = [url.strip() for url in os.environ.get("NOVELGEN_BACKENDS", API_URL).split(",") if url.strip()]
+SLOTS_PER_BACKEND = int(os.environ.get("NOVELGEN_SLOTS", "1"))
+
+# Timeouts in seconds
+CONNECT_TIMEOUT = float(os.environ.get("NOVELGEN_CONNECT_TIMEOUT", "10"))
+FIRST_TOKEN_TIMEOUT = float(os.environ.get("NOVELGEN_FIRST_TOKEN_TIMEOUT", "600"))  # Long prompts prefill slowly on CPU
+STALL_TIMEOUT = float(os.environ.get("NOVELGEN_STALL_TIMEOUT", "120"))
+REQUEST_DEADLINE = float(os.environ.get("NOVELGEN_REQUEST_DEADLINE", "3600"))
+
+# Tee chapter tokens to a partial file while streaming, fsyncing at most this often
+PARTIAL_OUTPUT = os.environ.get("NOVELGEN_PARTIAL_OUTPUT", "1") != "0"
+PARTIAL_FSYNC_INTERVAL = float(os.environ.get("NOVELGEN_PARTIAL_FSYNC_INTERVAL", "5"))
+
+# Summarize chapters in blocks of this many words while they stream
+INCREMENTAL_SUMMARY = os.environ.get("NOVELGEN_INCREMENTAL_SUMMARY", "1") != "0"
+SUMMARY_SEGMENT_WORDS = int(os.environ.get("NOVELGEN_SUMMARY_SEGMENT_WORDS", "1500"))
+
+# Adaptive (AIMD) per-backend concurrency: start at INITIAL_CONCURRENCY in-flight requests and
+# adjust every AIMD_WINDOW seconds, up to NOVELGEN_SLOTS; a latency this many times the baseline counts as overload
+ADAPTIVE_CONCURRENCY = os.environ.get("NOVELGEN_ADAPTIVE_CONCURRENCY", "1") != "0"
+INITIAL_CONCURRENCY = int(os.environ.get("NOVELGEN_INITIAL_CONCURRENCY", "1"))
+AIMD_WINDOW = float(os.environ.get("NOVELGEN_AIMD_WINDOW", "10"))
+AIMD_LATENCY_SPIKE = float(os.environ.get("NOVELGEN_AIMD_LATENCY_SPIKE", "3"))
+
+# Write each chapter as this many scenes generated in parallel on separate slots, then smooth
+# the joins (0 disables; most useful when NOVELGEN_SLOTS is at least this large)
+CHAPTER_SCENES = int(os.environ.get("NOVELGEN_CHAPTER_SCENES", "0"))
+
+# Generate the story plan as a core premise followed by sections and chapter breakdown chunks
+# in parallel, instead of one long stream (0 disables)
+SECTIONED_PLAN = os.environ.get("NOVELGEN_SECTIONED_PLAN", "1") != "0"
+PLAN_CHAPTERS = int(os.environ.get("NOVELGEN_PLAN_CHAPTERS", "20"))
+PLAN_CHUNK_SIZE = int(os.environ.get("NOVELGEN_PLAN_CHUNK_SIZE", "5"))
+
+# Retrieve up to RETRIEVAL_PASSAGES paragraphs from earlier chapters that match the next chapter's
+# plan, within RETRIEVAL_TOKENS prompt tokens, and add them to its prompt (0 disables)
+RETRIEVAL_PASSAGES = int(os.environ.get("NOVELGEN_RETRIEVAL_PASSAGES", "5"))
+RETRIEVAL_TOKENS = int(os.environ.get("NOVELGEN_RETRIEVAL_TOKENS", "800"))
+
+# Track characters, places, items, relationships and plot threads with one extraction call per
+# chapter, and keep only the last STATE_RECENT_SUMMARIES chapter summaries in prompts (0 disables)
+STATE_TRACKING = os.environ.get("NOVELGEN_STATE_TRACKING", "1") != "0"
+STATE_RECENT_SUMMARIES = int(os.environ.get("NOVELGEN_STATE_RECENT_SUMMARIES", "3"))
+
+# Request priority classes, served strictly in this order: blocking control calls (verify,
+# summarize, fix), chapter generation, then background work such as segment summaries
+PRIORITY_CONTROL = 0
+PRIORITY_CHAPTER = 1
+PRIORITY_BACKGROUND = 2
+
+# Backend API: "llamacpp", "openai" or "ollama"; by default it is detected from each backend URL or by
+# probing the server. NOVELGEN_MODEL names the model for servers that need one (default: the first listed)
+BACKEND_TYPE = os.environ.get("NOVELGEN_BACKEND_TYPE", "auto").lower()
+BACKEND_MODEL = os.environ.get("NOVELGEN_MODEL")
+
+# Keep finished chapters in one file each under novelgen_progress instead of one growing string, so
+# memory stays flat for very long serials; exports stream the chapters back from disk
+CHAPTER_STORE = os.environ.get("NOVELGEN_CHAPTER_STORE", "0") != "0"
+
+# Send a copy of a short control request (verify, summarize, state extraction...) to another backend
+# when its first token is later than HEDGE_PERCENTILE of recent ones for that stage; HEDGE_BUDGET caps
+# the copies as a fraction of all such requests
+HEDGE_REQUESTS = os.environ.get("NOVELGEN_HEDGE", "0") != "0"
+HEDGE_PERCENTILE = float(os.environ.get("NOVELGEN_HEDGE_PERCENTILE", "95"))
+HEDGE_BUDGET = float(os.environ.get("NOVELGEN_HEDGE_BUDGET", "0.05"))
+HEDGE_MIN_SAMPLES = 10  # Requests per stage before its threshold is trusted
+
+# Formats written for each finished novel (txt, epub, md, html; the text file is always written), the
+# worker processes they are rendered in (0: one per format, up to the CPU count) and where rendered
+# chapters are cached so unchanged chapters are not rendered again (empty: no cache). After each export
+# the least recently used renderings are deleted until the cache is under its size limit
+EXPORT_FORMATS = [fmt.strip().lower() for fmt in os.environ.get("NOVELGEN_EXPORT_FORMATS", "txt,epub").split(",") if fmt.strip()]
+EXPORT_WORKERS = int(os.environ.get("NOVELGEN_EXPORT_WORKERS", "0"))
+RENDER_CACHE_DIR = os.environ.get("NOVELGEN_RENDER_CACHE", os.path.join("novelgen_progress", "render_cache"))
+RENDER_CACHE_MB = float(os.environ.get("NOVELGEN_RENDER_CACHE_MB", "256"))
+RENDER_VERSION = "1"  # Part of every render cache key; bump it when a chapter renderer changes
+
+# Prefill the start that the coming prompts share (the world bible of a series, then the fixed chapter
+# instructions) on idle backend slots, so the first real request on each slot reuses the cached prefix
+WARM_UP_SLOTS = os.environ.get("NOVELGEN_WARMUP", "1") != "0"
+
+# Streamed tokens waiting for each consumer (terminal, partial files, loop detector, progress events)
+# before the network reader applies that consumer's backpressure policy
+STREAM_QUEUE_SIZE = 256
+
+# Record every backend request and its timed response chunks to a gzip JSON lines cassette, or
+# replay one without a server; the replay speed is a multiple of the recorded pace (0: as fast as possible)
+CASSETTE_RECORD = os.environ.get("NOVELGEN_RECORD")
+CASSETTE_REPLAY = os.environ.get("NOVELGEN_REPLAY")
+CASSETTE_REPLAY_SPEED = float(os.environ.get("NOVELGEN_REPLAY_SPEED", "0"))
+
+# Number of non-streamed results kept in the in-memory response cache (0 disables it)
+RESPONSE_CACHE_SIZE = int(os.environ.get("NOVELGEN_RESPONSE_CACHE_SIZE", "256"))
+
+# Shared work queue: lease length in seconds and attempts before a work item fails its job
+QUEUE_LEASE_SECONDS = float(os.environ.get("NOVELGEN_QUEUE_LEASE", "120"))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("NOVELGEN_QUEUE_MAX_ATTEMPTS", "3"))
+
+# Best-of-N chapter openings: number of parallel candidates (0 or 1 disables), their length,
+# and whether to add a one-number model verdict to the local continuity score
+OPENING_CANDIDATES = int(os.environ.get("NOVELGEN_OPENING_CANDIDATES", "0"))
+OPENING_TOKENS = int(os.environ.get("NOVELGEN_OPENING_TOKENS", "300"))
+OPENING_VERDICT = os.environ.get("NOVELGEN_OPENING_VERDICT", "0") != "0"
+
+class StageProfiler:
+    """Wall and CPU time per pipeline stage, with optional cProfile or tracemalloc data
+    
+    Stages nest per thread, so a stage is identified by its path, e.g. "chapter 3;generate;stream".
+    """
+    
+    def __init__(self, mode="timing"):
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.stats = {}  # path -> [calls, wall, cpu, child wall, child cpu, allocated bytes]
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.cprofile = None
+        if mode == "cprofile":
+            # cProfile only sees the thread that enables it, which is the main pipeline thread
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        elif mode == "tracemalloc":
+            tracemalloc.start()
+    
+    @contextmanager
+    def stage(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        path = f"{stack[-1][0]};{name}" if stack else name
+        stack.append([path, 0.0, 0.0])
+        memory_start = tracemalloc.get_traced_memory()[0] if self.mode == "tracemalloc" else 0
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            allocated = tracemalloc.get_traced_memory()[0] - memory_start if self.mode == "tracemalloc" else 0
+            _, child_wall, child_cpu = stack.pop()
+            if stack:
+                stack[-1][1] += wall
+                stack[-1][2] += cpu
+            with self.lock:
+                entry = self.stats.setdefault(path, [0, 0.0, 0.0, 0.0, 0.0, 0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+                entry[3] += child_wall
+                entry[4] += child_cpu
+                entry[5] += allocated
+            for hook in stage_hooks:
+                hook(path, wall, cpu)
+    
+    def write_report(self, output_dir):
+        """Write the per-stage report, a collapsed-stack file and any cProfile data to output_dir"""
+        os.makedirs(output_dir, exist_ok=True)
+        total = time.perf_counter() - self.started
+        with self.lock:
+            stats = {path: list(entry) for path, entry in self.stats.items()}
+        
+        # Totals per stage name, wherever the stage ran
+        by_name = {}
+        for path, (calls, wall, cpu, child_wall, child_cpu, allocated) in stats.items():
+            entry = by_name.setdefault(path.rsplit(';', 1)[-1], [0, 0.0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += wall - child_wall
+            entry[2] += cpu - child_cpu
+            entry[3] += allocated
+        
+        lines = [f"NovelGen stage profile ({self.mode}), {total:.2f}s total", "", "By stage (self time, excluding nested stages):"]
+        lines.append(f"{'stage':<28}{'calls':>8}{'self wall s':>14}{'self cpu s':>12}" + (f"{'alloc MB':>10}" if self.mode == "tracemalloc" else ""))
+        for name, (calls, self_wall, cpu, allocated) in sorted(by_name.items(), key=lambda item: -item[1][1]):
+            line = f"{name:<28}{calls:>8}{self_wall:>14.3f}{cpu:>12.3f}"
+            if self.mode == "tracemalloc":
+                line += f"{allocated / 1e6:>10.2f}"
+            lines.append(line)
+        
+        lines += ["", "By path:", f"{'path':<60}{'calls':>8}{'wall s':>10}{'cpu s':>10}"]
+        for path in sorted(stats):
+            calls, wall, cpu = stats[path][:3]
+            lines.append(f"{path:<60}{calls:>8}{wall:>10.3f}{cpu:>10.3f}")
+        
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(os.path.join(output_dir, "profile.prof"))
+            listing = io.StringIO()
+            pstats.Stats(self.cprofile, stream=listing).sort_stats("cumulative").print_stats(30)
+            lines += ["", "cProfile (main thread, top 30 by cumulative time):", listing.getvalue()]
+        
+        report_path = os.path.join(output_dir, "profile_report.txt")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        
+        # Self time in milliseconds per stack, as flamegraph.pl and speedscope expect
+        collapsed_path = os.path.join(output_dir, "profile.collapsed")
+        with open(collapsed_path, 'w', encoding='utf-8') as f:
+            for path in sorted(stats):
+                self_ms = int(round((stats[path][1] - stats[path][3]) * 1000))
+                if self_ms > 0:
+                    f.write(f"{path} {self_ms}\n")
+        
+        color_print(f"Profile written to {report_path} and {collapsed_path}", Fore.GREEN)
+
+# Set by --profile; every stage is a no-op while it is None
+stage_profiler = None
+
+# Callables run as hook(path, wall_seconds, cpu_seconds) when a profiled stage ends
+stage_hooks = []
+
+def register_stage_hook(hook):
+    stage_hooks.append(hook)
+
+def profile_stage(name):
+    """Context manager that times a pipeline stage when profiling is on"""
+    if stage_profiler is None:
+        return nullcontext()
+    return stage_profiler.stage(name)
+
+def profiled(name):
+    """Decorator that times every call of a function as a pipeline stage when profiling is on"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if stage_profiler is None:
+                return function(*args, **kwargs)
+            with stage_profiler.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def start_profiling(mode="timing"):
+    global stage_profiler
+    stage_profiler = StageProfiler(mode)
+
+@profiled("dedupe")
 def deduplicate_chapters(full_novel):
     """Remove duplicate chapters from the novel text"""
     color_print("Checking for and removing duplicate chapters...", Fore.CYAN)
@@ -133,6 +397,7 @@ def cancel_keep_alive():
     keep_alive_running = False
     return True
 
+@profiled("print")
 def color_print(text, color=Fore.WHITE, width=None):
     if not text:
         return
@@ -160,569 +425,4306 @@ def color_print(text, color=Fore.WHITE, width=None):
         for line in wrapped_lines:
             print(f"{color}{line}{Style.RESET_ALL}")
 
-def create_story_plan(title, theme=None, genre=None, max_tokens=4000, additional_instructions=None):
-    """Create a structured outline for the story with JSON chapter details"""
-    
-    color_print(f"\nCreating detailed story plan for: {title}\n", Fore.CYAN)
-    
-    # First, build the prompt parts
-    prompt_parts = [
-        f"""Create an extremely detailed story plan for a novel titled "{title}"."""
-    ]
-    
-    if theme:
-        prompt_parts.append(f'Theme: {theme}')
-    if genre:
-        prompt_parts.append(f'Genre: {genre}')
-    
-    prompt_parts.append("""
-The plan should include:
+# Shared telemetry counters for the whole run
+telemetry = {}
+telemetry_lock = threading.Lock()
 
-1. PREMISE: A comprehensive summary of the core story concept.
+def record_telemetry(key, amount=1):
+    """Add to a named telemetry counter"""
+    with telemetry_lock:
+        telemetry[key] = telemetry.get(key, 0) + amount
 
-2. CHARACTERS:
-   - Main character(s): Detailed background, psychology, key traits, wants, needs, internal conflicts, and development arc
-   - Supporting characters: Thorough descriptions, motivations, and their relationship to the protagonist
-   - Antagonists: Complex motivations, backstory, and detailed conflicts with the protagonist
+# Progress events go to the job (if any) that the current thread is working on
+job_context = threading.local()
 
-3. NARRATIVE STRUCTURE:
-   - Beginning: Detailed opening scenes, character introductions, and world-building elements
-   - Middle: Elaborate central conflicts, complications, and escalating tensions
-   - Multiple plot points and subplots with interconnections
-   - Climax: Detailed description of the turning point and its impact on all characters
-   - Resolution: Comprehensive conclusion showing how character arcs and themes are resolved
+def emit_event(event_type, **data):
+    """Report a pipeline progress event to the current job server job"""
+    job = getattr(job_context, 'job', None)
+    if job is not None:
+        job.add_event(event_type, data)
 
-4. KEY SCENES: 15-20 essential scenes that drive the narrative forward, with detailed descriptions
+def estimate_tokens(text):
+    """Rough token count for English prose (about three words per four tokens)"""
+    return int(len(text.split()) * 4 / 3)
 
-5. SETTINGS: Expansive descriptions of all locations, including sensory details and significance to the story
+# Text utilities for chapter headers and paragraphs. Each one looks only at the part of the
+# text it returns, or scans the text once, so no input (one huge line, no newlines at all, long
+# whitespace runs) makes them slower than linear
+CHAPTER_HEADER_SCAN = 300  # A chapter header is looked for only in this many leading characters
+CHAPTER_HEADER_PATTERN = re.compile(r'Chapter\s+\d+[:\s]+.*?\n\r?\n', re.IGNORECASE)
+CHAPTER_HEADER_LINE_PATTERN = re.compile(r'Chapter\s+\d+[:\s]+.*?\n', re.IGNORECASE)
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\s*\n')
 
-6. THEME & MESSAGE: In-depth exploration of core ideas and how they manifest throughout the story
+def chapter_body_start(chapter_content, blank_line=True):
+    """Offset just past a leading "Chapter N: Title" header (and the blank line after it), or 0"""
+    pattern = CHAPTER_HEADER_PATTERN if blank_line else CHAPTER_HEADER_LINE_PATTERN
+    match = pattern.match(chapter_content, 0, CHAPTER_HEADER_SCAN)
+    return match.end() if match else 0
 
-7. DETAILED CHAPTER BREAKDOWN: 
-   Provide a detailed chapter-by-chapter breakdown with EXACTLY this format for EACH chapter:
+def chapter_opening(chapter_content, max_chars=1500):
+    """The first max_chars characters of a chapter without its header"""
+    beginning = chapter_content[:max_chars]
+    return beginning[chapter_body_start(beginning):]
 
-   Chapter 1: [Title]
-   [Detailed 150-200 word description of the chapter events, character development, and plot advancement]
+def split_paragraphs(text):
+    """Split text into its paragraphs at blank lines in one pass"""
+    return PARAGRAPH_BREAK_PATTERN.split(text.strip())
 
-   Chapter 2: [Title]
-   [Detailed 150-200 word description of the chapter events, character development, and plot advancement]
+def print_telemetry():
+    """Print the telemetry counters collected during the run"""
+    with telemetry_lock:
+        counters = dict(telemetry)
+    if not counters:
+        return
+    color_print("\nRun telemetry:", Fore.CYAN)
+    for key in sorted(counters):
+        value = counters[key]
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        color_print(f"  {key}: {value}", Fore.CYAN)
+    if ADAPTIVE_CONCURRENCY:
+        for url, limit in backend_pool.limits().items():
+            color_print(f"  concurrency_limit[{url}]: {limit}", Fore.CYAN)
 
-   ...and so on. Provide at least 20 chapters, each with detailed descriptions.
-""")
+class RepetitionDetector:
+    """Detect degenerate loops in a token stream using rolling hashes of word n-grams"""
     
-    # Add any additional instructions
-    if additional_instructions:
-        prompt_parts.append(additional_instructions)
+    BASE = 1000003
+    MOD = (1 << 61) - 1
     
-    # Join all prompt parts together
-    prompt = "\n\n".join(prompt_parts)
+    def __init__(self, ngram_size=8, min_repeats=3, min_loop_words=40, max_period=1000):
+        self.ngram_size = ngram_size
+        self.min_repeats = min_repeats
+        self.min_loop_words = min_loop_words
+        self.max_period = max_period
+        self.words = []
+        self.offsets = []  # Character offset of each word in the fed text
+        self.loop_start = None  # Character offset where the repeated tail begins
+        self._word_hashes = []
+        self._pending = ""  # Partial word left over from the previous chunk
+        self._length = 0
+        self._hash = 0
+        self._high = pow(self.BASE, ngram_size - 1, self.MOD)
+        self._seen = {}  # n-gram hash -> index of the last word of its latest occurrence
+        self._period = 0
+        self._run = 0
     
-    try:
-        start_time = time.time()
-        color_print("Generating comprehensive story plan...", Fore.YELLOW)
+    def feed(self, text):
+        """Feed streamed text and return True once a loop has been detected"""
+        if self.loop_start is not None:
+            return True
         
-        keep_alive_running = setup_keep_alive()
-        if keep_alive_running:
-            color_print("Keep-alive feature enabled to prevent system sleep", Fore.CYAN)
+        data = self._pending + text
+        base = self._length - len(self._pending)
+        self._length += len(text)
         
-        response = requests.post(
-            "http://localhost:8080/completion",
-            json={
-                "prompt": prompt,
-                "max_tokens": max_tokens,
-                "stream": True
-            },
-            stream=True
-        )
+        # Hold back a word that may still be cut in half by the chunk boundary
+        words = list(re.finditer(r'\S+', data))
+        if words and words[-1].end() == len(data):
+            self._pending = data[words.pop().start():]
+        else:
+            self._pending = ""
         
-        if response.status_code != 200:
-            color_print(f"\nAPI Error: Status code {response.status_code}", Fore.RED)
-            cancel_keep_alive()
-            return None
-            
-        full_response = ""
-        buffer = ""
-        color_print("\nGenerating plan... \n", Fore.YELLOW)
+        for match in words:
+            if self._add_word(match.group(0), base + match.start()):
+                return True
+        return False
+    
+    def _add_word(self, raw_word, offset):
+        word = re.sub(r'\W+', '', raw_word.lower())
+        if not word:
+            return False
         
-        for line in response.iter_lines():
-            if line:
-                try:
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith('data: '):
-                        json_data = json.loads(decoded_line[6:])
-                        content = json_data.get('content', '')
-                        buffer += content
-                        full_response += content
-                        
-                        if content and content[-1] in (' ', '.', ',', '!', '?', '\n'):
-                            color_print(buffer, Fore.CYAN)
-                            buffer = ""
-                except json.JSONDecodeError:
-                    color_print("\nError decoding JSON from API response", Fore.RED)
-                except Exception as e:
-                    color_print(f"\nError processing stream: {e}", Fore.RED)
+        n = self.ngram_size
+        idx = len(self.words)
+        word_hash = zlib.crc32(word.encode('utf-8'))
+        self.words.append(word)
+        self.offsets.append(offset)
+        self._word_hashes.append(word_hash)
         
-        if buffer:
-            color_print(buffer, Fore.CYAN)
+        # Extend or break the current run of words that repeat at a fixed period
+        if self._period and self.words[idx - self._period] == word:
+            self._run += 1
+        else:
+            self._period = 0
+            self._run = 0
         
-        cancel_keep_alive()
-        end_time = time.time()
-        duration = end_time - start_time
-        color_print(f"\n\nPlan generation complete in {duration:.2f} seconds!", Fore.GREEN)
+        # Roll the n-gram hash forward by one word
+        if idx >= n:
+            self._hash = (self._hash - self._word_hashes[idx - n] * self._high) % self.MOD
+        self._hash = (self._hash * self.BASE + word_hash) % self.MOD
         
-        return full_response.strip()
+        if idx >= n - 1:
+            previous = self._seen.get(self._hash)
+            self._seen[self._hash] = idx
+            if not self._period and previous is not None and 0 < idx - previous <= self.max_period:
+                # Confirm the match word by word to rule out hash collisions
+                if self.words[idx - n + 1:idx + 1] == self.words[previous - n + 1:previous + 1]:
+                    self._period = idx - previous
+                    self._run = n
         
-    except requests.RequestException as e:
-        color_print(f"\nAPI Connection Error: {e}", Fore.RED)
-        cancel_keep_alive()
-        return None
-    except Exception as e:
-        color_print(f"\nUnexpected Error: {e}", Fore.RED)
-        cancel_keep_alive()
-        return None
+        if self._period and self._run >= max(self._period * (self.min_repeats - 1), self.min_loop_words):
+            # Keep the first copy of the repeated passage and drop everything after it
+            self.loop_start = self.offsets[idx - self._run + 1]
+            return True
+        return False
 
-def extract_chapters(story_plan):
-    """Extract chapter data from the story plan using regex"""
+class BackendSlot:
+    """A single request slot on one inference server"""
     
-    # Look for chapter patterns in the format "Chapter X: Title - Description"
-    chapter_pattern = re.compile(r'Chapter\s+(\d+):\s+([^-\n]+)\s*-\s*((?:(?!Chapter\s+\d+:)[\s\S])*?)(?=Chapter\s+\d+:|$)', re.IGNORECASE)
-    chapters = chapter_pattern.findall(story_plan)
+    def __init__(self, url, slot_id=None):
+        self.url = url
+        self.slot_id = slot_id
+        self.prefix_key = None  # World bible the slot's last prompt started with, if any
+        self.warm_key = None  # Prompt prefix the slot was last warmed up with
     
-    if not chapters:
-        # Try standard format "Chapter X: Title" with separate description
-        std_chapter_pattern = re.compile(r'Chapter\s+(\d+):\s+([^\n]+)\s*\n((?:(?!Chapter\s+\d+:)[\s\S])*?)(?=Chapter\s+\d+:|$)', re.IGNORECASE)
-        chapters = std_chapter_pattern.findall(story_plan)
+    def __repr__(self):
+        if self.slot_id is None:
+            return self.url
+        return f"{self.url}#{self.slot_id}"
+
+class AIMDController:
+    """Adapt the number of in-flight requests to one backend by additive increase and multiplicative decrease
     
-    if not chapters:
-        # Try an alternative pattern for other formats
-        alt_chapter_pattern = re.compile(r'(?:^|\n)\s*Chapter\s+(\d+)[.:\s-]+([^\n]+)(?:\n(.*?))?(?=\n\s*Chapter\s+\d+[.:\s-]|\Z)', re.DOTALL | re.IGNORECASE)
-        chapters = alt_chapter_pattern.findall(story_plan)
+    The limit grows by one per window while requests queue for this backend and throughput keeps
+    improving. It halves when the backend returns errors or latency spikes well above its baseline.
+    """
     
-    # Format the extracted chapters
-    formatted_chapters = []
-    for match in chapters:
-        try:
-            chapter_num = int(match[0])
-            chapter_title = match[1].strip()
-            chapter_desc = match[2].strip() if len(match) > 2 and match[2] else "No description available."
+    def __init__(self, max_limit, initial_limit=1):
+        self.max_limit = max_limit
+        self.limit = max(1, min(initial_limit, max_limit))
+        self._lock = threading.Lock()
+        self._baselines = {}  # Decaying minimum latency per request kind
+        self._window_start = time.time()
+        self._window_tokens = 0
+        self._saturated = False
+        self._last_throughput = None
+        self._last_change = None
+        self._last_decrease = 0.0
+    
+    def mark_saturated(self):
+        """Note that a request had to wait because this backend was at its limit"""
+        self._saturated = True
+    
+    def observe(self, kind, latency=None, tokens=0, error=False):
+        """Record a finished request and return True if the limit changed"""
+        with self._lock:
+            self._window_tokens += tokens
+            congested = error
+            if latency is not None and not error:
+                baseline = self._baselines.get(kind)
+                if baseline is not None and latency > AIMD_LATENCY_SPIKE * baseline and latency > 0.5:
+                    congested = True
+                # Let the baseline creep up slowly so it follows a backend that is slower overall
+                self._baselines[kind] = latency if baseline is None else min(baseline * 1.02, latency)
             
-            # For the format "Title - Description", merge them if description is too short
-            if chapter_desc == "No description available." or len(chapter_desc.split()) < 10:
-                # Look for a dash in the title to split into title and description
-                if " - " in chapter_title:
-                    parts = chapter_title.split(" - ", 1)
-                    chapter_title = parts[0].strip()
-                    chapter_desc = parts[1].strip()
+            now = time.time()
+            if congested:
+                if now - self._last_decrease < AIMD_WINDOW:
+                    return False
+                self._last_decrease = now
+                return self._set_limit(max(1, int(self.limit * 0.5)), "decrease", now)
             
-            formatted_chapters.append({
-                'number': chapter_num,
-                'title': chapter_title,
-                'description': chapter_desc
-            })
-        except (ValueError, IndexError) as e:
-            color_print(f"Error processing chapter: {e}", Fore.YELLOW)
+            elapsed = now - self._window_start
+            if elapsed < AIMD_WINDOW:
+                return False
+            
+            throughput = self._window_tokens / elapsed
+            previous = self._last_throughput
+            changed = False
+            if self._last_change == "increase" and previous and throughput < previous * 0.9:
+                # The last step up made things worse, so step back down
+                changed = self._set_limit(self.limit - 1, "decrease", now)
+            elif self._saturated and self.limit < self.max_limit and (previous is None or throughput >= previous * 0.95):
+                changed = self._set_limit(self.limit + 1, "increase", now)
+            else:
+                self._start_window(now)
+            self._last_throughput = throughput
+            return changed
     
-    # Sort chapters by number and ensure sequential numbering
-    formatted_chapters.sort(key=lambda x: x['number'])
+    def _set_limit(self, limit, change, now):
+        limit = max(1, min(limit, self.max_limit))
+        changed = limit != self.limit
+        self.limit = limit
+        self._last_change = change if changed else None
+        self._start_window(now)
+        if changed:
+            record_telemetry(f"concurrency_{change}s")
+        return changed
     
-    for i, chapter in enumerate(formatted_chapters):
-        if chapter['number'] != i + 1:
-            color_print(f"Fixed chapter numbering: Chapter {chapter['number']} → Chapter {i+1}", Fore.YELLOW)
-            chapter['number'] = i + 1
+    def _start_window(self, now):
+        self._window_start = now
+        self._window_tokens = 0
+        self._saturated = False
+
+class BackendPool:
+    """Hand out backend slots so that each slot serves one request at a time
     
-    if formatted_chapters:
-        color_print(f"Successfully extracted {len(formatted_chapters)} chapter plans.", Fore.GREEN)
-        for ch in formatted_chapters[:3]:  # Show first 3 as examples
-            color_print(f"Chapter {ch['number']}: {ch['title']}", Fore.CYAN)
-            color_print(f"Description: {ch['description'][:100]}...", Fore.CYAN)
-        if len(formatted_chapters) > 3:
-            color_print(f"... plus {len(formatted_chapters) - 3} more chapters", Fore.CYAN)
-    else:
-        color_print("No chapter plans extracted.", Fore.RED)
+    Each backend also has an AIMD controller that decides how many of its slots may be busy at once.
+    """
     
-    return formatted_chapters
-
-def validate_chapters(chapters):
-    """Validate chapter data and return whether it's complete"""
-    if not chapters:
-        return False
-        
-    # Check for sequential numbering
-    expected_numbers = list(range(1, len(chapters) + 1))
-    actual_numbers = [ch.get('number') for ch in chapters]
+    def __init__(self, urls, slots_per_backend=1):
+        self.slots = [
+            BackendSlot(url, slot_id if slots_per_backend > 1 else None)
+            for url in urls
+            for slot_id in range(slots_per_backend)
+        ]
+        self._free = list(self.slots)
+        self._condition = threading.Condition()
+        self._in_flight = {url: 0 for url in urls}
+        initial_limit = INITIAL_CONCURRENCY if ADAPTIVE_CONCURRENCY else slots_per_backend
+        self.controllers = {url: AIMDController(slots_per_backend, initial_limit) for url in urls}
+        # Scheduler state: waiting tickets, per-class virtual time and per-(class, job) finish times
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._virtual_time = {}
+        self._flow_finish = {}
     
-    # Check all required fields exist
-    all_fields_present = all(
-        'number' in ch and 'title' in ch and 'description' in ch
-        for ch in chapters
-    )
+    def _available(self, exclude):
+        usable = [slot for slot in self._free if self._in_flight[slot.url] < self.controllers[slot.url].limit]
+        preferred = [slot for slot in usable if slot not in exclude]
+        return preferred or usable
     
-    # Check for sufficient chapters
-    sufficient_chapters = len(chapters) >= 5  # Lower minimum threshold to 5 chapters
+    def acquire(self, exclude=None, priority=PRIORITY_CHAPTER, cost=1, prefer=None):
+        """Wait for a free slot, preferring slots not listed in exclude and then the slot given as prefer
+        
+        Waiting requests are served strictly by priority class. Within a class, jobs share the slots
+        by weighted fair queuing: each request gets a virtual finish time of its job's previous finish
+        (or the class's current virtual time, if later) plus its cost, and the earliest finish goes first.
+        """
+        exclude = exclude or ()
+        job = getattr(job_context, 'job', None)
+        flow = (priority, job.id if job is not None else None)
+        with self._condition:
+            start = max(self._virtual_time.get(priority, 0.0), self._flow_finish.get(flow, 0.0))
+            finish = start + cost / max(getattr(job, 'weight', 1), 1e-6)
+            self._flow_finish[flow] = finish
+            ticket = (priority, finish, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while self._waiting[0] != ticket or not self._available(exclude):
+                    if self._waiting[0] == ticket:
+                        for url, in_flight in self._in_flight.items():
+                            if in_flight >= self.controllers[url].limit:
+                                self.controllers[url].mark_saturated()
+                    # Wake up periodically in case a limit was raised
+                    self._condition.wait(1.0)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._virtual_time[priority] = max(self._virtual_time.get(priority, 0.0), start)
+            available = self._available(exclude)
+            slot = prefer if prefer in available else None
+            if slot is None and world_bible_key:
+                # Pin series requests to slots whose prompt cache already holds the world bible
+                slot = next((candidate for candidate in available if candidate.prefix_key == world_bible_key), None)
+            slot = slot or available[0]
+            self._free.remove(slot)
+            self._in_flight[slot.url] += 1
+            # The next waiter may be able to take another free slot
+            self._condition.notify_all()
+            return slot
     
-    # Debug chapter info
-    color_print("\nChapter descriptions:", Fore.CYAN)
-    for i, ch in enumerate(chapters[:3]):  # Print first 3 for debugging
-        desc_words = len(ch.get('description', '').split())
-        color_print(f"Chapter {ch['number']}: {ch['title']} - {desc_words} words", Fore.CYAN)
+    def try_acquire(self, exclude_urls=(), priority=PRIORITY_CONTROL, only=None):
+        """Take a free slot on a backend not in exclude_urls (and among only, if given) without waiting, or return None
+        
+        Hedged copies and warm-ups only use spare capacity, so nothing is taken while a request of the
+        same or a higher priority class is waiting.
+        """
+        with self._condition:
+            if any(ticket[0] <= priority for ticket in self._waiting):
+                return None
+            for slot in self._available(()):
+                if slot.url not in exclude_urls and (only is None or slot in only):
+                    self._free.remove(slot)
+                    self._in_flight[slot.url] += 1
+                    return slot
+            return None
     
-    # Check description length - set to 15 words minimum (even more lenient for testing)
-    min_word_count = 15  # Very low threshold just to ensure some content
-    good_descriptions = all(
-        len(ch.get('description', '').split()) >= min_word_count
-        for ch in chapters
-    )
+    def release(self, slot):
+        """Return a slot to the pool"""
+        with self._condition:
+            if slot in self.slots:
+                self._free.append(slot)
+            self._in_flight[slot.url] -= 1
+            self._condition.notify_all()
     
-    is_valid = (actual_numbers == expected_numbers and 
-                all_fields_present and 
-                sufficient_chapters and 
-                good_descriptions)
+    def limit_slots(self, url, count):
+        """Keep only the first count slots of a backend, for a server that has fewer than configured"""
+        with self._condition:
+            self.slots = [slot for slot in self.slots if slot.url != url or (slot.slot_id or 0) < count]
+            self._free = [slot for slot in self._free if slot in self.slots]
+            controller = self.controllers[url]
+            controller.max_limit = min(controller.max_limit, count)
+            controller.limit = min(controller.limit, controller.max_limit)
+            self._condition.notify_all()
     
-    if not is_valid:
-        if actual_numbers != expected_numbers:
-            color_print("Chapter numbers are not sequential.", Fore.YELLOW)
-        if not all_fields_present:
-            color_print("Some chapters are missing required fields.", Fore.YELLOW)
-        if not sufficient_chapters:
-            color_print(f"Not enough chapters ({len(chapters)}). Expected at least 5.", Fore.YELLOW)
-        if not good_descriptions:
-            color_print(f"Some chapter descriptions are too short (need at least {min_word_count} words each).", Fore.YELLOW)
-            
-            # Print information about the shortest descriptions
-            short_descriptions = [(i+1, ch['title'], len(ch['description'].split())) 
-                                 for i, ch in enumerate(chapters) 
-                                 if len(ch['description'].split()) < min_word_count]
-            for chapter_num, title, word_count in short_descriptions[:3]:  # Show up to 3 examples
-                color_print(f"  - Chapter {chapter_num}: '{title}' has only {word_count} words", Fore.YELLOW)
-            
-            if len(short_descriptions) > 3:
-                color_print(f"  - ... and {len(short_descriptions)-3} more chapters with short descriptions", Fore.YELLOW)
+    def record(self, slot, kind, latency=None, tokens=0, error=False):
+        """Feed a finished request into its backend's concurrency controller"""
+        if not ADAPTIVE_CONCURRENCY:
+            return
+        controller = self.controllers[slot.url]
+        if controller.observe(kind, latency, tokens, error):
+            color_print(f"Concurrency limit for {slot.url} is now {controller.limit}", Fore.BLUE)
+            with self._condition:
+                self._condition.notify_all()
     
-    return is_valid
-
-def get_story_plan_with_chapters(title, theme=None, genre=None, max_attempts=3):
-    """Generate a story plan with valid chapter format, with retries if needed"""
+    def limits(self):
+        return {url: controller.limit for url, controller in self.controllers.items()}
     
-    for attempt in range(max_attempts):
-        color_print(f"\nStory plan generation attempt {attempt+1}/{max_attempts}", Fore.CYAN)
-        
-        additional_instructions = None
-        if attempt > 0:
-            additional_instructions = """
-IMPORTANT: The previous attempt did not provide properly formatted chapter data.
+    @contextmanager
+    def slot(self, exclude=None, priority=PRIORITY_CHAPTER, cost=1, prefer=None):
+        with profile_stage("slot_wait"):
+            slot = self.acquire(exclude, priority, cost, prefer)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
 
-You MUST provide a detailed chapter-by-chapter breakdown in this format:
+# Export workers are spawned processes that import this file again (as __mp_main__ when it is run as
+# a script); they only render files, so they get no backend pool or request threads
+IN_WORKER_PROCESS = __name__ == "__mp_main__" or multiprocessing.parent_process() is not None
 
-Chapter 1: [Title]
-[150-200 word detailed description]
+backend_pool = None if IN_WORKER_PROCESS else BackendPool(BACKEND_URLS, SLOTS_PER_BACKEND)
 
-Chapter 2: [Title]
-[150-200 word detailed description]
+# Worker threads for background requests that run alongside the main pipeline
+background_executor = None if IN_WORKER_PROCESS else ThreadPoolExecutor(max_workers=max(2, len(backend_pool.slots)))
 
-And so on for at least 15-20 chapters.
-"""
+def submit_background(fn, *args, **kwargs):
+    """Run a function on the background executor as part of the current thread's job"""
+    job = getattr(job_context, 'job', None)
+    
+    def run():
+        job_context.job = job
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            job_context.job = None
+    
+    return background_executor.submit(run)
 
-        story_plan = create_story_plan(title, theme, genre, additional_instructions=additional_instructions)
-        if not story_plan:
-            color_print("Failed to generate story plan.", Fore.RED)
-            continue
-        
-        chapters = extract_chapters(story_plan)
-        if validate_chapters(chapters):
-            color_print("✓ Valid chapter format confirmed!", Fore.GREEN)
-            return story_plan, chapters
-        
-        color_print(f"Invalid chapter format. Retrying...", Fore.YELLOW)
+# Shared HTTP session so connections are reused and can be closed on shutdown
+http_session = requests.Session()
+
+def cassette_key(request):
+    """Identify a request by method, path and body, ignoring the server address and slot assignment"""
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    try:
+        data = json.loads(body)
+        if isinstance(data, dict):
+            data.pop("id_slot", None)
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+    except ValueError:
+        pass
+    path = request.path_url
+    return hashlib.sha256(request.method.encode('utf-8') + b" " + path.encode('utf-8') + b"\n" + body).hexdigest()
+
+# Headers that describe the wire encoding, which no longer applies to the decoded body kept in a cassette
+CASSETTE_SKIPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding", "connection")
+
+class RecordingBody:
+    """Wrap a response body so the chunks read from it are written to the cassette with their timing"""
     
-    # If we get here, all attempts failed to produce valid chapter data
-    color_print("\nFailed to get properly formatted chapters after multiple attempts.", Fore.RED)
+    def __init__(self, raw, cassette, entry, start_time):
+        self._raw = raw
+        self._cassette = cassette
+        self._entry = entry
+        self._start_time = start_time
+        self._saved = False
     
-    # Last resort: try to manually parse the story plan to extract any usable chapters
-    color_print("Attempting to manually extract chapter information...", Fore.YELLOW)
+    def __getattr__(self, name):
+        # The stream watchdog reaches the socket through raw.connection
+        return getattr(self._raw, name)
     
-    # First, find the chapter breakdown section
-    chapter_section_pattern = re.compile(r'(?:7\.\s*)?(?:DETAILED\s*)?CHAPTER\s*BREAKDOWN:?.*?(?=8\.|$)', re.DOTALL | re.IGNORECASE)
-    chapter_section_match = chapter_section_pattern.search(story_plan)
+    def stream(self, amount=2 ** 16, decode_content=None):
+        try:
+            for chunk in self._raw.stream(amount, decode_content=True):
+                # latin-1 maps bytes one to one, so chunks that split a UTF-8 character survive JSON
+                self._entry["chunks"].append([round(time.time() - self._start_time, 4), chunk.decode('latin-1')])
+                yield chunk
+        finally:
+            self._save()
     
-    if chapter_section_match:
-        chapter_section = chapter_section_match.group(0)
-        # Extract anything that looks like a chapter with a number and title
-        manual_chapter_pattern = re.compile(r'(?:Chapter|Ch\.?)\s*(\d+)[\s:\-\.]*([^.\n]+)(?:\.\s*|\n)(.*?)(?=(?:Chapter|Ch\.?)\s*\d+[\s:\-\.]|$)', re.DOTALL | re.IGNORECASE)
-        manual_chapters = manual_chapter_pattern.findall(chapter_section)
+    def read(self, *args, **kwargs):
+        return b"".join(self.stream())
+    
+    def close(self):
+        self._save()
+        self._raw.close()
+    
+    def _save(self):
+        if not self._saved:
+            self._saved = True
+            self._cassette.write(self._entry)
+
+class ReplayBody:
+    """Response body that plays back recorded chunks, optionally at the recorded pace"""
+    
+    def __init__(self, chunks, speed):
+        self._chunks = chunks
+        self._speed = speed
+        self._closed = False
+    
+    def stream(self, amount=2 ** 16, decode_content=None):
+        start = time.time()
+        for offset, chunk in self._chunks:
+            if self._closed:
+                return
+            if self._speed > 0:
+                delay = offset / self._speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield chunk.encode('latin-1')
+    
+    def read(self, *args, **kwargs):
+        return b"".join(self.stream())
+    
+    def close(self):
+        self._closed = True
+    
+    def release_conn(self):
+        pass
+
+class Cassette:
+    """gzip-compressed JSON lines file of backend requests and their timed response chunks
+    
+    Identical requests are replayed in the order they were recorded.
+    """
+    
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.file = None
+        if mode == "record":
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.load()
+    
+    def load(self):
+        count = 0
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+                    count += 1
+        except (EOFError, json.JSONDecodeError):
+            # A recording cut short by a crash still replays up to the last complete entry
+            pass
+        color_print(f"Loaded {count} recorded requests from {self.path}", Fore.BLUE)
+    
+    def write(self, entry):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+    
+    def take(self, key):
+        with self.lock:
+            entries = self.entries.get(key)
+            return entries.pop(0) if entries else None
+    
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class CassetteAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter that records backend traffic to a cassette or replays it without a server"""
+    
+    def __init__(self, cassette, speed=0.0):
+        super().__init__(pool_maxsize=max(10, len(BACKEND_URLS) * SLOTS_PER_BACKEND))
+        self.cassette = cassette
+        self.speed = speed
+    
+    def send(self, request, stream=False, **kwargs):
+        key = cassette_key(request)
+        if self.cassette.mode == "replay":
+            return self.replay(request, key)
         
-        if manual_chapters:
-            formatted_chapters = []
-            for i, (num, title, desc) in enumerate(manual_chapters):
-                formatted_chapters.append({
-                    'number': i + 1,  # Ensure sequential numbering
-                    'title': title.strip(),
-                    'description': desc.strip() if desc.strip() else f"Events for Chapter {i+1}"
-                })
-            
-            color_print(f"Manually extracted {len(formatted_chapters)} chapters.", Fore.GREEN)
-            return story_plan, formatted_chapters
+        start_time = time.time()
+        response = super().send(request, stream=True, **kwargs)
+        entry = {
+            "key": key,
+            "method": request.method,
+            "path": request.path_url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {name: value for name, value in response.headers.items() if name.lower() not in CASSETTE_SKIPPED_HEADERS},
+            "chunks": [],
+        }
+        response.raw = RecordingBody(response.raw, self.cassette, entry, start_time)
+        record_telemetry("cassette_recorded")
+        if not stream:
+            response.content
+        return response
     
-    # If all else fails, create some basic chapter data from the story plan
-    color_print("Creating basic chapter structure from story plan.", Fore.YELLOW)
-    basic_chapters = []
-    # Split story plan into sections to use as chapter content
-    sections = re.split(r'\n\s*\d+\.\s+', story_plan)
-    for i, section in enumerate(sections[1:6]):  # Use up to 5 sections as chapters
-        basic_chapters.append({
-            'number': i + 1,
-            'title': f"Chapter {i+1}",
-            'description': f"Content based on story plan section {i+1}: {section[:200]}..."
+    def replay(self, request, key):
+        entry = self.cassette.take(key)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.connection = self
+        if entry is None:
+            record_telemetry("cassette_misses")
+            color_print(f"No recorded response for {request.method} {request.path_url}", Fore.YELLOW)
+            response.status_code = 404
+            response.reason = "Not in cassette"
+            response.raw = ReplayBody([[0, json.dumps({"error": "not in cassette"})]], 0)
+            return response
+        record_telemetry("cassette_replayed")
+        response.status_code = entry["status"]
+        response.reason = entry.get("reason")
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = ReplayBody(entry["chunks"], self.speed)
+        return response
+    
+    def close(self):
+        self.cassette.close()
+        super().close()
+
+def install_cassette():
+    """Route backend traffic through the recording or replay cassette, if one is configured
+    
+    Called from the main entry point only: opening a cassette for recording truncates it, so no
+    other process that imports this file may do it.
+    """
+    if not (CASSETTE_RECORD or CASSETTE_REPLAY) or IN_WORKER_PROCESS:
+        return
+    cassette_adapter = CassetteAdapter(
+        Cassette(CASSETTE_REPLAY or CASSETTE_RECORD, "replay" if CASSETTE_REPLAY else "record"),
+        CASSETTE_REPLAY_SPEED
+    )
+    http_session.mount("http://", cassette_adapter)
+    http_session.mount("https://", cassette_adapter)
+
+
+class BackendDriver:
+    """Translate generic completion requests into one server's API and report what the server supports
+    
+    Requests use llama.cpp-style parameter names (temperature, repeat_penalty, grammar, cache_prompt, ...);
+    each driver renames them for its server or drops the ones the server does not understand.
+    """
+    
+    name = "generic"
+    completion_path = ""
+    
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.capabilities = {
+            "context_size": None,
+            "slots": None,
+            "prompt_cache": False,
+            "grammar": False,
+            "tokenize": False,
+            "model": None,
+        }
+    
+    @property
+    def completion_url(self):
+        return self.base_url + self.completion_path
+    
+    def supports(self, capability):
+        return bool(self.capabilities.get(capability))
+    
+    def count_tokens(self, text):
+        """Count the tokens of text with the server's tokenizer, or estimate them if it has no endpoint for that"""
+        return estimate_tokens(text)
+    
+    def get_json(self, path, timeout=5):
+        """GET a JSON document from the server, or None if it is not available"""
+        try:
+            response = http_session.get(self.base_url + path, timeout=(CONNECT_TIMEOUT, timeout))
+            if response.status_code == 200:
+                return response.json()
+        except (requests.RequestException, ValueError):
+            pass
+        return None
+    
+    def probe(self):
+        """Ask the server what it supports and fill in self.capabilities; return False if it did not answer"""
+        raise NotImplementedError
+    
+    def build_payload(self, prompt, max_tokens, stream, slot_id, params):
+        """Build the request body; slot_id is only used by servers with addressable slots"""
+        raise NotImplementedError
+    
+    def parse_content(self, data):
+        """Return the generated text from a non-streamed response body"""
+        raise NotImplementedError
+    
+    def parse_stream_line(self, line):
+        """Return (text, done) for one line of a streamed response, or None if the line carries nothing"""
+        raise NotImplementedError
+
+class LlamaCppDriver(BackendDriver):
+    """llama.cpp server /completion endpoint"""
+    
+    name = "llama.cpp"
+    completion_path = "/completion"
+    
+    def probe(self):
+        props = self.get_json("/props")
+        if props is None:
+            if self.get_json("/health") is None:
+                return False
+            props = {}
+        settings = props.get("default_generation_settings", {})
+        self.capabilities.update({
+            "context_size": settings.get("n_ctx") or props.get("n_ctx"),
+            "slots": props.get("total_slots"),
+            "prompt_cache": True,
+            "grammar": True,
+            "tokenize": True,
+            "model": props.get("model_path") or settings.get("model"),
         })
+        return True
     
-    return story_plan, basic_chapters
+    def count_tokens(self, text):
+        try:
+            response = http_session.post(self.base_url + "/tokenize", json={"content": text}, timeout=(CONNECT_TIMEOUT, 10))
+            if response.status_code == 200:
+                return len(response.json().get("tokens", []))
+        except (requests.RequestException, ValueError):
+            pass
+        return estimate_tokens(text)
+    
+    def build_payload(self, prompt, max_tokens, stream, slot_id, params):
+        payload = {"prompt": prompt, "n_predict": max_tokens, "stream": stream, **params}
+        if slot_id is not None:
+            payload["id_slot"] = slot_id
+        return payload
+    
+    def parse_content(self, data):
+        return data.get('content', '')
+    
+    def parse_stream_line(self, line):
+        if not line.startswith('data: '):
+            return None
+        data = json.loads(line[6:])
+        return data.get('content', ''), bool(data.get('stop'))
 
-def generate_chapter(title, chapter_plan, chapter_number, previous_chapters_summary=None, previous_chapter_ending=None, min_words=4000, max_tokens=8000):
-    """Generate a single detailed chapter based on the chapter plan with improved continuity"""
+class OpenAIDriver(BackendDriver):
+    """OpenAI-compatible /v1/completions endpoint (vLLM, llama.cpp, LM Studio and others)"""
     
-    color_print(f"\nGenerating Chapter {chapter_number}: {title}\n", Fore.CYAN)
+    name = "openai"
+    completion_path = "/v1/completions"
+    # Standard parameters only; unknown fields are rejected by strict servers
+    passed_params = ("temperature", "top_p", "presence_penalty", "frequency_penalty", "stop", "seed")
     
-    context = ""
-    continuity_instruction = ""
+    def probe(self):
+        models = self.get_json("/v1/models")
+        if models is None:
+            return False
+        model = (models.get("data") or [{}])[0]
+        self.capabilities.update({
+            "context_size": model.get("max_model_len") or model.get("context_length"),
+            "model": model.get("id"),
+        })
+        return True
     
-    if previous_chapters_summary:
-        context = f"""Previous chapters summary:
-{previous_chapters_summary}
+    def build_payload(self, prompt, max_tokens, stream, slot_id, params):
+        payload = {"prompt": prompt, "max_tokens": max_tokens, "stream": stream}
+        model = BACKEND_MODEL or self.capabilities.get("model")
+        if model:
+            payload["model"] = model
+        payload.update((key, value) for key, value in params.items() if key in self.passed_params)
+        return payload
+    
+    def parse_content(self, data):
+        choices = data.get('choices') or [{}]
+        return choices[0].get('text', '')
+    
+    def parse_stream_line(self, line):
+        if not line.startswith('data: '):
+            return None
+        if line[6:].strip() == "[DONE]":
+            return "", True
+        choices = json.loads(line[6:]).get('choices') or [{}]
+        return choices[0].get('text', ''), choices[0].get('finish_reason') is not None
 
-"""
+class OllamaDriver(BackendDriver):
+    """Ollama /api/generate endpoint"""
     
-    if previous_chapter_ending and chapter_number > 1:
-        # Extract the last 500-1000 characters of the previous chapter for direct continuity
-        continuity_instruction = f"""
-IMPORTANT - CONTINUITY INSTRUCTION:
-The previous chapter ended with this exact scene:
+    name = "ollama"
+    completion_path = "/api/generate"
+    option_names = {
+        "temperature": "temperature",
+        "top_p": "top_p",
+        "repeat_penalty": "repeat_penalty",
+        "repeat_last_n": "repeat_last_n",
+        "presence_penalty": "presence_penalty",
+        "frequency_penalty": "frequency_penalty",
+        "stop": "stop",
+        "seed": "seed",
+    }
+    
+    def probe(self):
+        tags = self.get_json("/api/tags")
+        if tags is None:
+            return False
+        models = tags.get("models") or [{}]
+        model = BACKEND_MODEL or models[0].get("name")
+        context_size = None
+        if model:
+            try:
+                response = http_session.post(self.base_url + "/api/show", json={"model": model}, timeout=(CONNECT_TIMEOUT, 5))
+                info = response.json().get("model_info", {}) if response.status_code == 200 else {}
+                context_size = next((value for key, value in info.items() if key.endswith(".context_length")), None)
+            except (requests.RequestException, ValueError):
+                pass
+        self.capabilities.update({
+            "context_size": context_size,
+            # Ollama keeps the previous context of each loaded model and reuses the shared prefix
+            "prompt_cache": True,
+            "model": model,
+        })
+        return True
+    
+    def build_payload(self, prompt, max_tokens, stream, slot_id, params):
+        options = {"num_predict": max_tokens}
+        options.update((self.option_names[key], value) for key, value in params.items() if key in self.option_names)
+        # raw mode sends the prompt as is, without the model's chat template
+        return {"model": self.capabilities.get("model"), "prompt": prompt, "stream": stream, "raw": True, "options": options}
+    
+    def parse_content(self, data):
+        return data.get('response', '')
+    
+    def parse_stream_line(self, line):
+        data = json.loads(line)
+        return data.get('response', ''), bool(data.get('done'))
 
-{previous_chapter_ending}
+BACKEND_DRIVERS = {"llamacpp": LlamaCppDriver, "openai": OpenAIDriver, "ollama": OllamaDriver}
 
-Your chapter MUST continue directly from this point, maintaining perfect narrative continuity.
-Start with the immediate next moment in the story - do not summarize or create a time jump unless the chapter plan specifically calls for it.
-Maintain consistency with character locations, emotional states, and ongoing dialogue or actions.
-"""
+backend_drivers = {}
+backend_drivers_lock = threading.Lock()
+
+def detect_backend_driver(url):
+    """Pick the driver for a backend URL from NOVELGEN_BACKEND_TYPE, the URL path, or by probing the server"""
+    url = url.rstrip('/')
+    candidates = list(BACKEND_DRIVERS.values())
+    if BACKEND_TYPE in BACKEND_DRIVERS:
+        candidates = [BACKEND_DRIVERS[BACKEND_TYPE]]
+    
+    for driver_class in candidates:
+        if url.endswith(driver_class.completion_path):
+            driver = driver_class(url[:-len(driver_class.completion_path)])
+            if not driver.probe():
+                color_print(f"Could not probe {driver.name} backend at {driver.base_url}; assuming defaults.", Fore.YELLOW)
+            return driver
     
-    prompt = f"""{context}{continuity_instruction}Write Chapter {chapter_number} titled "{title}" based on this detailed plan:
+    # A bare server address: ask each kind of server in turn
+    for driver_class in candidates:
+        driver = driver_class(url)
+        if driver.probe():
+            return driver
+    color_print(f"Could not identify the backend at {url}; treating it as llama.cpp.", Fore.YELLOW)
+    return (candidates[0] if len(candidates) == 1 else LlamaCppDriver)(url)
 
-{chapter_plan}
+def get_backend_driver(url):
+    """Return the driver for a backend URL, probing the server the first time it is used"""
+    with backend_drivers_lock:
+        driver = backend_drivers.get(url)
+        if driver is None:
+            driver = backend_drivers[url] = detect_backend_driver(url)
+            capabilities = ", ".join(f"{key}={value}" for key, value in driver.capabilities.items() if value not in (None, False))
+            color_print(f"Backend {url}: {driver.name} ({capabilities or 'no optional features'})", Fore.BLUE)
+            slots = driver.capabilities.get("slots")
+            if slots and SLOTS_PER_BACKEND > slots and backend_pool is not None:
+                # Slot ids past the server's last slot would be rejected, so they are taken out of the pool
+                color_print(f"Warning: NOVELGEN_SLOTS is {SLOTS_PER_BACKEND} but the server reports {slots} slots; using {slots}.", Fore.YELLOW)
+                backend_pool.limit_slots(url, slots)
+        return driver
 
-Guidelines:
-1. Create a substantial chapter of AT LEAST {min_words} words
-2. Include vivid descriptions, meaningful dialogue, and varied sentence structure
-3. Focus on character development and advancing the plot
-4. Create proper paragraphs with thoughtful transitions
-5. Maintain a consistent narrative voice
-6. If this is not Chapter 1, ensure DIRECT CONTINUITY with the ending of the previous chapter
-7. Incorporate sensory details to bring scenes to life
-8. End the chapter with a hook that propels the reader forward
+def backends_support(capability):
+    """Whether every configured backend supports an optional feature"""
+    return all(get_backend_driver(url).supports(capability) for url in BACKEND_URLS)
 
-This MUST be a substantial chapter with proper pacing and development.
-DO NOT stop before reaching at least {min_words} words.
-Format this as a standard novel chapter with "Chapter {chapter_number}: {title}" at the beginning.
-YOU MUST WRITE AT LEAST {min_words} WORDS, and you'll be penalized if you write fewer words.
+def unsupported_slots(params):
+    """Slots on backends that would ignore the grammar in params, so grammar requests avoid them when they can"""
+    if "grammar" not in params:
+        return []
+    return [slot for slot in backend_pool.slots if not get_backend_driver(slot.url).supports("grammar")]
 
-Begin:
-"""
+def fit_context(driver, prompt, max_tokens):
+    """Shorten max_tokens so the prompt and the answer fit in the server's context window"""
+    context_size = driver.capabilities.get("context_size")
+    if not context_size:
+        return max_tokens
+    # The estimate is free; the server's tokenizer is asked only when the request may not fit
+    if estimate_tokens(prompt) + max_tokens < context_size * 0.8:
+        return max_tokens
+    prompt_tokens = driver.count_tokens(prompt)
+    if prompt_tokens + max_tokens <= context_size:
+        return max_tokens
+    record_telemetry("context_clamped")
+    fitted = max(1, context_size - prompt_tokens)
+    color_print(f"Prompt of {prompt_tokens} tokens leaves {fitted} of the {max_tokens} requested tokens in a {context_size}-token context", Fore.YELLOW)
+    return fitted
+
+class CachedResponse:
+    """Stand-in for a requests response holding a normalized {"content": ...} result
+    
+    Returned for every successful non-streamed request, whether it came from the server or the response cache.
+    """
+    
+    status_code = 200
+    
+    def __init__(self, data):
+        self._data = data
+    
+    def json(self):
+        return dict(self._data)
+    
+    def close(self):
+        pass
+
+# Results of non-streamed requests, keyed by a hash of the request, shared by every job in the process
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+
+def response_cache_key(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+def response_cache_get(cache_key):
+    with response_cache_lock:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            response_cache.move_to_end(cache_key)
+    if cached is not None:
+        record_telemetry("response_cache_hits")
+    return cached
 
+def response_cache_put(cache_key, data):
+    with response_cache_lock:
+        response_cache[cache_key] = data
+        while len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+# World bible of the series being written, sent as a fixed prefix of every prompt (see run_series_book)
+world_bible = None
+world_bible_key = None
+
+def set_world_bible(text):
+    """Start every later prompt with the given text, or stop adding a prefix if it is None"""
+    global world_bible, world_bible_key
+    world_bible = text
+    world_bible_key = hashlib.sha256(text.encode('utf-8')).hexdigest() if text else None
+
+def completion_request(slot, prompt, max_tokens, stream=False, cache=True, measure=True, **params):
+    """POST a completion request to a backend slot with connect and read timeouts
+    
+    Successful non-streamed results are cached, so repeating an identical request costs nothing.
+    Requests with measure=False (warm-ups) are left out of the concurrency controller's latencies.
+    """
+    if world_bible:
+        # The same bible opens every prompt, so the backend can keep its prefill cached between requests
+        prompt = world_bible + prompt
+        params.setdefault("cache_prompt", True)
+    slot.prefix_key = world_bible_key
+    
+    driver = get_backend_driver(slot.url)
+    max_tokens = fit_context(driver, prompt, max_tokens)
+    if "grammar" in params and not driver.supports("grammar"):
+        # Every grammar request also states its format in the prompt and is parsed leniently, so it
+        # still works unconstrained on a backend that has no grammar support
+        params = {key: value for key, value in params.items() if key != "grammar"}
+        record_telemetry("grammar_unsupported")
+    
+    payload = {
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "stream": stream,
+        **params
+    }
+    
+    cache_key = None
+    if cache and not stream and RESPONSE_CACHE_SIZE > 0:
+        cache_key = response_cache_key(payload)
+        cached = response_cache_get(cache_key)
+        if cached is not None:
+            return CachedResponse(cached)
+    
+    request_payload = driver.build_payload(prompt, max_tokens, stream, slot.slot_id, params)
+    
+    # Streams are policed by the watchdog; the read timeout is only a backstop
+    read_timeout = max(FIRST_TOKEN_TIMEOUT, STALL_TIMEOUT) + 5 if stream else REQUEST_DEADLINE
+    start_time = time.time()
     try:
-        start_time = time.time()
-        color_print("Sending chapter request to API...", Fore.YELLOW)
-        
-        keep_alive_running = setup_keep_alive()
-        
-        response = requests.post(
-            "http://localhost:8080/completion",
-            json={
-                "prompt": prompt,
-                "max_tokens": max_tokens,
-                "stream": True
-            },
-            stream=True
-        )
-        
+        with profile_stage("network"):
+            response = http_session.post(
+                driver.completion_url,
+                json=request_payload,
+                stream=stream,
+                timeout=(CONNECT_TIMEOUT, read_timeout)
+            )
+    except requests.RequestException:
+        backend_pool.record(slot, "request", error=True)
+        raise
+    
+    # Streamed requests are measured by stream_completion once their tokens arrive
+    data = None
+    if not stream:
         if response.status_code != 200:
-            color_print(f"\nAPI Error: Status code {response.status_code}", Fore.RED)
-            cancel_keep_alive()
-            return None
-            
-        full_response = ""
-        buffer = ""
-        color_print("\nGenerating chapter... \n", Fore.YELLOW)
-        
-        for line in response.iter_lines():
-            if line:
-                try:
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith('data: '):
-                        json_data = json.loads(decoded_line[6:])
-                        content = json_data.get('content', '')
-                        buffer += content
-                        full_response += content
-                        
-                        if content and content[-1] in (' ', '.', ',', '!', '?', '\n'):
-                            color_print(buffer, Fore.CYAN)
-                            buffer = ""
-                except json.JSONDecodeError:
-                    color_print("\nError decoding JSON from API response", Fore.RED)
-                except Exception as e:
-                    color_print(f"\nError processing stream: {e}", Fore.RED)
-        
-        if buffer:
-            color_print(buffer, Fore.CYAN)
-        
-        cancel_keep_alive()
-        end_time = time.time()
-        duration = end_time - start_time
-        word_count = len(full_response.split())
-        color_print(f"\n\nChapter generation complete in {duration:.2f} seconds!", Fore.GREEN)
-        color_print(f"Word count: {word_count} words", Fore.GREEN)
-        
-        # Check if we've reached the minimum word count
-        if word_count < min_words:
-            color_print(f"\n⚠️ WARNING: Generated only {word_count} words, which is less than the minimum {min_words} words.", Fore.YELLOW)
-            
-            # Try to extend the chapter if it's too short
-            if word_count < min_words * 0.8:  # If less than 80% of target
-                color_print("Attempting to extend the chapter to reach minimum word count...", Fore.YELLOW)
-                
-                extension_prompt = f"""Continue the following chapter to reach at least {min_words} words total. The current chapter is {word_count} words, so you need to add approximately {min_words - word_count} more words.
+            if measure:
+                backend_pool.record(slot, "request", error=response.status_code in (429, 500, 502, 503, 504))
+        else:
+            try:
+                data = {"content": driver.parse_content(response.json())}
+            except (ValueError, AttributeError):
+                data = None
+            tokens = estimate_tokens(data['content']) if data else 0
+            # Normalize by output length so short and long calls are comparable
+            if measure:
+                backend_pool.record(slot, "request", latency=(time.time() - start_time) / (1 + tokens / 50), tokens=tokens)
+    
+    if data is None:
+        return response
+    
+    if cache_key:
+        response_cache_put(cache_key, data)
+    return CachedResponse(data)
 
-Current chapter content (ending):
-{full_response[-2000:]}
+def warm_up_slot(slot, prefix=""):
+    """Prefill a prompt prefix on a slot taken from the pool with a one-token request, then release it"""
+    try:
+        with profile_stage("warmup"):
+            # completion_request puts the world bible, if any, in front of the prefix
+            response = completion_request(slot, prefix, 1, cache=False, measure=False, cache_prompt=True, temperature=0)
+        if response.status_code == 200:
+            record_telemetry("warmup_requests")
+        else:
+            slot.prefix_key = slot.warm_key = None
+    except requests.RequestException as e:
+        slot.prefix_key = slot.warm_key = None
+        color_print(f"Warm-up of {slot} failed: {e}", Fore.YELLOW)
+    finally:
+        backend_pool.release(slot)
 
-Continue the chapter naturally, maintaining the same style, tone, and narrative flow. Do not create a new chapter - just continue this one with additional content that extends the scene, adds detail, or explores character thoughts and feelings more deeply.
+def warm_up_slots(prefix=""):
+    """Start prefilling the shared start of the coming prompts (the world bible, if any, then prefix) on
+    every idle slot that has not been warmed with it yet, without waiting
+    
+    Busy slots are skipped: the request they are running already leaves the prefix in their cache or
+    the next one pays for it once, as it would without the warm-up.
+    """
+    if not WARM_UP_SLOTS or not (world_bible or prefix):
+        return []
+    key = artifact_key(world_bible_key, prefix)
+    futures = []
+    for slot in backend_pool.slots:
+        if slot.warm_key == key or not get_backend_driver(slot.url).supports("prompt_cache"):
+            continue
+        if backend_pool.try_acquire(priority=PRIORITY_BACKGROUND, only=(slot,)) is not None:
+            slot.warm_key = key
+            futures.append(submit_background(warm_up_slot, slot, prefix))
+    if futures:
+        color_print(f"Warming {len(futures)} backend slot(s) with the shared prompt prefix", Fore.BLUE)
+    return futures
 
-Continue from here:
-"""
-                
-                try:
-                    keep_alive_running = setup_keep_alive()
-                    
-                    extension_response = requests.post(
-                        "http://localhost:8080/completion",
-                        json={
-                            "prompt": extension_prompt,
-                            "max_tokens": max(2000, (min_words - word_count) * 2),  # Approximate tokens needed
-                            "stream": True
-                        },
-                        stream=True
-                    )
-                    
-                    if extension_response.status_code == 200:
-                        extension_content = ""
-                        buffer = ""
-                        color_print("\nExtending chapter... \n", Fore.YELLOW)
-                        
-                        for line in extension_response.iter_lines():
-                            if line:
-                                try:
-                                    decoded_line = line.decode('utf-8')
-                                    if decoded_line.startswith('data: '):
-                                        json_data = json.loads(decoded_line[6:])
-                                        content = json_data.get('content', '')
-                                        buffer += content
-                                        extension_content += content
-                                        
-                                        if content and content[-1] in (' ', '.', ',', '!', '?', '\n'):
-                                            color_print(buffer, Fore.CYAN)
-                                            buffer = ""
-                                except Exception as e:
-                                    pass
-                                    
-                        if buffer:
-                            color_print(buffer, Fore.CYAN)
-                        
-                        # Combine original content with extension
-                        full_response = full_response + "\n\n" + extension_content
-                        new_word_count = len(full_response.split())
-                        color_print(f"\nExtended chapter word count: {new_word_count} words", Fore.GREEN)
-                        
-                except Exception as e:
-                    color_print(f"Error during chapter extension: {e}", Fore.RED)
-                finally:
-                    cancel_keep_alive()
-        
-        return full_response.strip()
-        
-    except requests.RequestException as e:
-        color_print(f"\nAPI Connection Error: {e}", Fore.RED)
-        cancel_keep_alive()
+def close_connections():
+    """Cancel queued background work and close all pooled HTTP connections"""
+    background_executor.shutdown(wait=False, cancel_futures=True)
+    try:
+        http_session.close()
+    except Exception:
+        pass
+
+class StreamMonitor:
+    """Track one streaming request so the watchdog and signal handler can act on it"""
+    
+    def __init__(self, deadline, sinks=()):
+        self.deadline_at = time.time() + deadline
+        self.sinks = list(sinks)
+        self.persist_channel = None  # TokenChannel feeding the sinks, if any
+        self.response = None
+        self.reason = None
+        self.last_activity = time.time()
+        self.first_token_received = False
+    
+    def start_request(self, response):
+        self.response = response
+        self.reason = None
+        self.last_activity = time.time()
+        self.first_token_received = False
+    
+    def token_received(self):
+        self.last_activity = time.time()
+        self.first_token_received = True
+    
+    def check(self, now):
+        """Return the reason this stream should be aborted, if any"""
+        if now > self.deadline_at:
+            return "deadline"
+        limit = STALL_TIMEOUT if self.first_token_received else FIRST_TOKEN_TIMEOUT
+        if now - self.last_activity > limit:
+            return "stall"
+        return None
+    
+    def abort(self, reason):
+        """Shut down the underlying socket so a blocked read returns immediately"""
+        self.reason = reason
+        response = self.response
+        if response is None:
+            return
+        sock = None
+        try:
+            sock = response.raw.connection.sock
+        except AttributeError:
+            pass
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+active_streams = set()
+active_streams_lock = threading.Lock()
+stream_watchdog_started = False
+shutdown_requested = threading.Event()
+
+def stream_watchdog():
+    """Abort streams that stall between tokens or run past their deadline"""
+    while True:
+        time.sleep(0.5)
+        now = time.time()
+        with active_streams_lock:
+            monitors = list(active_streams)
+        for monitor in monitors:
+            if monitor.reason is None:
+                reason = monitor.check(now)
+                if reason:
+                    monitor.abort(reason)
+
+def register_stream(monitor):
+    global stream_watchdog_started
+    with active_streams_lock:
+        active_streams.add(monitor)
+        if not stream_watchdog_started:
+            threading.Thread(target=stream_watchdog, daemon=True).start()
+            stream_watchdog_started = True
+
+def unregister_stream(monitor):
+    with active_streams_lock:
+        active_streams.discard(monitor)
+
+def flush_partial_streams():
+    """Sync the partial file of every in-progress stream that has one"""
+    with active_streams_lock:
+        monitors = list(active_streams)
+    for monitor in monitors:
+        # Write out tokens that are still queued for the sinks, without waiting on a stuck disk for long
+        if monitor.persist_channel is not None:
+            monitor.persist_channel.drain(timeout=2.0)
+        for sink in monitor.sinks:
+            try:
+                sink.sync()
+                if getattr(sink, 'path', None):
+                    color_print(f"Partial output saved to {sink.path}", Fore.GREEN)
+            except Exception as e:
+                color_print(f"Warning: Could not save partial output: {e}", Fore.YELLOW)
+
+class PartialOutputSink:
+    """Tee streamed tokens into a partial file, fsyncing periodically so a crash loses little text"""
+    
+    def __init__(self, path, initial_text="", fsync_interval=None):
+        self.path = path
+        self.fsync_interval = PARTIAL_FSYNC_INTERVAL if fsync_interval is None else fsync_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Binary mode so the file can be truncated at an exact byte offset
+        self.file = open(path, 'wb')
+        self.file.write(initial_text.encode('utf-8'))
+        self.sync()
+    
+    def write(self, text):
+        self.file.write(text.encode('utf-8'))
+        if time.time() - self._last_sync >= self.fsync_interval:
+            self.sync()
+    
+    def reset(self, text):
+        """Replace the file contents, e.g. after a repeated tail has been trimmed"""
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(text.encode('utf-8'))
+        self.sync()
+    
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._last_sync = time.time()
+    
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+class TokenChannel:
+    """Bounded queue from a stream's network reader to one consumer thread
+    
+    The policy says what the reader does when the queue is full: "block" waits (text that must not be
+    lost), "coalesce" merges the new text into the last queued item, and "drop" discards it.
+    """
+    
+    def __init__(self, name, handler, policy="block", maxsize=STREAM_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.policy = policy
+        self.maxsize = maxsize
+        self.items = deque()
+        self.busy = False
+        self.closed = False
+        self.failed = False
+        self.condition = threading.Condition()
+        # The handler runs as part of the job that opened the stream, so its background work keeps the job's share
+        self.job = getattr(job_context, 'job', None)
+        self.thread = threading.Thread(target=self.run, name=f"stream-{name}", daemon=True)
+        self.thread.start()
+    
+    def put(self, text):
+        with self.condition:
+            while len(self.items) >= self.maxsize:
+                if self.policy == "drop":
+                    record_telemetry(f"stream_{self.name}_dropped")
+                    return
+                if self.policy == "coalesce":
+                    self.items[-1] += text
+                    return
+                record_telemetry(f"stream_{self.name}_waits")
+                self.condition.wait()
+            self.items.append(text)
+            self.condition.notify_all()
+    
+    def run(self):
+        job_context.job = self.job
+        while True:
+            with self.condition:
+                while not self.items and not self.closed:
+                    self.condition.wait()
+                if not self.items:
+                    return
+                text = self.items.popleft()
+                self.busy = True
+                self.condition.notify_all()
+            try:
+                if not self.failed:
+                    self.handler(text)
+            except Exception as e:
+                # Report once and stop calling a consumer that failed, rather than stopping the stream
+                self.failed = True
+                color_print(f"\nError in stream {self.name}: {e}", Fore.RED)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+    
+    def drain(self, timeout=None):
+        """Wait until the consumer has handled everything queued so far"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.items and not self.busy, timeout)
+    
+    def close(self):
+        """Let the consumer finish the queue, then stop its thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+class StreamRenderer:
+    """Echo streamed text to the terminal a few words at a time"""
+    
+    def __init__(self, color):
+        self.color = color
+        self.buffer = ""
+    
+    def write(self, text):
+        self.buffer += text
+        if self.buffer[-1] in (' ', '.', ',', '!', '?', '\n'):
+            self.flush()
+    
+    def flush(self):
+        if self.buffer:
+            color_print(self.buffer, self.color)
+            self.buffer = ""
+
+class StreamProgress:
+    """Report the number of streamed tokens to a job server job every few seconds"""
+    
+    def __init__(self, job, interval=2.0):
+        self.job = job
+        self.interval = interval
+        self.tokens = 0
+        self.last_report = time.time()
+    
+    def write(self, text):
+        self.tokens += 1
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.job.add_event("stream_progress", {"tokens": self.tokens})
+
+def stream_completion(prompt, max_tokens, color=Fore.CYAN, detect_loops=True, max_loop_retries=2,
+                      max_stall_retries=2, deadline=None, sinks=(), prefix="", sampling=None,
+                      priority=PRIORITY_CHAPTER):
+    """Stream a completion with loop detection, stall recovery and a hard deadline
+    
+    If prefix is given, generation continues from that text and it is included in the result.
+    Every token is also written to each of the sinks (see PartialOutputSink for the interface).
+    Pass color=None to stream without echoing to the terminal.
+    
+    This thread only reads and decodes the stream. The terminal, the sinks, the loop detector and
+    progress events each run on their own thread behind a TokenChannel, so a slow consumer never
+    delays reading the socket: sinks and the detector block the reader when far behind, the terminal
+    coalesces queued text, and progress events are dropped.
+    """
+    
+    full_response = prefix
+    base_sampling = dict(sampling or {})
+    sampling = base_sampling
+    tokens_left = max_tokens
+    loop_retries = 0
+    stall_retries = 0
+    stalled_slots = []
+    
+    monitor = StreamMonitor(deadline or REQUEST_DEADLINE, sinks)
+    register_stream(monitor)
+    
+    detector = None
+    loop_detected = False
+    
+    def detect(text):
+        nonlocal loop_detected
+        if detector and not loop_detected and detector.feed(text):
+            loop_detected = True
+            monitor.abort("loop")
+    
+    def persist(text):
+        for sink in sinks:
+            sink.write(text)
+    
+    renderer = StreamRenderer(color) if color else None
+    job = getattr(job_context, 'job', None)
+    channels = []
+    if renderer:
+        channels.append(TokenChannel("render", renderer.write, "coalesce"))
+    if sinks:
+        monitor.persist_channel = TokenChannel("persist", persist, "block")
+        channels.append(monitor.persist_channel)
+    if detect_loops:
+        channels.append(TokenChannel("detect", detect, "block"))
+    if job is not None:
+        channels.append(TokenChannel("progress", StreamProgress(job).write, "drop"))
+    
+    try:
+        while True:
+            with backend_pool.slot(exclude=stalled_slots, priority=priority, cost=tokens_left) as slot:
+                request_start = time.time()
+                # Follow-up calls on this thread can ask for the same slot to reuse its prompt cache
+                job_context.last_slot = slot
+                response = completion_request(slot, prompt + full_response, tokens_left, stream=True, **sampling)
+                
+                if response.status_code != 200:
+                    color_print(f"\nAPI Error: Status code {response.status_code}", Fore.RED)
+                    backend_pool.record(slot, "stream", error=response.status_code in (429, 500, 502, 503, 504))
+                    response.close()
+                    # Keep whatever was generated before the request was retried
+                    return full_response if full_response != prefix else None
+                
+                monitor.start_request(response)
+                driver = get_backend_driver(slot.url)
+                
+                # The channels were drained after the last request, so the detector can be replaced safely
+                loop_detected = False
+                if detect_loops:
+                    detector = RepetitionDetector()
+                    detector.feed(full_response)
+                
+                tokens_received = 0
+                first_token_latency = None
+                
+                try:
+                    with profile_stage("stream"):
+                        for line in response.iter_lines():
+                            if line:
+                                try:
+                                    parsed = driver.parse_stream_line(line.decode('utf-8'))
+                                    if parsed:
+                                        content = parsed[0]
+                                        if not content:
+                                            continue
+                                        tokens_received += 1
+                                        if first_token_latency is None:
+                                            first_token_latency = time.time() - request_start
+                                        full_response += content
+                                        monitor.token_received()
+                                        for channel in channels:
+                                            channel.put(content)
+                                except json.JSONDecodeError:
+                                    color_print("\nError decoding JSON from API response", Fore.RED)
+                                except Exception as e:
+                                    color_print(f"\nError processing stream: {e}", Fore.RED)
+                except Exception:
+                    # An aborted socket surfaces as a read error; anything else is a real failure
+                    if monitor.reason is None:
+                        raise
+                finally:
+                    response.close()
+                    # Time to first token is the latency signal; a stalled stream counts as an error
+                    backend_pool.record(slot, "stream", latency=first_token_latency, tokens=tokens_received,
+                                        error=monitor.reason == "stall")
+            
+            # Let every consumer catch up before the result is inspected or the request retried
+            for channel in channels:
+                channel.drain()
+            if renderer:
+                renderer.flush()
+            
+            record_telemetry("tokens_streamed", tokens_received)
+            tokens_left -= tokens_received
+            
+            if monitor.reason == "stall":
+                record_telemetry("stalls_detected")
+                color_print(f"\n\nNo tokens from {slot} within the stall timeout. Cancelled request.", Fore.YELLOW)
+                if stall_retries >= max_stall_retries or tokens_left <= 0:
+                    break
+                stall_retries += 1
+                stalled_slots.append(slot)
+                record_telemetry("stall_retries")
+                color_print("Retrying on another slot...\n", Fore.YELLOW)
+                continue
+            
+            if monitor.reason == "deadline":
+                record_telemetry("deadlines_exceeded")
+                color_print("\n\nRequest deadline exceeded. Keeping the text generated so far.", Fore.YELLOW)
+                break
+            
+            if monitor.reason == "shutdown":
+                break
+            
+            if not loop_detected:
+                break
+            
+            trimmed_words = len(full_response[detector.loop_start:].split())
+            full_response = full_response[:detector.loop_start]
+            for sink in sinks:
+                sink.reset(full_response)
+            record_telemetry("loops_detected")
+            record_telemetry("loop_tokens_saved", max(tokens_left, 0))
+            color_print(f"\n\nRepetition loop detected. Cancelled request and trimmed {trimmed_words} repeated words.", Fore.YELLOW)
+            
+            if loop_retries >= max_loop_retries or tokens_left <= 0:
+                break
+            
+            # Resume from the trimmed text with sampling that discourages repetition
+            sampling = {
+                **base_sampling,
+                "temperature": 0.9 + 0.1 * loop_retries,
+                "repeat_penalty": 1.2 + 0.1 * loop_retries,
+                "repeat_last_n": 512,
+                "presence_penalty": 0.3
+            }
+            loop_retries += 1
+            record_telemetry("loop_resumes")
+            color_print("Resuming generation with adjusted sampling...\n", Fore.YELLOW)
+    finally:
+        for channel in channels:
+            channel.close()
+        if renderer:
+            renderer.flush()
+        unregister_stream(monitor)
+    
+    if monitor.reason == "stall" and full_response == prefix:
+        return None
+    return full_response
+
+class HedgePolicy:
+    """Learn when a short request is running late and ration the copies sent for late requests
+    
+    Each stage keeps its recent times to first token, and a request is late once it has waited longer
+    than HEDGE_PERCENTILE of them. Every hedgeable request earns HEDGE_BUDGET of a copy, so copies stay
+    within that fraction of the requests however slow the backends get.
+    """
+    
+    def __init__(self, percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET, window=200, min_samples=HEDGE_MIN_SAMPLES, max_credit=3.0):
+        self.percentile = percentile
+        self.budget = budget
+        self.window = window
+        self.min_samples = min_samples
+        self.max_credit = max_credit
+        self._samples = {}  # stage -> recent seconds to first token
+        self._credit = 0.0
+        self._lock = threading.Lock()
+    
+    def threshold(self, stage):
+        """Seconds without a first token after which a request of this stage is late, or None if still learning"""
+        with self._lock:
+            samples = sorted(self._samples.get(stage, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = math.ceil(self.percentile / 100 * len(samples)) - 1
+        return samples[max(0, min(index, len(samples) - 1))]
+    
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+    
+    def earn(self):
+        with self._lock:
+            self._credit = min(self.max_credit, self._credit + self.budget)
+    
+    def spend(self):
+        """Take the credit for one copy, if there is enough"""
+        with self._lock:
+            if self._credit < 1:
+                return False
+            self._credit -= 1
+            return True
+
+hedge_policy = HedgePolicy()
+
+class HedgedAttempt:
+    """One copy of a hedged request, streamed so its first token can be timed and a losing copy cancelled"""
+    
+    def __init__(self, slot, events):
+        self.slot = slot
+        self.events = events  # Queue receiving ("first_token" | "done", attempt)
+        self.monitor = StreamMonitor(REQUEST_DEADLINE)
+        self.started = time.time()
+        self.first_token_latency = None
+        self.text = ""
+        self.response = None  # The server's reply if it refused the request
+        self.error = None
+        self.cancelled = False
+    
+    def start(self, prompt, max_tokens, params):
+        threading.Thread(target=self.run, args=(prompt, max_tokens, params), daemon=True).start()
+    
+    def cancel(self):
+        self.cancelled = True
+        self.monitor.abort("hedged")
+    
+    def run(self, prompt, max_tokens, params):
+        register_stream(self.monitor)
+        tokens = 0
+        try:
+            response = completion_request(self.slot, prompt, max_tokens, stream=True, cache=False, **params)
+            if response.status_code != 200:
+                backend_pool.record(self.slot, "stream", error=response.status_code in (429, 500, 502, 503, 504))
+                self.response = response
+                response.close()
+                return
+            self.monitor.start_request(response)
+            # A cancel that came while the request was being sent had no socket to shut down yet
+            if self.cancelled:
+                self.monitor.abort("hedged")
+            driver = get_backend_driver(self.slot.url)
+            try:
+                for line in response.iter_lines():
+                    try:
+                        parsed = driver.parse_stream_line(line.decode('utf-8')) if line else None
+                    except json.JSONDecodeError:
+                        continue
+                    if not parsed or not parsed[0]:
+                        continue
+                    if self.first_token_latency is None:
+                        self.first_token_latency = time.time() - self.started
+                        self.events.put(("first_token", self))
+                    tokens += 1
+                    self.text += parsed[0]
+                    self.monitor.token_received()
+            except Exception:
+                if self.monitor.reason is None:
+                    raise
+            finally:
+                response.close()
+                if self.monitor.reason != "hedged":
+                    backend_pool.record(self.slot, "stream", latency=self.first_token_latency, tokens=tokens,
+                                        error=self.monitor.reason == "stall")
+        except Exception as e:
+            self.error = e
+        finally:
+            unregister_stream(self.monitor)
+            backend_pool.release(self.slot)
+            self.events.put(("done", self))
+
+def hedged_request(prompt, max_tokens, stage, priority=PRIORITY_CONTROL, prefer=None, **params):
+    """Make a short, idempotent non-streamed request, copying it to another backend if it starts late
+    
+    Returns a response like completion_request. Without NOVELGEN_HEDGE, or with one backend, this is a
+    plain request. Otherwise the request is streamed, and if no token has arrived by the stage's learned
+    threshold, a copy goes to a free slot on another backend. The first copy to produce a token wins
+    and the other is cancelled.
+    """
+    avoid = unsupported_slots(params)
+    if not HEDGE_REQUESTS or len(BACKEND_URLS) < 2:
+        with backend_pool.slot(exclude=avoid, priority=priority, cost=max_tokens, prefer=prefer) as slot:
+            return completion_request(slot, prompt, max_tokens, **params)
+    
+    cache_key = None
+    if RESPONSE_CACHE_SIZE > 0:
+        cache_key = response_cache_key({"prompt": prompt, "max_tokens": max_tokens, "stream": False, "world_bible": world_bible_key, **params})
+        cached = response_cache_get(cache_key)
+        if cached is not None:
+            return CachedResponse(cached)
+    
+    hedge_policy.earn()
+    threshold = hedge_policy.threshold(stage)
+    events = queue.Queue()
+    with profile_stage("slot_wait"):
+        slot = backend_pool.acquire(exclude=avoid, priority=priority, cost=max_tokens, prefer=prefer)
+    primary = HedgedAttempt(slot, events)
+    primary.start(prompt, max_tokens, params)
+    attempts = [primary]
+    hedge_at = primary.started + threshold if threshold is not None else None
+    winner = None
+    pending = 1
+    
+    try:
+        while True:
+            timeout = max(0.0, hedge_at - time.time()) if hedge_at is not None and winner is None else None
+            try:
+                kind, attempt = events.get(timeout=timeout)
+            except queue.Empty:
+                # Late: copy the request to another backend if one is idle and the budget allows
+                hedge_at = None
+                hedge_slot = backend_pool.try_acquire({slot.url} | {other.url for other in avoid}, priority)
+                if hedge_slot is None:
+                    continue
+                if not hedge_policy.spend():
+                    backend_pool.release(hedge_slot)
+                    continue
+                record_telemetry("hedged_requests")
+                color_print(f"No response from {slot} after {threshold:.1f}s; also asking {hedge_slot}", Fore.BLUE)
+                hedge = HedgedAttempt(hedge_slot, events)
+                hedge.start(prompt, max_tokens, params)
+                attempts.append(hedge)
+                pending += 1
+                continue
+            
+            if kind == "first_token":
+                if winner is None:
+                    winner = attempt
+                    hedge_policy.observe(stage, attempt.first_token_latency)
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel()
+                    if attempt is not primary:
+                        record_telemetry("hedge_wins")
+                        # Keep the primary's wait as a sample too, or the threshold would only see the fast copies
+                        hedge_policy.observe(stage, time.time() - primary.started)
+                continue
+            
+            pending -= 1
+            if attempt is winner or (winner is None and pending == 0):
+                break
+    except BaseException:
+        for attempt in attempts:
+            attempt.cancel()
+        raise
+    
+    if attempt.error is not None:
+        raise attempt.error
+    if attempt.response is not None:
+        return attempt.response
+    if attempt.monitor.reason in ("stall", "deadline"):
+        raise requests.Timeout(f"{stage} request to {attempt.slot} hit its {attempt.monitor.reason} limit")
+    data = {"content": attempt.text}
+    if cache_key:
+        response_cache_put(cache_key, data)
+    return CachedResponse(data)
+
+# Generation state of every novel in progress, keyed by progress name, so a signal can checkpoint them all
+active_checkpoints = {}
+active_checkpoints_lock = threading.Lock()
+
+def title_slug(title):
+    """Turn a novel title into the file name stem used for output and progress files"""
+    return title.replace(' ', '_').lower()
+
+def progress_name(title):
+    """File name stem of a novel's progress files; job server jobs use their id, since concurrent jobs can share a title"""
+    job = getattr(job_context, 'job', None)
+    if job is not None:
+        return f"job_{job.id}"
+    return title_slug(title)
+
+def checkpoint_path(title, name=None):
+    return os.path.join("novelgen_progress", f"{name or progress_name(title)}_checkpoint.json")
+
+def partial_chapter_path(title, chapter_number):
+    return os.path.join("novelgen_progress", f"{progress_name(title)}_chapter_{chapter_number}_partial.txt")
+
+def save_checkpoint(state):
+    """Atomically write a generation state so an interrupted run can be resumed"""
+    try:
+        # A signal saves from the main thread, which has no job, so the state carries its own name
+        path = checkpoint_path(state['title'], state.get('progress_name'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception as e:
+        color_print(f"Warning: Could not save checkpoint: {e}", Fore.YELLOW)
+
+def load_checkpoint(title):
+    """Load a saved generation state for the given title, if there is one"""
+    path = checkpoint_path(title)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        color_print(f"Warning: Could not read checkpoint {path}: {e}", Fore.YELLOW)
+        return None
+
+def save_all_checkpoints():
+    with active_checkpoints_lock:
+        states = list(active_checkpoints.values())
+    for state in states:
+        save_checkpoint(state)
+
+def clear_checkpoint(title):
+    try:
+        os.remove(checkpoint_path(title))
+    except OSError:
+        pass
+
+def chapter_store_path(title):
+    return os.path.join("novelgen_progress", f"{progress_name(title)}_chapters")
+
+def artifact_key(*parts):
+    """Hash the inputs an artifact was computed from"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class ChapterStore:
+    """Finished chapters kept as one file each, with only a small index held in memory
+    
+    Chapters are read back through a memory map one at a time, so exporting or indexing a very
+    long novel never needs the whole text in memory. Adding a chapter number again replaces it.
+    
+    The store also keeps the plan the novel was written from and, per chapter, the artifacts derived
+    from it (summary, state updates, continuity check), each with a hash of its inputs so that
+    regenerate can tell which ones are still valid.
+    """
+    
+    def __init__(self, directory, reset=False):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.meta_path = os.path.join(directory, "novel.json")
+        self.chapters = {}  # chapter number -> (title, words)
+        self.meta = None
+        os.makedirs(directory, exist_ok=True)
+        if reset:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+        else:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.chapters = {int(number): tuple(entry) for number, entry in json.load(f).items()}
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, 'r', encoding='utf-8') as f:
+                    self.meta = json.load(f)
+    
+    def __len__(self):
+        return len(self.chapters)
+    
+    def chapter_path(self, chapter_number):
+        return os.path.join(self.directory, f"chapter_{chapter_number:04d}.txt")
+    
+    def write_atomic(self, path, text):
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    
+    def add(self, chapter_number, title, content):
+        self.write_atomic(self.chapter_path(chapter_number), content)
+        self.chapters[chapter_number] = (title, len(content.split()))
+        self.write_atomic(self.index_path, json.dumps(self.chapters))
+    
+    def read(self, chapter_number):
+        with open(self.chapter_path(chapter_number), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:].decode('utf-8')
+    
+    def save_meta(self, meta):
+        """Record the title, plan and settings the chapters are generated from"""
+        self.meta = meta
+        self.write_atomic(self.meta_path, json.dumps(meta))
+    
+    def artifacts_path(self, chapter_number):
+        return os.path.join(self.directory, f"chapter_{chapter_number:04d}.json")
+    
+    def read_artifacts(self, chapter_number):
+        try:
+            with open(self.artifacts_path(chapter_number), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+    
+    def artifact(self, chapter_number, kind, key):
+        """Return a stored artifact if it was computed from inputs with this key, else None"""
+        entry = self.read_artifacts(chapter_number).get(kind)
+        if entry is None or entry['key'] != key:
+            return None
+        return entry['value']
+    
+    def set_artifact(self, chapter_number, kind, key, value):
+        artifacts = self.read_artifacts(chapter_number)
+        artifacts[kind] = {'key': key, 'value': value}
+        self.write_atomic(self.artifacts_path(chapter_number), json.dumps(artifacts))
+    
+    def titles(self):
+        """(chapter number, title) pairs in story order"""
+        return [(number, self.chapters[number][0]) for number in sorted(self.chapters)]
+    
+    def word_count(self):
+        return sum(words for _, words in self.chapters.values())
+    
+    def iter_chapters(self):
+        """Yield (chapter number, title, text) in story order, reading one chapter at a time"""
+        for chapter_number, title in self.titles():
+            yield chapter_number, title, self.read(chapter_number)
+    
+    def write_novel(self, f):
+        """Stream the chapters to an open text file in the same layout as the assembled novel"""
+        for i, (chapter_number, title, text) in enumerate(self.iter_chapters()):
+            f.write(format_chapter(text, chapter_number, title, first=(i == 0)))
+
+def handle_shutdown_signal(signum, frame):
+    """Flush the partial chapter and checkpoint, then unwind on SIGINT/SIGTERM"""
+    if shutdown_requested.is_set():
+        # A second signal exits without flushing again
+        raise KeyboardInterrupt
+    shutdown_requested.set()
+    
+    color_print(f"\nReceived {signal.Signals(signum).name}, saving progress before exiting...", Fore.YELLOW)
+    flush_partial_streams()
+    save_all_checkpoints()
+    
+    with active_streams_lock:
+        monitors = list(active_streams)
+    for monitor in monitors:
+        monitor.abort("shutdown")
+    
+    raise KeyboardInterrupt
+
+def install_signal_handlers():
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+
+# Sections generated in parallel once the core plan exists: (heading, instructions, max tokens)
+PLAN_SECTIONS = [
+    ("CHARACTERS", """- Main character(s): Detailed background, psychology, key traits, wants, needs, internal conflicts, and development arc
+- Supporting characters: Thorough descriptions, motivations, and their relationship to the protagonist
+- Antagonists: Complex motivations, backstory, and detailed conflicts with the protagonist""", 1500),
+    ("KEY SCENES", "15-20 essential scenes that drive the narrative forward, with detailed descriptions", 1500),
+    ("SETTINGS", "Expansive descriptions of all locations, including sensory details and significance to the story", 1000),
+    ("THEME & MESSAGE", "In-depth exploration of core ideas and how they manifest throughout the story", 800),
+]
+
+def plan_context(title, theme=None, genre=None):
+    lines = [f'The novel is titled "{title}".']
+    if theme:
+        lines.append(f'Theme: {theme}')
+    if genre:
+        lines.append(f'Genre: {genre}')
+    return "\n".join(lines)
+
+def generate_plan_core(title, theme=None, genre=None, chapter_count=None):
+    """Generate the short core of a story plan: premise, main cast, structure and a one-line arc per chapter"""
+    
+    chapter_count = chapter_count or PLAN_CHAPTERS
+    prompt = f"""Create the core of a story plan for a novel.
+{plan_context(title, theme, genre)}
+
+Write these sections, concisely:
+
+PREMISE: A summary of the core story concept in one paragraph.
+
+MAIN CAST: One line per important character with their role, goal and central conflict.
+
+NARRATIVE STRUCTURE: A short paragraph each for the beginning, middle, climax and resolution.
+
+CHAPTER ARC: A numbered list with exactly {chapter_count} entries, one line each, saying what each chapter contributes to the story. Number the entries "1.", "2.", and so on, and do not write the word "Chapter".
+
+PREMISE:"""
+    
+    text = stream_completion(prompt, 400 + 40 * chapter_count, prefix="PREMISE:")
+    if not text or "CHAPTER ARC" not in text.upper():
+        return None
+    return text.strip()
+
+def generate_plan_section(title, theme, genre, core, heading, instructions, max_tokens):
+    """Generate one descriptive section of the story plan from the core plan"""
+    
+    prompt = f"""This is the core plan for a novel.
+{plan_context(title, theme, genre)}
+
+{core}
+
+Write the {heading} section of the full story plan, consistent with the core plan:
+{instructions}
+
+{heading}:
+"""
+    text = stream_completion(prompt, max_tokens, color=None)
+    return text.strip() if text else None
+
+# Added to each breakdown chunk when the chapters of an earlier plan could not be extracted; the one-pass
+# plan's retry instructions ask for the whole breakdown, which contradicts the core and chunk prompts
+BREAKDOWN_RETRY_INSTRUCTIONS = """
+IMPORTANT: The previous attempt did not provide properly formatted chapter data.
+Start each chapter on a line of its own in exactly the form "Chapter N: Title", followed by its description.
+"""
+
+def count_breakdown_chapters(text):
+    return len(re.findall(r'^\s*Chapter\s+\d+\s*:', text, re.MULTILINE | re.IGNORECASE))
+
+def generate_breakdown_chunk(title, theme, genre, core, first, last, chapter_count, additional_instructions=None):
+    """Generate the detailed breakdown for chapters first to last, retrying once if it comes back short"""
+    
+    prompt = f"""This is the core plan for a novel.
+{plan_context(title, theme, genre)}
+
+{core}
+
+Write the detailed breakdown for chapters {first} to {last} of the {chapter_count} chapters, following the CHAPTER ARC above.
+Use EXACTLY this format for EACH chapter:
+
+Chapter {first}: [Title]
+[Detailed 150-200 word description of the chapter events, character development, and plot advancement]
+
+Write only chapters {first} to {last}.
+{additional_instructions or ""}
+"""
+    prefix = f"Chapter {first}:"
+    expected = last - first + 1
+    for attempt in range(2):
+        text = stream_completion(prompt, 350 * expected, color=None, prefix=prefix)
+        if text and count_breakdown_chapters(text) >= expected:
+            # Drop anything written past the last requested chapter
+            overflow = re.search(rf'^\s*Chapter\s+{last + 1}\s*:', text, re.MULTILINE | re.IGNORECASE)
+            return (text[:overflow.start()] if overflow else text).strip()
+        record_telemetry("plan_chunk_retries")
+    return None
+
+def create_sectioned_story_plan(title, theme=None, genre=None, retry=False, chapter_count=None):
+    """Create a story plan as a small DAG: the core first, then all other sections in parallel
+    
+    The assembled text has the same sections as a single-pass plan, so extract_chapters works on it unchanged.
+    On a retry the breakdown chunks are reminded of the chapter format.
+    """
+    
+    chapter_count = chapter_count or PLAN_CHAPTERS
+    start_time = time.time()
+    color_print("Generating the core plan (premise, cast and chapter arc)...\n", Fore.YELLOW)
+    try:
+        core = generate_plan_core(title, theme, genre, chapter_count)
+    except Exception as e:
+        color_print(f"\nError generating the core plan: {e}", Fore.RED)
+        core = None
+    if not core:
+        color_print("\nCould not generate the core plan.", Fore.YELLOW)
+        return None
+    
+    chunks = [(first, min(first + PLAN_CHUNK_SIZE - 1, chapter_count))
+              for first in range(1, chapter_count + 1, PLAN_CHUNK_SIZE)]
+    color_print(f"\n\nGenerating {len(PLAN_SECTIONS)} plan sections and {len(chunks)} chapter breakdown chunks in parallel...", Fore.YELLOW)
+    
+    section_futures = [
+        submit_background(generate_plan_section, title, theme, genre, core, heading, instructions, max_tokens)
+        for heading, instructions, max_tokens in PLAN_SECTIONS
+    ]
+    chunk_futures = [
+        submit_background(generate_breakdown_chunk, title, theme, genre, core, first, last, chapter_count,
+                          BREAKDOWN_RETRY_INSTRUCTIONS if retry else None)
+        for first, last in chunks
+    ]
+    
+    def result_or_none(future, part):
+        # A failed part counts as missing, so a failed chunk leads to the one-pass fallback
+        try:
+            return future.result()
+        except Exception as e:
+            color_print(f"Error generating the {part}: {e}", Fore.RED)
+            return None
+    
+    sections = [result_or_none(future, f"{heading} section") for future, (heading, _, _) in zip(section_futures, PLAN_SECTIONS)]
+    breakdown = [result_or_none(future, f"breakdown of chapters {first} to {last}") for future, (first, last) in zip(chunk_futures, chunks)]
+    
+    if not all(breakdown):
+        color_print("A chapter breakdown chunk could not be generated.", Fore.YELLOW)
+        return None
+    
+    parts = [f"1. CORE PLAN:\n\n{core}"]
+    for number, ((heading, _, _), text) in enumerate(zip(PLAN_SECTIONS, sections), 2):
+        if text:
+            parts.append(f"{number}. {heading}:\n\n{text}")
+        else:
+            color_print(f"The {heading} section could not be generated and was left out.", Fore.YELLOW)
+    parts.append(f"{len(PLAN_SECTIONS) + 2}. DETAILED CHAPTER BREAKDOWN:\n\n" + "\n\n".join(breakdown))
+    
+    record_telemetry("plan_sections", len(PLAN_SECTIONS) + len(chunks))
+    color_print(f"Sectioned plan assembled in {time.time() - start_time:.2f} seconds.", Fore.GREEN)
+    return "\n\n".join(parts)
+
+@profiled("plan")
+def create_story_plan(title, theme=None, genre=None, max_tokens=4000, additional_instructions=None):
+    """Create a structured outline for the story with JSON chapter details"""
+    
+    color_print(f"\nCreating detailed story plan for: {title}\n", Fore.CYAN)
+    
+    # First, build the prompt parts
+    prompt_parts = [
+        f"""Create an extremely detailed story plan for a novel titled "{title}"."""
+    ]
+    
+    if theme:
+        prompt_parts.append(f'Theme: {theme}')
+    if genre:
+        prompt_parts.append(f'Genre: {genre}')
+    
+    prompt_parts.append("""
+The plan should include:
+
+1. PREMISE: A comprehensive summary of the core story concept.
+
+2. CHARACTERS:
+   - Main character(s): Detailed background, psychology, key traits, wants, needs, internal conflicts, and development arc
+   - Supporting characters: Thorough descriptions, motivations, and their relationship to the protagonist
+   - Antagonists: Complex motivations, backstory, and detailed conflicts with the protagonist
+
+3. NARRATIVE STRUCTURE:
+   - Beginning: Detailed opening scenes, character introductions, and world-building elements
+   - Middle: Elaborate central conflicts, complications, and escalating tensions
+   - Multiple plot points and subplots with interconnections
+   - Climax: Detailed description of the turning point and its impact on all characters
+   - Resolution: Comprehensive conclusion showing how character arcs and themes are resolved
+
+4. KEY SCENES: 15-20 essential scenes that drive the narrative forward, with detailed descriptions
+
+5. SETTINGS: Expansive descriptions of all locations, including sensory details and significance to the story
+
+6. THEME & MESSAGE: In-depth exploration of core ideas and how they manifest throughout the story
+
+7. DETAILED CHAPTER BREAKDOWN: 
+   Provide a detailed chapter-by-chapter breakdown with EXACTLY this format for EACH chapter:
+
+   Chapter 1: [Title]
+   [Detailed 150-200 word description of the chapter events, character development, and plot advancement]
+
+   Chapter 2: [Title]
+   [Detailed 150-200 word description of the chapter events, character development, and plot advancement]
+
+   ...and so on. Provide at least 20 chapters, each with detailed descriptions.
+""")
+    
+    # Add any additional instructions
+    if additional_instructions:
+        prompt_parts.append(additional_instructions)
+    
+    # Join all prompt parts together
+    prompt = "\n\n".join(prompt_parts)
+    
+    try:
+        start_time = time.time()
+        color_print("Generating comprehensive story plan...", Fore.YELLOW)
+        
+        keep_alive_running = setup_keep_alive()
+        if keep_alive_running:
+            color_print("Keep-alive feature enabled to prevent system sleep", Fore.CYAN)
+        
+        full_response = None
+        if SECTIONED_PLAN:
+            full_response = create_sectioned_story_plan(title, theme, genre, retry=additional_instructions is not None)
+            if full_response is None:
+                color_print("Falling back to generating the plan in one pass.", Fore.YELLOW)
+        
+        if full_response is None:
+            color_print("\nGenerating plan... \n", Fore.YELLOW)
+            full_response = stream_completion(prompt, max_tokens)
+        
+        if full_response is None:
+            cancel_keep_alive()
+            return None
+        
+        cancel_keep_alive()
+        end_time = time.time()
+        duration = end_time - start_time
+        color_print(f"\n\nPlan generation complete in {duration:.2f} seconds!", Fore.GREEN)
+        
+        return full_response.strip()
+        
+    except requests.RequestException as e:
+        color_print(f"\nAPI Connection Error: {e}", Fore.RED)
+        cancel_keep_alive()
+        return None
+    except Exception as e:
+        color_print(f"\nUnexpected Error: {e}", Fore.RED)
+        cancel_keep_alive()
+        return None
+
+@profiled("extract")
+def extract_chapters(story_plan):
+    """Extract chapter data from the story plan using regex"""
+    
+    # Look for chapter patterns in the format "Chapter X: Title - Description"
+    chapter_pattern = re.compile(r'Chapter\s+(\d+):\s+([^-\n]+)\s*-\s*((?:(?!Chapter\s+\d+:)[\s\S])*?)(?=Chapter\s+\d+:|$)', re.IGNORECASE)
+    chapters = chapter_pattern.findall(story_plan)
+    
+    if not chapters:
+        # Try standard format "Chapter X: Title" with separate description
+        std_chapter_pattern = re.compile(r'Chapter\s+(\d+):\s+([^\n]+)\s*\n((?:(?!Chapter\s+\d+:)[\s\S])*?)(?=Chapter\s+\d+:|$)', re.IGNORECASE)
+        chapters = std_chapter_pattern.findall(story_plan)
+    
+    if not chapters:
+        # Try an alternative pattern for other formats
+        alt_chapter_pattern = re.compile(r'(?:^|\n)\s*Chapter\s+(\d+)[.:\s-]+([^\n]+)(?:\n(.*?))?(?=\n\s*Chapter\s+\d+[.:\s-]|\Z)', re.DOTALL | re.IGNORECASE)
+        chapters = alt_chapter_pattern.findall(story_plan)
+    
+    # Format the extracted chapters
+    formatted_chapters = []
+    for match in chapters:
+        try:
+            chapter_num = int(match[0])
+            chapter_title = match[1].strip()
+            chapter_desc = match[2].strip() if len(match) > 2 and match[2] else "No description available."
+            
+            # For the format "Title - Description", merge them if description is too short
+            if chapter_desc == "No description available." or len(chapter_desc.split()) < 10:
+                # Look for a dash in the title to split into title and description
+                if " - " in chapter_title:
+                    parts = chapter_title.split(" - ", 1)
+                    chapter_title = parts[0].strip()
+                    chapter_desc = parts[1].strip()
+            
+            formatted_chapters.append({
+                'number': chapter_num,
+                'title': chapter_title,
+                'description': chapter_desc
+            })
+        except (ValueError, IndexError) as e:
+            color_print(f"Error processing chapter: {e}", Fore.YELLOW)
+    
+    # Sort chapters by number and ensure sequential numbering
+    formatted_chapters.sort(key=lambda x: x['number'])
+    
+    for i, chapter in enumerate(formatted_chapters):
+        if chapter['number'] != i + 1:
+            color_print(f"Fixed chapter numbering: Chapter {chapter['number']} → Chapter {i+1}", Fore.YELLOW)
+            chapter['number'] = i + 1
+    
+    if formatted_chapters:
+        color_print(f"Successfully extracted {len(formatted_chapters)} chapter plans.", Fore.GREEN)
+        for ch in formatted_chapters[:3]:  # Show first 3 as examples
+            color_print(f"Chapter {ch['number']}: {ch['title']}", Fore.CYAN)
+            color_print(f"Description: {ch['description'][:100]}...", Fore.CYAN)
+        if len(formatted_chapters) > 3:
+            color_print(f"... plus {len(formatted_chapters) - 3} more chapters", Fore.CYAN)
+    else:
+        color_print("No chapter plans extracted.", Fore.RED)
+    
+    return formatted_chapters
+
+def validate_chapters(chapters):
+    """Validate chapter data and return whether it's complete"""
+    if not chapters:
+        return False
+        
+    # Check for sequential numbering
+    expected_numbers = list(range(1, len(chapters) + 1))
+    actual_numbers = [ch.get('number') for ch in chapters]
+    
+    # Check all required fields exist
+    all_fields_present = all(
+        'number' in ch and 'title' in ch and 'description' in ch
+        for ch in chapters
+    )
+    
+    # Check for sufficient chapters
+    sufficient_chapters = len(chapters) >= 5  # Lower minimum threshold to 5 chapters
+    
+    # Debug chapter info
+    color_print("\nChapter descriptions:", Fore.CYAN)
+    for i, ch in enumerate(chapters[:3]):  # Print first 3 for debugging
+        desc_words = len(ch.get('description', '').split())
+        color_print(f"Chapter {ch['number']}: {ch['title']} - {desc_words} words", Fore.CYAN)
+    
+    # Check description length - set to 15 words minimum (even more lenient for testing)
+    min_word_count = 15  # Very low threshold just to ensure some content
+    good_descriptions = all(
+        len(ch.get('description', '').split()) >= min_word_count
+        for ch in chapters
+    )
+    
+    is_valid = (actual_numbers == expected_numbers and 
+                all_fields_present and 
+                sufficient_chapters and 
+                good_descriptions)
+    
+    if not is_valid:
+        if actual_numbers != expected_numbers:
+            color_print("Chapter numbers are not sequential.", Fore.YELLOW)
+        if not all_fields_present:
+            color_print("Some chapters are missing required fields.", Fore.YELLOW)
+        if not sufficient_chapters:
+            color_print(f"Not enough chapters ({len(chapters)}). Expected at least 5.", Fore.YELLOW)
+        if not good_descriptions:
+            color_print(f"Some chapter descriptions are too short (need at least {min_word_count} words each).", Fore.YELLOW)
+            
+            # Print information about the shortest descriptions
+            short_descriptions = [(i+1, ch['title'], len(ch['description'].split())) 
+                                 for i, ch in enumerate(chapters) 
+                                 if len(ch['description'].split()) < min_word_count]
+            for chapter_num, title, word_count in short_descriptions[:3]:  # Show up to 3 examples
+                color_print(f"  - Chapter {chapter_num}: '{title}' has only {word_count} words", Fore.YELLOW)
+            
+            if len(short_descriptions) > 3:
+                color_print(f"  - ... and {len(short_descriptions)-3} more chapters with short descriptions", Fore.YELLOW)
+    
+    return is_valid
+
+def get_story_plan_with_chapters(title, theme=None, genre=None, max_attempts=3):
+    """Generate a story plan with valid chapter format, with retries if needed"""
+    
+    for attempt in range(max_attempts):
+        color_print(f"\nStory plan generation attempt {attempt+1}/{max_attempts}", Fore.CYAN)
+        
+        additional_instructions = None
+        if attempt > 0:
+            additional_instructions = """
+IMPORTANT: The previous attempt did not provide properly formatted chapter data.
+
+You MUST provide a detailed chapter-by-chapter breakdown in this format:
+
+Chapter 1: [Title]
+[150-200 word detailed description]
+
+Chapter 2: [Title]
+[150-200 word detailed description]
+
+And so on for at least 15-20 chapters.
+"""
+
+        story_plan = create_story_plan(title, theme, genre, additional_instructions=additional_instructions)
+        if not story_plan:
+            color_print("Failed to generate story plan.", Fore.RED)
+            continue
+        
+        chapters = extract_chapters(story_plan)
+        if validate_chapters(chapters):
+            color_print("✓ Valid chapter format confirmed!", Fore.GREEN)
+            return story_plan, chapters
+        
+        color_print(f"Invalid chapter format. Retrying...", Fore.YELLOW)
+    
+    # If we get here, all attempts failed to produce valid chapter data
+    color_print("\nFailed to get properly formatted chapters after multiple attempts.", Fore.RED)
+    
+    # Last resort: try to manually parse the story plan to extract any usable chapters
+    color_print("Attempting to manually extract chapter information...", Fore.YELLOW)
+    
+    # First, find the chapter breakdown section
+    chapter_section_pattern = re.compile(r'(?:7\.\s*)?(?:DETAILED\s*)?CHAPTER\s*BREAKDOWN:?.*?(?=8\.|$)', re.DOTALL | re.IGNORECASE)
+    chapter_section_match = chapter_section_pattern.search(story_plan)
+    
+    if chapter_section_match:
+        chapter_section = chapter_section_match.group(0)
+        # Extract anything that looks like a chapter with a number and title
+        manual_chapter_pattern = re.compile(r'(?:Chapter|Ch\.?)\s*(\d+)[\s:\-\.]*([^.\n]+)(?:\.\s*|\n)(.*?)(?=(?:Chapter|Ch\.?)\s*\d+[\s:\-\.]|$)', re.DOTALL | re.IGNORECASE)
+        manual_chapters = manual_chapter_pattern.findall(chapter_section)
+        
+        if manual_chapters:
+            formatted_chapters = []
+            for i, (num, title, desc) in enumerate(manual_chapters):
+                formatted_chapters.append({
+                    'number': i + 1,  # Ensure sequential numbering
+                    'title': title.strip(),
+                    'description': desc.strip() if desc.strip() else f"Events for Chapter {i+1}"
+                })
+            
+            color_print(f"Manually extracted {len(formatted_chapters)} chapters.", Fore.GREEN)
+            return story_plan, formatted_chapters
+    
+    # If all else fails, create some basic chapter data from the story plan
+    color_print("Creating basic chapter structure from story plan.", Fore.YELLOW)
+    basic_chapters = []
+    # Split story plan into sections to use as chapter content
+    sections = re.split(r'\n\s*\d+\.\s+', story_plan)
+    for i, section in enumerate(sections[1:6]):  # Use up to 5 sections as chapters
+        basic_chapters.append({
+            'number': i + 1,
+            'title': f"Chapter {i+1}",
+            'description': f"Content based on story plan section {i+1}: {section[:200]}..."
+        })
+    
+    return story_plan, basic_chapters
+
+def chapter_prompt_prefix(min_words=4000):
+    """The fixed instructions that open every chapter prompt of a novel, so a backend can keep them cached"""
+    return f"""You are writing a novel one chapter at a time.
+
+Guidelines for every chapter:
+1. Create a substantial chapter of AT LEAST {min_words} words
+2. Include vivid descriptions, meaningful dialogue, and varied sentence structure
+3. Focus on character development and advancing the plot
+4. Create proper paragraphs with thoughtful transitions
+5. Maintain a consistent narrative voice
+6. If this is not Chapter 1, ensure DIRECT CONTINUITY with the ending of the previous chapter
+7. Incorporate sensory details to bring scenes to life
+8. End the chapter with a hook that propels the reader forward
+
+Each chapter MUST be substantial, with proper pacing and development.
+DO NOT stop before reaching at least {min_words} words.
+YOU MUST WRITE AT LEAST {min_words} WORDS, and you'll be penalized if you write fewer words.
+
+"""
+
+def build_chapter_prompt(title, chapter_plan, chapter_number, previous_chapters_summary=None, previous_chapter_ending=None, min_words=4000, earlier_passages=None, story_state=None):
+    """Build the generation prompt for a chapter
+    
+    The fixed instructions come first and the chapter's plan and context after them, so consecutive
+    chapter prompts share a prefix that the backend's prompt cache can reuse.
+    """
+    
+    context = ""
+    continuity_instruction = ""
+    
+    if previous_chapters_summary:
+        context = f"""Previous chapters summary:
+{previous_chapters_summary}
+
+"""
+    
+    if story_state:
+        context += f"""Current state of the characters, places and plot threads in this chapter:
+{story_state}
+
+"""
+    
+    if earlier_passages:
+        context += f"""Passages from earlier chapters that are relevant to this chapter (keep any details you reuse consistent with them):
+{earlier_passages}
+
+"""
+    
+    if previous_chapter_ending and chapter_number > 1:
+        # Extract the last 500-1000 characters of the previous chapter for direct continuity
+        continuity_instruction = f"""
+IMPORTANT - CONTINUITY INSTRUCTION:
+The previous chapter ended with this exact scene:
+
+{previous_chapter_ending}
+
+Your chapter MUST continue directly from this point, maintaining perfect narrative continuity.
+Start with the immediate next moment in the story - do not summarize or create a time jump unless the chapter plan specifically calls for it.
+Maintain consistency with character locations, emotional states, and ongoing dialogue or actions.
+"""
+    
+    prompt = f"""{chapter_prompt_prefix(min_words)}Write Chapter {chapter_number} titled "{title}" based on this detailed plan:
+
+{chapter_plan}
+
+{context}{continuity_instruction}
+Format this as a standard novel chapter with "Chapter {chapter_number}: {title}" at the beginning.
+
+Begin:
+"""
+    
+    return prompt
+
+@profiled("generate")
+def generate_chapter(title, chapter_plan, chapter_number, previous_chapters_summary=None, previous_chapter_ending=None, min_words=4000, max_tokens=8000, partial_path=None, resume_text=None, summarizer=None, earlier_passages=None, story_state=None):
+    """Generate a single detailed chapter based on the chapter plan with improved continuity
+    
+    If resume_text is given (saved partial output or a chosen opening), the chapter continues from it.
+    """
+    
+    color_print(f"\nGenerating Chapter {chapter_number}: {title}\n", Fore.CYAN)
+    
+    prompt = build_chapter_prompt(title, chapter_plan, chapter_number, previous_chapters_summary, previous_chapter_ending, min_words, earlier_passages, story_state)
+
+    try:
+        start_time = time.time()
+        color_print("Sending chapter request to API...", Fore.YELLOW)
+        
+        keep_alive_running = setup_keep_alive()
+        
+        sinks = []
+        if partial_path and PARTIAL_OUTPUT:
+            sinks.append(PartialOutputSink(partial_path, resume_text or ""))
+        if summarizer:
+            if resume_text:
+                # A paragraph at a time, so the saved text is cut into blocks as if it had streamed
+                for paragraph in re.split(r'(?<=\n\n)', resume_text):
+                    summarizer.write(paragraph)
+            sinks.append(summarizer)
+        
+        full_response = None
+        try:
+            if resume_text:
+                resume_words = len(resume_text.split())
+                color_print(f"\nContinuing chapter from {resume_words} words already written... \n", Fore.YELLOW)
+                # Only spend the part of the token budget the saved text did not use
+                max_tokens = max(max_tokens - estimate_tokens(resume_text), 500)
+            elif CHAPTER_SCENES > 1:
+                full_response = generate_chapter_scenes(title, chapter_plan, chapter_number, previous_chapters_summary,
+                                                        previous_chapter_ending, min_words, max_tokens, earlier_passages, story_state)
+                if full_response is not None:
+                    # Scenes stream in parallel, so the sinks receive the joined chapter at the end, a
+                    # paragraph at a time so the summarizer still cuts it into blocks
+                    for paragraph in re.split(r'(?<=\n\n)', full_response):
+                        for sink in sinks:
+                            sink.write(paragraph)
+                else:
+                    color_print("Falling back to writing the chapter in one pass.", Fore.YELLOW)
+            
+            if full_response is None:
+                if not resume_text:
+                    color_print("\nGenerating chapter... \n", Fore.YELLOW)
+                full_response = stream_completion(prompt, max_tokens, sinks=sinks, prefix=resume_text or "")
+        finally:
+            for sink in sinks:
+                sink.close()
+        
+        if full_response is None:
+            cancel_keep_alive()
+            return None
+        
+        cancel_keep_alive()
+        end_time = time.time()
+        duration = end_time - start_time
+        word_count = len(full_response.split())
+        color_print(f"\n\nChapter generation complete in {duration:.2f} seconds!", Fore.GREEN)
+        color_print(f"Word count: {word_count} words", Fore.GREEN)
+        
+        # Check if we've reached the minimum word count
+        if word_count < min_words:
+            color_print(f"\n⚠️ WARNING: Generated only {word_count} words, which is less than the minimum {min_words} words.", Fore.YELLOW)
+            
+            # Try to extend the chapter if it's too short
+            if word_count < min_words * 0.8:  # If less than 80% of target
+                color_print("Attempting to extend the chapter to reach minimum word count...", Fore.YELLOW)
+                
+                extension_prompt = f"""Continue the following chapter to reach at least {min_words} words total. The current chapter is {word_count} words, so you need to add approximately {min_words - word_count} more words.
+
+Current chapter content (ending):
+{full_response[-2000:]}
+
+Continue the chapter naturally, maintaining the same style, tone, and narrative flow. Do not create a new chapter - just continue this one with additional content that extends the scene, adds detail, or explores character thoughts and feelings more deeply.
+
+Continue from here:
+"""
+                
+                try:
+                    keep_alive_running = setup_keep_alive()
+                    
+                    color_print("\nExtending chapter... \n", Fore.YELLOW)
+                    extension_content = stream_completion(
+                        extension_prompt,
+                        max(2000, (min_words - word_count) * 2)  # Approximate tokens needed
+                    )
+                    
+                    if extension_content is not None:
+                        # Combine original content with extension
+                        full_response = full_response + "\n\n" + extension_content
+                        new_word_count = len(full_response.split())
+                        color_print(f"\nExtended chapter word count: {new_word_count} words", Fore.GREEN)
+                        
+                except Exception as e:
+                    color_print(f"Error during chapter extension: {e}", Fore.RED)
+                finally:
+                    cancel_keep_alive()
+        
+        return full_response.strip()
+        
+    except requests.RequestException as e:
+        color_print(f"\nAPI Connection Error: {e}", Fore.RED)
+        cancel_keep_alive()
+        return None
+    except Exception as e:
+        color_print(f"\nUnexpected Error: {e}", Fore.RED)
+        cancel_keep_alive()
+        return None
+@profiled("fix")
+def fix_chapter_beginning(chapter_content, previous_ending, issues, chapter_number, chapter_title):
+    """Fix the beginning of a chapter to ensure continuity with the previous chapter"""
+    
+    # Extract the first 1000-1500 characters of the chapter as the part to replace
+    body_start = chapter_body_start(chapter_content)
+    chapter_beginning = chapter_opening(chapter_content)
+    chapter_beginning = chapter_beginning.split("\n\n")[0] if "\n\n" in chapter_beginning else chapter_beginning
+    
+    # Extract the rest of the chapter content (after the header and the replaced part)
+    rest_of_chapter = chapter_content[body_start + len(chapter_beginning):]
+    
+    issues_text = "\n".join([f"- {issue}" for issue in issues]) if issues else "Unknown continuity issues"
+    
+    prompt = f"""REWRITE THE BEGINNING OF THIS CHAPTER to fix continuity issues.
+
+PREVIOUS CHAPTER ENDING:
+{previous_ending}
+
+CURRENT CHAPTER BEGINNING (to be replaced):
+{chapter_beginning}
+
+CONTINUITY ISSUES TO FIX:
+{issues_text}
+
+Write a NEW beginning that directly continues from the previous chapter's ending, fixing all continuity issues.
+Maintain the same characters, setting, and situation, but make sure it flows naturally from the previous ending.
+The new beginning should be approximately the same length as the original.
+
+NEW CHAPTER BEGINNING:
+"""
+
+    try:
+        color_print("Fixing chapter beginning for better continuity...", Fore.YELLOW)
+        
+        with backend_pool.slot(priority=PRIORITY_CONTROL, cost=2000) as slot:
+            response = completion_request(slot, prompt, 2000)
+        
+        if response.status_code != 200:
+            color_print(f"\nAPI Error during continuity fix: {response.status_code}", Fore.RED)
+            return chapter_content  # Return original content if fix fails
+            
+        result = response.json()
+        new_beginning = result.get('content', '')
+        
+        if new_beginning:
+            # Replace the beginning of the chapter with the fixed version
+            fixed_chapter = f"Chapter {chapter_number}: {chapter_title}\n\n{new_beginning.strip()}{rest_of_chapter}"
+            color_print("Successfully fixed chapter beginning for continuity.", Fore.GREEN)
+            return fixed_chapter
+        
+        return chapter_content  # Return original if no fix generated
+        
+    except Exception as e:
+        color_print(f"Error fixing chapter beginning: {e}", Fore.RED)
+        return chapter_content  
+
+@profiled("verify")
+def verify_chapter_continuity(previous_ending, new_beginning, chapter_number, story_state=None):
+    """Verify that the new chapter continues properly from the previous one"""
+    
+    # Skip for first chapter
+    if chapter_number <= 1:
+        return True, None
+    
+    state_context = f"\nKNOWN STATE OF THE STORY:\n{story_state}\n" if story_state else ""
+    
+    prompt = f"""CONTINUITY CHECK:
+Compare the ending of the previous chapter with the beginning of the new chapter and identify any continuity issues:
+{state_context}
+PREVIOUS CHAPTER ENDING:
+{previous_ending}
+
+NEW CHAPTER BEGINNING:
+{new_beginning}
+
+Return a single JSON object with these properties:
+1. "continuity_score": A number from 1-10, with 10 meaning perfect continuity
+2. "issues": An array of specific continuity issues found
+3. "fix_needed": Boolean indicating if the new chapter beginning needs to be rewritten
+
+Be strict in your evaluation. Consider character locations, ongoing conversations, emotional states, and logical story flow.
+"""
+
+    try:
+        color_print("Verifying chapter continuity...", Fore.YELLOW)
+        
+        response = hedged_request(prompt, 1000, "verify")
+        
+        if response.status_code != 200:
+            color_print(f"\nAPI Error during continuity verification: {response.status_code}", Fore.RED)
+            return True, None  # Return true to continue anyway
+            
+        result = response.json()
+        analysis = result.get('content', '')
+        
+        # Try to extract JSON from the response
+        try:
+            import json
+            # Find JSON-like content in the response
+            json_match = re.search(r'(\{.*\})', analysis, re.DOTALL)
+            if json_match:
+                continuity_data = json.loads(json_match.group(1))
+                score = continuity_data.get('continuity_score', 0)
+                issues = continuity_data.get('issues', [])
+                fix_needed = continuity_data.get('fix_needed', False)
+                
+                color_print(f"Continuity score: {score}/10", Fore.GREEN if score >= 7 else Fore.YELLOW)
+                
+                if issues:
+                    color_print("Continuity issues detected:", Fore.YELLOW)
+                    for issue in issues:
+                        color_print(f"- {issue}", Fore.YELLOW)
+                
+                return not fix_needed, issues if fix_needed else None
+            
+        except Exception as e:
+            color_print(f"Error parsing continuity check: {e}", Fore.RED)
+        
+        # Default to continuing if we can't parse the response
+        return True, None
+        
+    except Exception as e:
+        color_print(f"Error during continuity verification: {e}", Fore.RED)
+        return True, None
+
+# Phrases that signal a chapter opening skips ahead or recaps instead of continuing the scene
+TIME_JUMP_PATTERN = re.compile(
+    r'\b(?:the next (?:morning|day|evening|night|week)|the following (?:morning|day|evening|week)|'
+    r'(?:hours|days|weeks|months|years) (?:later|passed|had passed)|later that|some time later|meanwhile)\b',
+    re.IGNORECASE
+)
+RECAP_PATTERN = re.compile(r'\b(?:previously|in the last chapter|as we saw|to recap)\b', re.IGNORECASE)
+STOPWORDS = frozenset("""
+a an and are as at be been but by for from had has have he her hers him his i if in into is it its me my no not
+of on or our she so than that the their them then there these they this to too up us was we were what when where
+which while who will with would you your
+""".split())
+
+def content_words(text):
+    return [word for word in re.findall(r"[a-z']+", text.lower()) if word not in STOPWORDS and len(word) > 2]
+
+def capitalized_names(text):
+    return {word for word in re.findall(r"\b[A-Z][a-z]+\b", text) if word.lower() not in STOPWORDS}
+
+def score_opening_continuity(previous_ending, opening):
+    """Score from 0 to 10 how well an opening continues the previous ending, using local heuristics only"""
+    
+    opening = opening.lstrip()
+    opening_body = opening[chapter_body_start(opening):]
+    ending_tail = " ".join(previous_ending.split()[-150:])
+    
+    opening_words = set(content_words(opening_body))
+    ending_words = set(content_words(ending_tail))
+    if not opening_words:
+        return 0.0
+    
+    # Shared vocabulary and shared character names both point to the same scene continuing
+    word_overlap = len(opening_words & ending_words) / max(1, min(len(ending_words), 40))
+    ending_names = capitalized_names(ending_tail)
+    name_overlap = len(ending_names & capitalized_names(opening_body)) / len(ending_names) if ending_names else 0.5
+    
+    score = 2 + 4 * min(1.0, word_overlap * 2) + 4 * name_overlap
+    if TIME_JUMP_PATTERN.search(opening_body[:400]):
+        score -= 3
+    if RECAP_PATTERN.search(opening_body[:400]):
+        score -= 2
+    if len(opening_words) < 30:
+        score -= 2
+    
+    return max(0.0, min(10.0, score))
+
+def opening_verdict(previous_ending, opening):
+    """Ask the model for a one-number continuity verdict on a chapter opening"""
+    
+    prompt = f"""PREVIOUS CHAPTER ENDING:
+{previous_ending}
+
+NEW CHAPTER OPENING:
+{opening}
+
+On a scale of 1 to 10, how directly and consistently does the new chapter opening continue from the previous chapter ending?
+Answer with a single number.
+
+Score: """
+    
+    try:
+        # The grammar limits the answer to a bare number so the verdict costs only a few tokens
+        response = hedged_request(prompt, 3, "verdict", grammar='root ::= [1-9] | "10"')
+        if response.status_code != 200:
+            return None
+        match = re.search(r'\d+', response.json().get('content', ''))
+        return min(10, int(match.group(0))) if match else None
+    except Exception as e:
+        color_print(f"Error getting opening verdict: {e}", Fore.RED)
+        return None
+
+def trim_to_sentence(text):
+    """Cut text back to the end of its last complete sentence"""
+    last_end = None
+    for match in re.finditer(r'[.!?]["\'”’]?(?=\s)', text):
+        last_end = match.end()
+    return text[:last_end] if last_end else text
+
+@profiled("openings")
+def choose_chapter_opening(title, chapter_plan, chapter_number, previous_chapters_summary, previous_chapter_ending, min_words=4000, candidates=None, earlier_passages=None, story_state=None):
+    """Generate several chapter openings in parallel and return the one that best continues the previous chapter"""
+    
+    candidates = candidates or OPENING_CANDIDATES
+    prompt = build_chapter_prompt(title, chapter_plan, chapter_number, previous_chapters_summary, previous_chapter_ending, min_words, earlier_passages, story_state)
+    
+    def generate_candidate(index):
+        # Spread the temperatures so the candidates actually differ
+        text = stream_completion(prompt, OPENING_TOKENS, color=None, max_stall_retries=0,
+                                 sampling={"temperature": 0.7 + 0.15 * index})
+        return trim_to_sentence(text) if text else None
+    
+    color_print(f"Generating {candidates} candidate openings for Chapter {chapter_number} in parallel...", Fore.YELLOW)
+    start_time = time.time()
+    
+    try:
+        futures = [submit_background(generate_candidate, index) for index in range(candidates)]
+        openings = [future.result() for future in futures]
+    except Exception as e:
+        color_print(f"Error generating candidate openings: {e}", Fore.RED)
+        return None
+    
+    openings = [opening for opening in openings if opening and opening.strip()]
+    record_telemetry("opening_candidates", len(openings))
+    if not openings:
+        color_print("No candidate openings were generated.", Fore.YELLOW)
+        return None
+    
+    scores = [score_opening_continuity(previous_chapter_ending, opening) for opening in openings]
+    if OPENING_VERDICT:
+        verdicts = list(background_executor.map(lambda opening: opening_verdict(previous_chapter_ending, opening), openings))
+        scores = [(score + verdict) / 2 if verdict is not None else score for score, verdict in zip(scores, verdicts)]
+    
+    for index, score in enumerate(scores):
+        color_print(f"Candidate {index + 1}: continuity score {score:.1f}/10", Fore.CYAN)
+    
+    best_index = max(range(len(openings)), key=lambda index: scores[index])
+    color_print(f"Selected candidate {best_index + 1} in {time.time() - start_time:.2f} seconds.\n", Fore.GREEN)
+    color_print(openings[best_index], Fore.CYAN)
+    return openings[best_index]
+
+SCENE_LINE_PATTERN = re.compile(r'^\s*Scene\s+(\d+)\s*[:.\-]\s*(.+?)\s*\|\s*END\s*:\s*(.+?)\s*$', re.IGNORECASE | re.MULTILINE)
+
+def plan_chapter_scenes(title, chapter_plan, chapter_number, previous_chapter_ending=None, scene_count=None):
+    """Break a chapter plan into a short list of scenes, each with the state it should end in"""
+    
+    scene_count = scene_count or CHAPTER_SCENES
+    ending_context = f"\nThe previous chapter ended with:\n{previous_chapter_ending[-1000:]}\n" if previous_chapter_ending else ""
+    
+    prompt = f"""Break Chapter {chapter_number}, "{title}", into exactly {scene_count} consecutive scenes.
+{ending_context}
+Chapter plan:
+{chapter_plan}
+
+For each scene write ONE line in this exact format:
+Scene <number>: <what happens, in one or two sentences> | END: <where the characters are and what state things are in when the scene ends>
+
+Scene 1:"""
+    
+    try:
+        response = hedged_request(prompt, 100 * scene_count, "scenes")
+        
+        if response.status_code != 200:
+            color_print(f"API Error: Status code {response.status_code}", Fore.RED)
+            return None
+        
+        content = "Scene 1:" + response.json().get('content', '')
+        scenes = [
+            {"summary": summary, "end_state": end_state}
+            for _, summary, end_state in SCENE_LINE_PATTERN.findall(content)
+        ][:scene_count]
+    except Exception as e:
+        color_print(f"Error planning scenes: {e}", Fore.RED)
+        return None
+    
+    if len(scenes) < 2:
+        color_print("Could not parse a scene list from the response.", Fore.YELLOW)
+        return None
+    return scenes
+
+def build_scene_prompt(title, chapter_plan, chapter_number, scenes, index, previous_chapters_summary=None, previous_chapter_ending=None, scene_words=1000, earlier_passages=None, story_state=None):
+    """Create the prompt for one scene of a chapter that is written scene by scene"""
+    
+    scene_list = "\n".join(
+        f"Scene {number}: {scene['summary']} (ends: {scene['end_state']})"
+        for number, scene in enumerate(scenes, 1)
+    )
+    
+    context = f"Previous chapters summary:\n{previous_chapters_summary}\n\n" if previous_chapters_summary else ""
+    if story_state:
+        context += f"Current state of the characters, places and plot threads:\n{story_state}\n\n"
+    if earlier_passages:
+        context += f"Relevant passages from earlier chapters:\n{earlier_passages}\n\n"
+    if index == 0:
+        if previous_chapter_ending and chapter_number > 1:
+            start = f"The previous chapter ended with this exact scene:\n\n{previous_chapter_ending}\n\nContinue directly from that moment."
+        else:
+            start = "This scene opens the chapter."
+    else:
+        start = f"The previous scene ends like this: {scenes[index - 1]['end_state']}\nStart from that moment, without recapping it."
+    
+    scene = scenes[index]
+    return f"""{context}You are writing Chapter {chapter_number} of a novel, titled "{title}", one scene at a time.
+
+Chapter plan:
+{chapter_plan}
+
+All scenes in this chapter:
+{scene_list}
+
+{start}
+
+Write ONLY Scene {index + 1}: {scene['summary']}
+The scene must end with: {scene['end_state']}
+
+Write about {scene_words} words of polished prose with vivid description and natural dialogue.
+Do not write a chapter heading or a scene heading, and do not continue into the next scene.
+
+Begin:
+"""
+
+def smooth_scene_boundary(previous_tail, next_opening, chapter_number):
+    """Rewrite the first paragraph of a scene so that it follows on from the end of the previous one"""
+    
+    prompt = f"""These are two consecutive passages from Chapter {chapter_number} of a novel, written separately.
+
+END OF THE PREVIOUS PASSAGE:
+{previous_tail}
+
+FIRST PARAGRAPH OF THE NEXT PASSAGE:
+{next_opening}
+
+Rewrite ONLY the first paragraph of the next passage so it follows on smoothly from the end of the previous passage.
+Remove anything that repeats or contradicts it, keep the same events, style and length, and do not add a heading.
+
+Rewritten paragraph:
+"""
+    
+    try:
+        response = hedged_request(prompt, 400, "smooth")
+        if response.status_code != 200:
+            return None
+        return response.json().get('content', '').strip() or None
+    except Exception as e:
+        color_print(f"Error smoothing scene boundary: {e}", Fore.RED)
+        return None
+
+def split_scene_opening(text):
+    """Split off the opening paragraph of a scene, or its first few sentences if paragraphs are very long"""
+    paragraph_end = text.find("\n\n", 0, 1500)
+    if paragraph_end != -1:
+        return text[:paragraph_end], text[paragraph_end:]
+    opening = trim_to_sentence(text[:600] + " ")
+    return opening, text[len(opening):]
+
+@profiled("scenes")
+def generate_chapter_scenes(title, chapter_plan, chapter_number, previous_chapters_summary=None, previous_chapter_ending=None, min_words=4000, max_tokens=8000, earlier_passages=None, story_state=None):
+    """Write a chapter as parallel scenes on separate slots and join them with a smoothing pass
+    
+    Returns the chapter text, or None so the caller can fall back to writing it in one pass.
+    """
+    
+    scenes = plan_chapter_scenes(title, chapter_plan, chapter_number, previous_chapter_ending)
+    if not scenes:
+        return None
+    
+    color_print(f"Writing Chapter {chapter_number} as {len(scenes)} scenes in parallel...", Fore.YELLOW)
+    for number, scene in enumerate(scenes, 1):
+        color_print(f"  Scene {number}: {scene['summary']}", Fore.CYAN)
+    
+    scene_words = max(min_words // len(scenes), 300)
+    scene_tokens = max(max_tokens // len(scenes), 1000)
+    
+    def write_scene(index):
+        prompt = build_scene_prompt(title, chapter_plan, chapter_number, scenes, index,
+                                    previous_chapters_summary, previous_chapter_ending, scene_words, earlier_passages, story_state)
+        text = stream_completion(prompt, scene_tokens, color=None)
+        if not text or not text.strip():
+            return None
+        # Drop any heading the model wrote despite the instructions
+        text = re.sub(r'^\s*(?:Chapter|Scene)\s+\d+[^\n]*\n+', '', text.strip(), flags=re.IGNORECASE)
+        color_print(f"Scene {index + 1} finished ({len(text.split())} words).", Fore.GREEN)
+        return text
+    
+    start_time = time.time()
+    futures = [submit_background(write_scene, index) for index in range(len(scenes))]
+    texts = [future.result() for future in futures]
+    if not all(texts):
+        color_print("A scene failed to generate.", Fore.YELLOW)
+        return None
+    record_telemetry("scenes_generated", len(texts))
+    
+    # Smooth every boundary at once; each rewrite only touches the opening of the later scene
+    openings = [None] + [split_scene_opening(text) for text in texts[1:]]
+    
+    def smooth(index):
+        return smooth_scene_boundary(texts[index - 1][-1200:], openings[index][0], chapter_number)
+    
+    rewrites = [future.result() for future in [submit_background(smooth, index) for index in range(1, len(texts))]]
+    for index, rewrite in enumerate(rewrites, 1):
+        if rewrite:
+            texts[index] = (rewrite + openings[index][1]).strip()
+            record_telemetry("scene_boundaries_smoothed")
+    
+    color_print(f"Scenes written and joined in {time.time() - start_time:.2f} seconds.", Fore.GREEN)
+    return f"Chapter {chapter_number}: {title}\n\n" + "\n\n".join(texts)
+
+@profiled("summarize")
+def summarize_chapter(chapter_content, max_tokens=1000):
+    """NovelGen by RFS11G: Generate a detailed summary of the chapter for context in subsequent chapters"""
+    
+    prompt = f"""Create a DETAILED summary of the following chapter that captures key elements needed for narrative continuity:
+
+{chapter_content[-5000:]}
+
+Your summary MUST include:
+1. Character locations and states at the END of the chapter
+2. Ongoing conversations and unfinished plot points
+3. Emotional states and tensions between characters
+4. Setting details and time of day/period at chapter end
+5. Key revelations or plot developments that affect future chapters
+
+Focus especially on the ENDING SCENE of the chapter, as this is critical for maintaining continuity.
+The summary should be comprehensive but no more than 500 words.
+"""
+
+    try:
+        color_print("Generating chapter summary with continuity elements...", Fore.YELLOW)
+        
+        keep_alive_running = setup_keep_alive()
+        
+        response = hedged_request(prompt, max_tokens, "summarize")
+        
+        cancel_keep_alive()
+        
+        if response.status_code != 200:
+            color_print(f"\nAPI Error: Status code {response.status_code}", Fore.RED)
+            return None
+            
+        result = response.json()
+        summary = result.get('content', '')
+        
+        color_print("Enhanced continuity summary generated.", Fore.GREEN)
+        return summary
+        
+    except requests.RequestException as e:
+        color_print(f"\nAPI Connection Error: {e}", Fore.RED)
+        cancel_keep_alive()
+        return None
+    except Exception as e:
+        color_print(f"\nUnexpected Error: {e}", Fore.RED)
+        cancel_keep_alive()
+        return None
+
+@profiled("summarize_segment")
+def summarize_segment(segment, chapter_number, part_number, max_tokens=400):
+    """Summarize one completed block of a chapter that is still being written"""
+    
+    prompt = f"""Summarize part {part_number} of Chapter {chapter_number} of a novel for narrative continuity:
+
+{segment}
+
+Your summary MUST include:
+1. Key events and revelations in this part
+2. Character locations, emotional states and tensions at the END of this part
+3. Ongoing conversations and unfinished plot points
+4. Setting details and time of day/period
+
+Be concise: no more than 200 words.
+"""
+    
+    try:
+        response = hedged_request(prompt, max_tokens, "summarize_segment", priority=PRIORITY_BACKGROUND)
+        
+        if response.status_code != 200:
+            color_print(f"\nAPI Error during segment summary: {response.status_code}", Fore.RED)
+            return None
+        
+        return response.json().get('content', '').strip() or None
+        
+    except Exception as e:
+        color_print(f"Error summarizing chapter segment: {e}", Fore.RED)
+        return None
+
+@profiled("summarize_merge")
+def merge_segment_summaries(summaries, chapter_number, max_tokens=1000):
+    """Merge the partial summaries of a chapter into one continuity summary"""
+    
+    parts_text = "\n\n".join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(summaries))
+    prompt = f"""Combine these consecutive partial summaries of Chapter {chapter_number} into a single DETAILED summary that captures key elements needed for narrative continuity:
+
+{parts_text}
+
+Your summary MUST include:
+1. Character locations and states at the END of the chapter
+2. Ongoing conversations and unfinished plot points
+3. Emotional states and tensions between characters
+4. Setting details and time of day/period at chapter end
+5. Key revelations or plot developments that affect future chapters
+
+The last part describes the ENDING SCENE of the chapter, which is critical for maintaining continuity.
+The summary should be comprehensive but no more than 500 words.
+"""
+    
+    try:
+        response = hedged_request(prompt, max_tokens, "summarize_merge")
+        
+        if response.status_code != 200:
+            color_print(f"\nAPI Error while merging summaries: {response.status_code}", Fore.RED)
+            return None
+        
+        return response.json().get('content', '').strip() or None
+        
+    except Exception as e:
+        color_print(f"Error merging chapter summaries: {e}", Fore.RED)
+        return None
+
+class IncrementalSummarizer:
+    """Stream sink that summarizes each completed block of a chapter on a free slot while the chapter is still streaming"""
+    
+    def __init__(self, chapter_number, segment_words=None):
+        self.chapter_number = chapter_number
+        self.segment_words = segment_words or SUMMARY_SEGMENT_WORDS
+        self._text = ""
+        self._committed = 0  # Offset of the first character not yet sent for summarization
+        self._pending_words = 0
+        self._futures = []
+        self._segment_ends = []  # Offset in the text where each submitted block ends
+        self._last_segment = ""
+    
+    def write(self, text):
+        self._text += text
+        self._pending_words += text.count(' ') + text.count('\n')
+        if self._pending_words >= self.segment_words:
+            self._cut_segment()
+    
+    def reset(self, text):
+        """Replace the text with a trimmed version of it, dropping the blocks that reach into the removed part"""
+        kept = 0
+        while kept < len(self._futures) and self._segment_ends[kept] <= len(text):
+            kept += 1
+        for future in self._futures[kept:]:
+            future.cancel()
+        if kept < len(self._futures):
+            record_telemetry("summary_segments_dropped", len(self._futures) - kept)
+        del self._futures[kept:]
+        del self._segment_ends[kept:]
+        
+        self._text = text
+        self._committed = self._segment_ends[-1] if self._segment_ends else 0
+        start = self._segment_ends[-2] if kept > 1 else 0
+        self._last_segment = text[start:self._committed]
+        self._pending_words = len(text[self._committed:].split())
+    
+    def sync(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    def _cut_segment(self):
+        pending = self._text[self._committed:]
+        if len(pending.split()) < self.segment_words:
+            self._pending_words = len(pending.split())
+            return
+        
+        # End the block at a paragraph break, or failing that a sentence end, in its second half
+        cut = pending.rfind('\n\n')
+        if cut < len(pending) // 2:
+            cut = pending.rfind('. ') + 1
+        if cut < len(pending) // 2:
+            cut = len(pending)
+        
+        self._submit(pending[:cut], self._committed + cut)
+        self._committed += cut
+        self._pending_words = len(self._text[self._committed:].split())
+    
+    def _submit(self, segment, end):
+        part_number = len(self._futures) + 1
+        self._last_segment = segment
+        self._segment_ends.append(end)
+        self._futures.append(submit_background(summarize_segment, segment, self.chapter_number, part_number))
+        record_telemetry("summary_segments")
+    
+    def _remaining_text(self, final_text):
+        """Find the text of the finished chapter that has not been summarized yet"""
+        if not self._futures:
+            return final_text
+        # The chapter may have been extended or had its beginning rewritten, so locate the last block by its tail
+        anchor = self._last_segment[-200:]
+        position = final_text.rfind(anchor) if anchor.strip() else -1
+        if position >= 0:
+            return final_text[position + len(anchor):]
+        return final_text[self._committed:]
+    
+    def finish(self, final_text):
+        """Summarize the rest of the chapter and merge all partial summaries"""
+        remaining = self._remaining_text(final_text)
+        if len(remaining.split()) >= 50 or not self._futures:
+            self._submit(remaining, len(self._text))
+        
+        wait_start = time.time()
+        summaries = [future.result() for future in self._futures]
+        summaries = [summary for summary in summaries if summary]
+        
+        merged = None
+        if len(summaries) == 1:
+            merged = summaries[0]
+        elif summaries:
+            merged = merge_segment_summaries(summaries, self.chapter_number) or "\n\n".join(summaries)
+        
+        record_telemetry("summary_wait_seconds", time.time() - wait_start)
+        if merged:
+            color_print(f"Chapter summary merged from {len(summaries)} segment summaries.", Fore.GREEN)
+        return merged
+
+class PassageIndex:
+    """BM25 index over the paragraphs of the chapters written so far
+    
+    Chapters are added as they finish; the next chapter's plan is the query, and the best
+    passages that fit a token budget go into its prompt. Passages are kept as offsets into their
+    chapter, whose text is held here or, with a chapter store, read back from disk when needed.
+    """
+    
+    def __init__(self, k1=1.5, b=0.75, min_passage_words=40, store=None):
+        self.k1 = k1
+        self.b = b
+        self.min_passage_words = min_passage_words
+        self.store = store
+        self.texts = {}  # chapter number -> text, when there is no store
+        self.passages = []  # (chapter number, start, end, length in terms)
+        self.postings = {}  # term -> list of (passage id, term frequency)
+        self.total_length = 0
+    
+    def split_passages(self, text):
+        """Split chapter text into paragraph spans, merging short ones (dialogue lines) with the next"""
+        spans = []
+        start = None
+        words = 0
+        position = 0
+        while position < len(text):
+            end = text.find("\n\n", position)
+            if end == -1:
+                end = len(text)
+            paragraph = text[position:end].strip()
+            # Skip headings (chapter titles and the "# Title" transition markers)
+            if paragraph and not (re.match(r'^(?:#|Chapter\s+\d+)', paragraph, re.IGNORECASE) and "\n" not in paragraph):
+                if start is None:
+                    start = position
+                words += len(paragraph.split())
+                if words >= self.min_passage_words:
+                    spans.append((start, end))
+                    start, words = None, 0
+            position = end + 2
+        if start is not None:
+            spans.append((start, len(text)))
+        return spans
+    
+    def passage_text(self, passage_id):
+        chapter_number, start, end, _ = self.passages[passage_id]
+        text = self.store.read(chapter_number) if self.store is not None else self.texts[chapter_number]
+        return text[start:end].strip()
+    
+    def add_chapter(self, chapter_number, text):
+        if self.store is None:
+            self.texts[chapter_number] = text
+        for start, end in self.split_passages(text):
+            terms = content_words(text[start:end])
+            if not terms:
+                continue
+            passage_id = len(self.passages)
+            self.passages.append((chapter_number, start, end, len(terms)))
+            self.total_length += len(terms)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((passage_id, count))
+    
+    def add_novel(self, full_novel):
+        """Index every chapter of an already written novel, e.g. when resuming from a checkpoint"""
+        # Later chapters follow a "## Chapter N: Title" heading (see append_chapter)
+        for chapter in re.split(r'(?m)^(?=(?:## )?Chapter\s+\d+)', full_novel):
+            match = re.match(r'(?:## )?Chapter\s+(\d+)', chapter, re.IGNORECASE)
+            if match:
+                self.add_chapter(int(match.group(1)), chapter)
+    
+    def add_store(self, store):
+        """Index every chapter already in a chapter store, one chapter in memory at a time"""
+        for chapter_number, _, text in store.iter_chapters():
+            self.add_chapter(chapter_number, text)
+    
+    def search(self, query, k=5, max_chapter=None):
+        """Return up to k (score, passage id) pairs for the query, best first"""
+        if not self.passages:
+            return []
+        count = len(self.passages)
+        average_length = self.total_length / count
+        scores = {}
+        for term in set(content_words(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for passage_id, frequency in postings:
+                length = self.passages[passage_id][3]
+                weight = frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * weight
+        ranked = [
+            (score, passage_id) for passage_id, score in scores.items()
+            if max_chapter is None or self.passages[passage_id][0] <= max_chapter
+        ]
+        return heapq.nlargest(k, ranked)
+    
+    def context_for(self, query, k=None, token_budget=None, max_chapter=None):
+        """Format the best passages for the query that fit in the token budget, in story order"""
+        k = k or RETRIEVAL_PASSAGES
+        token_budget = token_budget or RETRIEVAL_TOKENS
+        chosen = {}
+        used = 0
+        for _, passage_id in self.search(query, k, max_chapter):
+            text = self.passage_text(passage_id)
+            cost = estimate_tokens(text)
+            if used + cost > token_budget:
+                continue
+            chosen[passage_id] = text
+            used += cost
+        if not chosen:
+            return ""
+        record_telemetry("retrieved_passages", len(chosen))
+        record_telemetry("retrieved_tokens", used)
+        return "\n\n".join(
+            f"[From Chapter {self.passages[passage_id][0]}]\n{chosen[passage_id]}"
+            for passage_id in sorted(chosen)
+        )
+
+# Grammar for the state extraction call: one "KIND | name | facts" line per changed entity
+STATE_GRAMMAR = r'''
+root ::= line+
+line ::= kind " | " text " | " text "\n"
+kind ::= "CHARACTER" | "LOCATION" | "ITEM" | "RELATIONSHIP" | "THREAD_OPEN" | "THREAD_CLOSED"
+text ::= [^|\n]+
+'''
+
+STATE_KINDS = ("CHARACTER", "LOCATION", "ITEM", "RELATIONSHIP", "THREAD_OPEN", "THREAD_CLOSED")
+
+class StoryState:
+    """Structured record of characters, locations, possessions, relationships and open plot threads
+    
+    Updated by one extraction call per chapter; prompts include only the entries that the
+    upcoming chapter's plan mentions.
+    """
+    
+    def __init__(self, entries=None):
+        # (kind, name) -> [facts, chapter number of the last update]
+        self.entries = {}
+        for kind, name, facts, chapter_number in entries or []:
+            self.entries[(kind, name)] = [facts, chapter_number]
+    
+    def to_list(self):
+        return [[kind, name, facts, chapter_number] for (kind, name), (facts, chapter_number) in self.entries.items()]
+    
+    def apply(self, updates, chapter_number):
+        for kind, name, facts in updates:
+            if kind == "THREAD_CLOSED":
+                self.entries.pop(("THREAD", name), None)
+            else:
+                self.entries[("THREAD" if kind == "THREAD_OPEN" else kind, name)] = [facts, chapter_number]
+    
+    def names(self):
+        return sorted({name for kind, name in self.entries if kind != "THREAD"})
+    
+    def context_for(self, text, max_threads=5):
+        """Format the entries whose names appear in the text, plus the most recent open threads"""
+        lowered = text.lower()
+        
+        def mentioned(name):
+            # Match full names and significant parts, e.g. "Mara" for "Mara Quinn"
+            parts = [name] + [part for part in name.split() if len(part) > 3 and part[0].isupper()]
+            return any(re.search(rf"\b{re.escape(part.lower())}\b", lowered) for part in parts)
+        
+        lines = [
+            f"- {kind.title()} {name}: {facts}"
+            for (kind, name), (facts, _) in sorted(self.entries.items())
+            if kind != "THREAD" and mentioned(name)
+        ]
+        threads = sorted(
+            ((chapter_number, name, facts) for (kind, name), (facts, chapter_number) in self.entries.items() if kind == "THREAD"),
+            key=lambda thread: (not mentioned(thread[1]), -thread[0])
+        )[:max_threads]
+        lines += [f"- Open thread {name}: {facts}" for _, name, facts in threads]
+        return "\n".join(lines)
+
+def parse_state_updates(text):
+    """Parse "KIND | name | facts" lines, ignoring anything malformed"""
+    updates = []
+    for line in text.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[0].upper() in STATE_KINDS and parts[1] and parts[2]:
+            updates.append((parts[0].upper(), parts[1], parts[2]))
+    return updates
+
+@profiled("state")
+def extract_story_state(chapter_prompt, chapter_content, chapter_number, known_names=(), slot_hint=None):
+    """Extract state changes from a finished chapter
+    
+    The prompt starts with the chapter's own generation prompt and text, so when the call lands on the
+    slot that wrote the chapter the server can reuse its cached prefix instead of reading it again.
+    """
+    
+    known = f"\nAlready tracked: {', '.join(known_names)}. Reuse these exact names.\n" if known_names else ""
+    # Without a prompt cache the generation prompt would be read again in full, so send only the chapter
+    if not backends_support("prompt_cache"):
+        chapter_prompt = ""
+    prompt = f"""{chapter_prompt}{chapter_content}
+
+---
+STATE UPDATE for Chapter {chapter_number}. List every character, location, important item, relationship and plot thread whose state is established or changed by the chapter above, one per line, as:
+KIND | name | current facts (where they are, condition, what they carry, what they know or want)
+KIND is one of CHARACTER, LOCATION, ITEM, RELATIONSHIP, THREAD_OPEN or THREAD_CLOSED. For a RELATIONSHIP, the name is "A and B". Use THREAD_CLOSED for threads resolved in this chapter.{known}
+"""
+    
+    try:
+        response = hedged_request(prompt, 600, "state", prefer=slot_hint, grammar=STATE_GRAMMAR, cache_prompt=True, temperature=0.2)
+        
+        if response.status_code != 200:
+            color_print(f"API Error during state extraction: {response.status_code}", Fore.RED)
+            return []
+        
+        updates = parse_state_updates(response.json().get('content', ''))
+        record_telemetry("state_updates", len(updates))
+        return updates
+    except Exception as e:
+        color_print(f"Error extracting story state: {e}", Fore.RED)
+        return []
+
+def recent_summaries(previous_chapters_summary, count):
+    """Keep only the summaries of the last few chapters"""
+    summaries = re.split(r'\n\n(?=Chapter \d+: )', previous_chapters_summary.strip())
+    if len(summaries) <= count:
+        return previous_chapters_summary
+    return "\n\n".join(summaries[-count:]) + "\n\n"
+
+def ensure_chapter_header(chapter_content, chapter_number, chapter_title):
+    """Add the "Chapter N: Title" header if the model left it out"""
+    if not re.match(r'^Chapter\s+\d+', chapter_content, re.IGNORECASE):
+        chapter_content = f"Chapter {chapter_number}: {chapter_title}\n\n{chapter_content}"
+        color_print("Added missing chapter header.", Fore.YELLOW)
+    return chapter_content
+
+def check_and_fix_continuity(chapter_content, previous_chapter_ending, chapter_number, chapter_title, story_state=None):
+    """Verify that a chapter continues from the previous ending and rewrite its beginning if not"""
+    # Get first 1500 characters of current chapter (after removing header)
+    new_beginning = chapter_opening(chapter_content)
+    
+    continuity_ok, issues = verify_chapter_continuity(previous_chapter_ending, new_beginning, chapter_number, story_state)
+    
+    if not continuity_ok and issues:
+        color_print("Fixing continuity issues between chapters...", Fore.YELLOW)
+        chapter_content = fix_chapter_beginning(chapter_content, previous_chapter_ending, issues, chapter_number, chapter_title)
+    return chapter_content
+
+def format_chapter(chapter_content, chapter_number, chapter_title, first=False):
+    """Return the text a chapter adds to the novel, with proper formatting"""
+    if first:
+        # First chapter doesn't need the transition marker
+        return chapter_content
+    # Add a proper scene break/transition marker
+    transition = "\n\n# " + chapter_title + "\n\n## " + f"Chapter {chapter_number}: {chapter_title}" + "\n\n"
+    # Add the chapter content without repeating the header that's already in the transition
+    chapter_content_without_header = chapter_content[chapter_body_start(chapter_content):]
+    return transition + chapter_content_without_header
+
+def append_chapter(full_novel, chapter_content, chapter_number, chapter_title, first=False):
+    """Add a chapter to the novel text with proper formatting"""
+    return full_novel + format_chapter(chapter_content, chapter_number, chapter_title, first)
+
+def extract_chapter_ending(chapter_content):
+    """Return the closing lines of a chapter for continuity with the next one"""
+    # A slice, so a long chapter is never searched as a whole
+    return chapter_content[-1000:]
+
+def chapter_context(chapter, previous_chapters_summary, story_state=None, passage_index=None):
+    """Return the summaries, story state and earlier passages that go into a chapter's prompt"""
+    query = f"{chapter['title']}\n{chapter['description']}"
+    
+    # The previous chapter is already covered by its ending and summary, so search the ones before it
+    earlier_passages = None
+    if passage_index:
+        earlier_passages = passage_index.context_for(query, max_chapter=chapter['number'] - 2)
+    
+    # With tracked state, older summaries mostly repeat the cast, so keep only the latest ones
+    summary_context = previous_chapters_summary
+    state_context = None
+    if story_state:
+        summary_context = recent_summaries(previous_chapters_summary, STATE_RECENT_SUMMARIES)
+        state_context = story_state.context_for(query) or None
+    return summary_context, state_context, earlier_passages
+
+def generate_novel_chapters(title, story_plan, chapters_data, min_words_per_chapter=4000, max_tokens_per_chapter=8000, resume_state=None):
+    """NovelGen by RFS11G: Generate a novel chapter by chapter with improved continuity between chapters"""
+    
+    color_print(f"\nGenerating novel: {title}\n", Fore.CYAN)
+    color_print(f"Min words per chapter: {min_words_per_chapter}, Max tokens per chapter: {max_tokens_per_chapter}\n", Fore.YELLOW)
+    
+    if not chapters_data:
+        color_print("No chapter data available. Attempting to extract chapter plans.", Fore.YELLOW)
+        chapters_data = extract_chapters(story_plan)
+        
+        if not chapters_data:
+            color_print("Failed to extract any usable chapter plans. Using basic structure.", Fore.RED)
+            # Create some basic chapters if extraction failed
+            chapters_data = []
+            for i in range(1, 6):  # Create 5 basic chapters
+                chapters_data.append({
+                    'number': i,
+                    'title': f"Chapter {i}",
+                    'description': f"Events from story plan section {i}"
+                })
+    
+    color_print(f"Ready to generate {len(chapters_data)} chapters.", Fore.GREEN)
+    
+    # Generate chapters sequentially
+    full_novel = ""
+    previous_chapters_summary = ""
+    previous_chapter_ending = None
+    start_index = 0
+    story_state = StoryState() if STATE_TRACKING else None
+    store_only = CHAPTER_STORE
+    chapter_store = None
+    
+    if resume_state:
+        full_novel = resume_state.get('full_novel', "")
+        store_only = resume_state.get('store_only', False)
+        if resume_state.get('chapter_store'):
+            chapter_store = ChapterStore(resume_state['chapter_store'])
+        previous_chapters_summary = resume_state.get('previous_chapters_summary', "")
+        previous_chapter_ending = resume_state.get('previous_chapter_ending')
+        start_index = resume_state.get('next_index', 0)
+        if story_state:
+            story_state = StoryState(resume_state.get('story_state'))
+        color_print(f"Resuming from checkpoint at chapter {start_index + 1}.", Fore.GREEN)
+    
+    # Chapters and the artifacts derived from them are always stored so that regenerate can revise single
+    # chapters later; with NOVELGEN_CHAPTER_STORE the store is also the only copy of the text
+    if chapter_store is None:
+        chapter_store = ChapterStore(chapter_store_path(title), reset=True)
+    chapter_store.save_meta({
+        'title': title,
+        'story_plan': story_plan,
+        'chapters_data': chapters_data,
+        'min_words': min_words_per_chapter,
+        'max_tokens': max_tokens_per_chapter,
+        'world_bible': world_bible
+    })
+    
+    # Keep the checkpoint in step with the loop so a signal can save it at any time
+    checkpoint_state = {
+        'title': title,
+        'progress_name': progress_name(title),
+        'story_plan': story_plan,
+        'chapters_data': chapters_data,
+        'full_novel': full_novel,
+        'chapter_store': chapter_store.directory,
+        'store_only': store_only,
+        'previous_chapters_summary': previous_chapters_summary,
+        'previous_chapter_ending': previous_chapter_ending,
+        'story_state': story_state.to_list() if story_state else None,
+        'next_index': start_index
+    }
+    with active_checkpoints_lock:
+        active_checkpoints[checkpoint_state['progress_name']] = checkpoint_state
+    save_checkpoint(checkpoint_state)
+    
+    # Slots that the plan did not use prefill the start every chapter prompt shares while the first chapter starts
+    warm_up_slots(chapter_prompt_prefix(min_words_per_chapter))
+    
+    # The index is rebuilt from the text, so checkpoints do not need to store it
+    passage_index = None
+    if RETRIEVAL_PASSAGES > 0:
+        passage_index = PassageIndex(store=chapter_store if store_only else None)
+        if store_only:
+            passage_index.add_store(chapter_store)
+        else:
+            passage_index.add_novel(full_novel)
+    
+    # Nests each chapter's stages under "chapter N" in the profile; closed at the start of the next chapter,
+    # and by the with block after the last one or when a chapter fails
+    with ExitStack() as chapter_stage:
+        for i, chapter in enumerate(chapters_data):
+            if i < start_index:
+                continue
+            
+            chapter_stage.close()
+            chapter_stage.enter_context(profile_stage(f"chapter {chapter['number']}"))
+            
+            chapter_number = chapter['number']
+            chapter_title = chapter['title']
+            chapter_description = chapter['description']
+            
+            color_print(f"\nStarting generation of Chapter {chapter_number}/{len(chapters_data)}: {chapter_title}", Fore.CYAN)
+            emit_event("chapter_started", number=chapter_number, title=chapter_title, total=len(chapters_data))
+            
+            # Summarize the chapter block by block while it streams (no summary is needed for the last chapter)
+            summarizer = None
+            if INCREMENTAL_SUMMARY and i < len(chapters_data) - 1:
+                summarizer = IncrementalSummarizer(chapter_number)
+            
+            resume_text = resume_state.get('partial_chapter_text') if resume_state and i == start_index else None
+            
+            summary_context, state_context, earlier_passages = chapter_context(chapter, previous_chapters_summary, story_state, passage_index)
+            
+            # Pick the best of several parallel openings instead of verifying and fixing one afterwards
+            opening = None
+            if OPENING_CANDIDATES > 1 and i > 0 and previous_chapter_ending and not resume_text:
+                opening = choose_chapter_opening(
+                    chapter_title,
+                    chapter_description,
+                    chapter_number,
+                    summary_context,
+                    previous_chapter_ending,
+                    min_words_per_chapter,
+                    earlier_passages=earlier_passages,
+                    story_state=state_context
+                )
+            
+            # Generate the chapter with continuity from previous chapter
+            chapter_content = generate_chapter(
+                chapter_title, 
+                chapter_description, 
+                chapter_number, 
+                summary_context,
+                previous_chapter_ending,  # Pass the ending of the previous chapter
+                min_words_per_chapter,
+                max_tokens_per_chapter,
+                partial_path=partial_chapter_path(title, chapter_number),
+                resume_text=resume_text or opening,
+                summarizer=summarizer,
+                earlier_passages=earlier_passages,
+                story_state=state_context
+            )
+            
+            if not chapter_content:
+                color_print(f"Failed to generate Chapter {chapter_number}. Skipping.", Fore.RED)
+                continue
+            
+            chapter_content = ensure_chapter_header(chapter_content, chapter_number, chapter_title)
+            
+            # Verify continuity with previous chapter if not the first chapter (a chosen opening was already checked)
+            if i > 0 and not opening:
+                chapter_content = check_and_fix_continuity(chapter_content, previous_chapter_ending, chapter_number, chapter_title, state_context)
+            
+            # Extract state changes while the summary finishes; ask for the slot that wrote the chapter
+            state_future = None
+            if story_state and i < len(chapters_data) - 1:
+                chapter_prompt = build_chapter_prompt(chapter_title, chapter_description, chapter_number, summary_context,
+                                                      previous_chapter_ending, min_words_per_chapter, earlier_passages, state_context)
+                state_future = submit_background(extract_story_state, chapter_prompt, chapter_content, chapter_number,
+                                                 story_state.names(), getattr(job_context, 'last_slot', None))
+            
+            chapter_store.add(chapter_number, chapter_title, chapter_content)
+            if i > 0:
+                # The boundary into this chapter was checked (or its opening chosen); the check reads only the opening
+                chapter_store.set_artifact(chapter_number, "continuity", artifact_key(previous_chapter_ending, chapter_content[:1500]), True)
+            
+            if store_only:
+                # Each chapter is written to its own file as it is added, so there is no progress file to rewrite
+                color_print(f"Progress saved to {chapter_store.chapter_path(chapter_number)}", Fore.GREEN)
+            else:
+                full_novel = append_chapter(full_novel, chapter_content, chapter_number, chapter_title, first=(i == 0))
+                
+                # Save progress after each chapter
+                try:
+                    progress_dir = "novelgen_progress"
+                    if not os.path.exists(progress_dir):
+                        os.makedirs(progress_dir)
+                    
+                    progress_filename = os.path.join(progress_dir, f"{progress_name(title)}_progress.txt")
+                    with open(progress_filename, 'w', encoding='utf-8') as f:
+                        f.write(full_novel)
+                    color_print(f"Progress saved to {progress_filename}", Fore.GREEN)
+                except Exception as e:
+                    color_print(f"Warning: Could not save progress: {e}", Fore.YELLOW)
+            
+            # Store the ending of the current chapter for continuity in the next chapter
+            previous_chapter_ending = extract_chapter_ending(chapter_content)
+            if passage_index:
+                passage_index.add_chapter(chapter_number, chapter_content)
+            
+            # Create a detailed summary for context in subsequent chapters
+            if i < len(chapters_data) - 1:  # Don't need a summary for the last chapter
+                summary = summarizer.finish(chapter_content) if summarizer else None
+                if not summary:
+                    summary = summarize_chapter(chapter_content)
+                if summary:
+                    previous_chapters_summary += f"Chapter {chapter_number}: {summary}\n\n"
+                    chapter_store.set_artifact(chapter_number, "summary", artifact_key(chapter_content), summary)
+                    if store_only and story_state:
+                        # Prompts only use the latest summaries once state is tracked, and the store keeps them all
+                        previous_chapters_summary = recent_summaries(previous_chapters_summary, STATE_RECENT_SUMMARIES)
+            
+            if state_future:
+                updates = state_future.result()
+                story_state.apply(updates, chapter_number)
+                chapter_store.set_artifact(chapter_number, "state", artifact_key(chapter_content), updates)
+            
+            checkpoint_state.update({
+                'full_novel': full_novel,
+                'previous_chapters_summary': previous_chapters_summary,
+                'previous_chapter_ending': previous_chapter_ending,
+                'story_state': story_state.to_list() if story_state else None,
+                'next_index': i + 1
+            })
+            save_checkpoint(checkpoint_state)
+            
+            # The chapter is complete, so any partial output saved for it is stale
+            try:
+                os.remove(partial_chapter_path(title, chapter_number))
+            except OSError:
+                pass
+            
+            # Chapter text is freed by reference counting as soon as it goes out of scope; a young-generation
+            # pass clears short-lived cycles without walking every object the run has accumulated
+            gc.collect(1)
+            
+            color_print(f"Completed Chapter {chapter_number}/{len(chapters_data)}\n", Fore.GREEN)
+            emit_event("chapter_completed", number=chapter_number, title=chapter_title, words=len(chapter_content.split()), total=len(chapters_data))
+    
+    with active_checkpoints_lock:
+        active_checkpoints.pop(checkpoint_state['progress_name'], None)
+    
+    # A store keeps one entry per chapter number, so it has no duplicates to remove
+    if store_only:
+        return chapter_store
+    
+    # Apply deduplication to remove any duplicate chapters
+    full_novel = deduplicate_chapters(full_novel)
+    
+    return full_novel
+
+BOOK_STYLE = """
+    @namespace epub "http://www.idpf.org/2007/ops";
+    body {
+        font-family: Cambria, Liberation Serif, Bitstream Vera Serif, Georgia, Times, Times New Roman, serif;
+        margin: 5%;
+        text-align: justify;
+    }
+    h1, h2 {
+        text-align: center;
+        page-break-before: always;
+    }
+    .title {
+        margin-top: 20%;
+        text-align: center;
+    }
+    .chapter {
+        margin-top: 10%;
+        page-break-before: always;
+    }
+    p {
+        text-indent: 1em;
+        margin-top: 0.5em;
+        margin-bottom: 0.5em;
+    }
+    """
+
+CHAPTER_HEADING_PATTERN = re.compile(r'(Chapter\s+\d+[:\s]+.*?\n)', re.IGNORECASE)
+TRANSITION_MARKER_PATTERN = re.compile(r'\n\s*#[^\S\n]+[^\n]*\n\s*#+\s*$')  # "# Title\n\n## " left before the next heading
+
+def novel_sections(full_novel):
+    """Split an assembled novel once into (heading, text) pairs for the export formats"""
+    splits = CHAPTER_HEADING_PATTERN.split(full_novel)
+    if len(splits) <= 1:
+        color_print("No chapter divisions found. Treating novel as single chapter.", Fore.YELLOW)
+        return [("Chapter 1", full_novel)]
+    
+    # Text before the first heading is an introduction; the transition marker that format_chapter puts
+    # in front of each heading belongs to the next chapter, not to the end of this one
+    sections = [("Introduction", splits[0])] + [(splits[i].strip(), splits[i + 1]) for i in range(1, len(splits), 2)]
+    return [(heading, TRANSITION_MARKER_PATTERN.sub('', text)) for heading, text in sections if text.strip()]
+
+def stored_section(store, chapter_number, chapter_title):
+    """Read one chapter of a store as a (heading, text) pair"""
+    text = store.read(chapter_number)
+    text = text[chapter_body_start(text, blank_line=False):]
+    return f"Chapter {chapter_number}: {chapter_title}", text
+
+def iter_sections(source):
+    """Yield the (heading, text) pairs of a section list, or of a chapter store one chapter at a time"""
+    if isinstance(source, ChapterStore):
+        for chapter_number, chapter_title in source.titles():
+            yield stored_section(source, chapter_number, chapter_title)
+    else:
+        yield from source
+
+def section_headings(source):
+    if isinstance(source, ChapterStore):
+        return [f"Chapter {chapter_number}: {chapter_title}" for chapter_number, chapter_title in source.titles()]
+    return [heading for heading, _ in source]
+
+def paragraphs_html(text):
+    """Escape text and mark up its blank-line separated paragraphs"""
+    # Escaping leaves newlines and spaces alone, so the escaped text splits into the same paragraphs
+    paragraphs = split_paragraphs(html.escape(text))
+    return "<p>" + "</p><p>".join(paragraph.replace('\n', '<br/>') for paragraph in paragraphs) + "</p>"
+
+def chapter_xhtml(chapter_title, chapter_text):
+    """Render one chapter's text as an XHTML page"""
+    return f"""
+    <html>
+    <head>
+        <title>{html.escape(chapter_title)}</title>
+        <link rel="stylesheet" href="style/default.css" type="text/css" />
+    </head>
+    <body>
+        <div class="chapter">
+            <h2>{html.escape(chapter_title)}</h2>
+            <div>
+                {paragraphs_html(chapter_text)}
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+def chapter_html(chapter_title, chapter_text):
+    """Render one chapter as the body of a section in the standalone HTML book"""
+    return f"<h2>{html.escape(chapter_title)}</h2>\n{paragraphs_html(chapter_text)}\n"
+
+def chapter_markdown(chapter_title, chapter_text):
+    return f"## {chapter_title}\n\n{chapter_text.strip()}\n\n"
+
+CHAPTER_RENDERERS = {"xhtml": chapter_xhtml, "html": chapter_html, "md": chapter_markdown}
+
+def render_chapter(kind, chapter_title, chapter_text):
+    """Render a chapter, reusing the cached rendering when neither its text nor the renderer changed
+    
+    Book-level pieces (metadata, title page, CSS) are not part of a chapter's rendering, so changing
+    them does not invalidate the cache.
+    """
+    renderer = CHAPTER_RENDERERS[kind]
+    if not RENDER_CACHE_DIR:
+        return renderer(chapter_title, chapter_text)
+    
+    cache_path = os.path.join(RENDER_CACHE_DIR, f"{artifact_key(RENDER_VERSION, kind, chapter_title, chapter_text)}.{kind}")
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            rendered = f.read()
+        # The modification time records the last use, for pruning
+        os.utime(cache_path)
+        return rendered
+    except OSError:
+        pass
+    
+    rendered = renderer(chapter_title, chapter_text)
+    try:
+        os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+        # Several export workers may render the same chapter; each writes its own file and renames it
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(rendered)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        color_print(f"Warning: Could not cache rendered chapter: {e}", Fore.YELLOW)
+    return rendered
+
+def prune_render_cache(limit_mb=None):
+    """Delete the least recently used renderings until the render cache fits in its size limit"""
+    limit = (RENDER_CACHE_MB if limit_mb is None else limit_mb) * 1e6
+    if not RENDER_CACHE_DIR or not os.path.isdir(RENDER_CACHE_DIR):
+        return 0
+    entries = []
+    for entry in os.scandir(RENDER_CACHE_DIR):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        record_telemetry("render_cache_pruned", removed)
+    return removed
+
+class StoredChapterHtml(epub.EpubHtml):
+    """EPUB chapter rendered from a chapter store only while the book is being written"""
+    
+    def __init__(self, store, chapter_number, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.chapter_number = chapter_number
+    
+    def render(self, method):
+        # Hold the chapter's markup only for this call so the whole book is never in memory at once
+        heading, text = stored_section(self.store, self.chapter_number, self.store.chapters[self.chapter_number][0])
+        self.content = render_chapter("xhtml", heading, text)
+        try:
+            return method()
+        finally:
+            self.content = ""
+    
+    def get_content(self, default=None):
+        return self.render(functools.partial(super().get_content, default))
+    
+    def get_body_content(self):
+        return self.render(super().get_body_content)
+
+@profiled("epub")
+def create_epub(title, author, story_plan, full_novel, output_filename=None):
+    """Create an EPUB file from the generated novel and story plan
+    
+    The novel may be the assembled text, its (heading, text) sections or a chapter store.
+    """
+    
+    output_dir = "novelgen_output"
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        
+    if not output_filename:
+        output_filename = os.path.join(output_dir, f"{title.replace(' ', '_').lower()}.epub")
+    
+    color_print(f"\nCreating EPUB file: {output_filename}", Fore.CYAN)
+    
+    # First deduplicate chapters to ensure clean content (a chapter store has none)
+    if isinstance(full_novel, str):
+        full_novel = novel_sections(deduplicate_chapters(full_novel))
+    
+    # Create a new EPUB book
+    book = epub.EpubBook()
+    
+    # Set metadata
+    book.set_identifier(f"novel-{int(time.time())}")
+    book.set_title(title)
+    book.set_language('en')
+    book.add_author(author)
+    
+    # Add CSS
+    css = epub.EpubItem(
+        uid="style_default",
+        file_name="style/default.css",
+        media_type="text/css",
+        content=BOOK_STYLE
+    )
+    book.add_item(css)
+    
+    # Create title page
+    title_page = epub.EpubHtml(title='Title Page', file_name='title_page.xhtml', lang='en')
+    title_page.content = f"""
+    <html>
+    <head>
+        <title>{html.escape(title)}</title>
+        <link rel="stylesheet" href="style/default.css" type="text/css" />
+    </head>
+    <body>
+        <div class="title">
+            <h1>{html.escape(title)}</h1>
+            <h3>By {html.escape(author)}</h3>
+            <p>Generated: {datetime.now().strftime('%Y-%m-%d')}</p>
+            <p>Created with NovelGen by RFS11G</p>
+        </div>
+    </body>
+    </html>
+    """
+    book.add_item(title_page)
+    
+    # Create story plan page
+    plan_page = epub.EpubHtml(title='Story Plan', file_name='story_plan.xhtml', lang='en')
+    
+    # Process story plan to proper HTML
+    story_plan_html = html.escape(story_plan)
+    story_plan_html = story_plan_html.replace('\n', '<br/>')
+    
+    plan_page.content = f"""
+    <html>
+    <head>
+        <title>Story Plan</title>
+        <link rel="stylesheet" href="style/default.css" type="text/css" />
+    </head>
+    <body>
+        <h1>Story Plan</h1>
+        <div>
+            {story_plan_html}
+        </div>
+    </body>
+    </html>
+    """
+    book.add_item(plan_page)
+    
+    # Add the chapters to the book
+    chapters = []
+    toc = []
+    
+    if isinstance(full_novel, ChapterStore):
+        # Chapters are read back from disk one at a time when the EPUB is written
+        for chapter_count, (chapter_number, heading) in enumerate(zip(sorted(full_novel.chapters), section_headings(full_novel)), 1):
+            ch_filename = f'chapter_{chapter_count}.xhtml'
+            ch = StoredChapterHtml(full_novel, chapter_number, title=heading, file_name=ch_filename, lang='en')
+            book.add_item(ch)
+            chapters.append(ch)
+            toc.append(epub.Link(ch_filename, heading, f'chapter{chapter_count}'))
+    else:
+        for chapter_count, (heading, text) in enumerate(full_novel, 1):
+            ch_filename = f'chapter_{chapter_count}.xhtml'
+            ch = epub.EpubHtml(title=heading, file_name=ch_filename, lang='en')
+            ch.content = render_chapter("xhtml", heading, text)
+            book.add_item(ch)
+            chapters.append(ch)
+            toc.append(epub.Link(ch_filename, heading, f'chapter{chapter_count}'))
+    
+    # Add table of contents
+    book.toc = [
+        epub.Link('title_page.xhtml', 'Title Page', 'title'),
+        epub.Link('story_plan.xhtml', 'Story Plan', 'story_plan'),
+        (
+            epub.Section('Chapters'),
+            toc
+        )
+    ]
+    
+    # Add navigation files
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    
+    # Define book spine
+    book.spine = ['nav', title_page, plan_page] + chapters
+    
+    # Write the EPUB file
+    try:
+        epub.write_epub(output_filename, book, {})
+        color_print(f"EPUB file created successfully: {output_filename}", Fore.GREEN)
+        return output_filename
+    except Exception as e:
+        color_print(f"Error creating EPUB file: {e}", Fore.RED)
+        return None
+
+def write_text_export(title, author, story_plan, source, output_filename):
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        if isinstance(source, ChapterStore):
+            source.write_novel(f)
+        else:
+            f.write(source)
+    color_print(f"Novel saved to {output_filename}", Fore.GREEN)
+    return output_filename
+
+def write_markdown_export(title, author, story_plan, source, output_filename):
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        f.write(f"# {title}\n\n*By {author}*\n\n")
+        for heading, text in iter_sections(source):
+            f.write(render_chapter("md", heading, text))
+    color_print(f"Markdown file created successfully: {output_filename}", Fore.GREEN)
+    return output_filename
+
+def write_html_export(title, author, story_plan, source, output_filename):
+    """Write the novel as one HTML page with the EPUB's stylesheet and a table of contents"""
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        f.write(f'<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8"/>\n<title>{html.escape(title)}</title>\n'
+                f'<style>{BOOK_STYLE}</style>\n</head>\n<body>\n<div class="title">\n<h1>{html.escape(title)}</h1>\n'
+                f'<h3>By {html.escape(author)}</h3>\n</div>\n<nav>\n<ol>\n')
+        for chapter_count, heading in enumerate(section_headings(source), 1):
+            f.write(f'<li><a href="#chapter-{chapter_count}">{html.escape(heading)}</a></li>\n')
+        f.write("</ol>\n</nav>\n")
+        for chapter_count, (heading, text) in enumerate(iter_sections(source), 1):
+            f.write(f'<section class="chapter" id="chapter-{chapter_count}">\n{render_chapter("html", heading, text)}</section>\n')
+        f.write("</body>\n</html>\n")
+    color_print(f"HTML file created successfully: {output_filename}", Fore.GREEN)
+    return output_filename
+
+EXPORT_WRITERS = {"txt": write_text_export, "epub": create_epub, "md": write_markdown_export, "html": write_html_export}
+
+def export_format(fmt, title, author, story_plan, source, output_filename):
+    """Write one export format, returning the path written or None; runs in an export worker process"""
+    try:
+        return EXPORT_WRITERS[fmt](title, author, story_plan, source, output_filename)
+    except Exception as e:
+        color_print(f"Error creating {fmt.upper()} file: {e}", Fore.RED)
+        return None
+
+def export_jobs(title, author, story_plan, full_novel, output_dir="novelgen_output", formats=None):
+    """List the (format, arguments) of each file to write for a novel, splitting its text into chapters once"""
+    formats = ["txt"] + [fmt for fmt in (formats or EXPORT_FORMATS) if fmt != "txt"]
+    unknown = [fmt for fmt in formats if fmt not in EXPORT_WRITERS]
+    if unknown:
+        color_print(f"Skipping unknown export formats: {', '.join(unknown)}", Fore.YELLOW)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # A chapter store is passed as is and read from disk by each worker; text is split only once
+    sections = full_novel
+    if isinstance(full_novel, str) and len(formats) > 1:
+        sections = novel_sections(deduplicate_chapters(full_novel))
+    jobs = []
+    for fmt in formats:
+        if fmt in EXPORT_WRITERS:
+            source = full_novel if fmt == "txt" else sections
+            jobs.append((fmt, (title, author, story_plan, source, os.path.join(output_dir, f"{title_slug(title)}.{fmt}"))))
+    return jobs
+
+def run_export_jobs(jobs, workers=None):
+    """Run export jobs in parallel worker processes, returning the path written (or None) for each"""
+    workers = EXPORT_WORKERS if workers is None else workers
+    if workers <= 0:
+        workers = min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1 or len(jobs) <= 1:
+        results = [export_format(fmt, *args) for fmt, args in jobs]
+    else:
+        # Workers are spawned rather than forked, since this process has live background threads
+        results = [None] * len(jobs)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [executor.submit(export_format, fmt, *args) for fmt, args in jobs]
+                for index, future in enumerate(futures):
+                    results[index] = future.result()
+        except Exception as e:
+            color_print(f"Export workers failed ({e}); exporting in this process", Fore.YELLOW)
+            results = [export_format(fmt, *args) for fmt, args in jobs]
+    
+    # Pruned here, once the workers are done, so no worker is reading a file while it is deleted
+    prune_render_cache()
+    return results
+
+@profiled("export")
+def export_novel(title, author, story_plan, full_novel, output_dir="novelgen_output", formats=None, workers=None):
+    """Write the finished novel in each export format, returning the paths of the files written"""
+    jobs = export_jobs(title, author, story_plan, full_novel, output_dir, formats)
+    return {fmt: path for (fmt, _), path in zip(jobs, run_export_jobs(jobs, workers)) if path}
+
+def export_stored_novels(titles, author="AI Writer", formats=None, output_dir="novelgen_output", workers=None):
+    """Export several stored novels from one pool of worker processes"""
+    jobs = []
+    for title in titles:
+        store = ChapterStore(chapter_store_path(title)) if os.path.isdir(chapter_store_path(title)) else None
+        if store is None or not store.meta:
+            color_print(f"No stored chapters for '{title}'", Fore.RED)
+            continue
+        jobs.extend(export_jobs(store.meta['title'], author, store.meta['story_plan'], store, output_dir, formats))
+    
+    started = time.time()
+    written = [path for path in run_export_jobs(jobs, workers) if path]
+    color_print(f"Wrote {len(written)} of {len(jobs)} files in {time.time() - started:.1f}s", Fore.GREEN if len(written) == len(jobs) else Fore.YELLOW)
+    return written
+
+def run_novel(title, author, theme=None, genre=None, min_words=2000, resume_state=None, output_dir="novelgen_output"):
+    """Generate a complete novel and export it, returning the paths of the files written"""
+    
+    if resume_state:
+        story_plan, chapters_data = resume_state['story_plan'], resume_state['chapters_data']
+    else:
+        # Generate story plan with retry logic
+        color_print("\nGenerating story plan...", Fore.CYAN)
+        emit_event("plan_started", title=title)
+        story_plan, chapters_data = get_story_plan_with_chapters(title, theme, genre)
+    
+    if not story_plan:
+        color_print("Failed to generate story plan. Exiting.", Fore.RED)
         return None
+    
+    emit_event("plan_completed", chapters=len(chapters_data))
+    outputs = {}
+    
+    # Save story plan
+    try:
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+            
+        plan_filename = os.path.join(output_dir, f"{title_slug(title)}_plan.txt")
+        with open(plan_filename, 'w', encoding='utf-8') as f:
+            f.write(story_plan)
+        outputs['plan'] = plan_filename
+        color_print(f"Story plan saved to {plan_filename}", Fore.GREEN)
     except Exception as e:
-        color_print(f"\nUnexpected Error: {e}", Fore.RED)
-        cancel_keep_alive()
+        color_print(f"Warning: Could not save story plan: {e}", Fore.YELLOW)
+    
+    # Generate novel
+    full_novel = generate_novel_chapters(title, story_plan, chapters_data, min_words, resume_state=resume_state)
+    
+    if not full_novel:
+        color_print("Failed to generate novel. Exiting.", Fore.RED)
         return None
-def fix_chapter_beginning(chapter_content, previous_ending, issues, chapter_number, chapter_title):
-    """Fix the beginning of a chapter to ensure continuity with the previous chapter"""
     
-    # Extract the first 1000-1500 characters of the chapter as the part to replace
-    chapter_beginning = re.sub(r'^Chapter\s+\d+[:\s]+.*?\n\n', '', chapter_content[:1500], flags=re.IGNORECASE)
-    chapter_beginning = chapter_beginning.split("\n\n")[0] if "\n\n" in chapter_beginning else chapter_beginning
+    outputs.update(export_novel(title, author, story_plan, full_novel, output_dir))
+    if 'txt' in outputs:
+        clear_checkpoint(title)
     
-    # Extract the rest of the chapter content
-    rest_of_chapter = chapter_content[len(chapter_beginning):]
+    emit_event("export_completed", files=sorted(outputs))
+    color_print("\nNovel generation complete!", Fore.GREEN)
+    return outputs
+
+def regenerate_chapters(title, chapter_numbers, author="AI Writer", output_dir="novelgen_output"):
+    """Rewrite chapters of a stored novel, recompute only the artifacts that depend on them, and export it again
     
-    issues_text = "\n".join([f"- {issue}" for issue in issues]) if issues else "Unknown continuity issues"
+    A chapter's text depends on the summaries before it and the previous chapter's ending; its summary,
+    state updates and the continuity checks into it and out of it depend on its text. Every stored
+    artifact whose inputs are unchanged is reused.
+    """
+    directory = chapter_store_path(title)
+    chapter_store = ChapterStore(directory) if os.path.isdir(directory) else None
+    if chapter_store is None or not chapter_store.meta:
+        color_print(f"No stored chapters for '{title}' in {directory}. Generate the novel first.", Fore.RED)
+        return None
     
-    prompt = f"""REWRITE THE BEGINNING OF THIS CHAPTER to fix continuity issues.
+    meta = chapter_store.meta
+    # A series book is rewritten with the same prompt prefix it was written with
+    set_world_bible(meta.get('world_bible'))
+    warm_up_slots(chapter_prompt_prefix(meta['min_words']))
+    chapters_data = [chapter for chapter in meta['chapters_data'] if chapter['number'] in chapter_store.chapters]
+    missing = sorted(set(chapter_numbers) - chapter_store.chapters.keys())
+    if missing:
+        color_print(f"Chapters not in the store: {', '.join(map(str, missing))}", Fore.RED)
+        return None
+    
+    targets = set(chapter_numbers)
+    counts = {'regenerated': 0, 'checked': 0, 'summarized': 0, 'state': 0, 'reused': 0}
+    previous_chapters_summary = ""
+    previous_chapter_ending = None
+    story_state = StoryState() if STATE_TRACKING else None
+    passage_index = PassageIndex(store=chapter_store) if RETRIEVAL_PASSAGES > 0 else None
+    
+    for i, chapter in enumerate(chapters_data):
+        chapter_number = chapter['number']
+        chapter_title = chapter['title']
+        last = i == len(chapters_data) - 1
+        rewritten = False
+        
+        if chapter_number in targets:
+            color_print(f"\nRegenerating Chapter {chapter_number}: {chapter_title}", Fore.CYAN)
+            summary_context, state_context, earlier_passages = chapter_context(chapter, previous_chapters_summary, story_state, passage_index)
+            chapter_content = generate_chapter(
+                chapter_title,
+                chapter['description'],
+                chapter_number,
+                summary_context,
+                previous_chapter_ending,
+                meta['min_words'],
+                meta['max_tokens'],
+                partial_path=partial_chapter_path(title, chapter_number),
+                earlier_passages=earlier_passages,
+                story_state=state_context
+            )
+            if chapter_content:
+                chapter_content = ensure_chapter_header(chapter_content, chapter_number, chapter_title)
+                if previous_chapter_ending:
+                    chapter_content = check_and_fix_continuity(chapter_content, previous_chapter_ending, chapter_number, chapter_title, state_context)
+                chapter_store.add(chapter_number, chapter_title, chapter_content)
+                counts['regenerated'] += 1
+                rewritten = True
+                try:
+                    os.remove(partial_chapter_path(title, chapter_number))
+                except OSError:
+                    pass
+            else:
+                color_print(f"Failed to regenerate Chapter {chapter_number}. Keeping the stored text.", Fore.RED)
+                chapter_content = chapter_store.read(chapter_number)
+        else:
+            chapter_content = chapter_store.read(chapter_number)
+        
+        # The boundary into this chapter is checked again only if the previous ending or this opening changed
+        if previous_chapter_ending:
+            continuity_key = artifact_key(previous_chapter_ending, chapter_content[:1500])
+            if chapter_store.artifact(chapter_number, "continuity", continuity_key) is None:
+                if not rewritten:
+                    color_print(f"\nRe-checking the start of Chapter {chapter_number}...", Fore.CYAN)
+                    state_context = chapter_context(chapter, previous_chapters_summary, story_state)[1]
+                    fixed = check_and_fix_continuity(chapter_content, previous_chapter_ending, chapter_number, chapter_title, state_context)
+                    if fixed != chapter_content:
+                        chapter_content = fixed
+                        chapter_store.add(chapter_number, chapter_title, chapter_content)
+                        continuity_key = artifact_key(previous_chapter_ending, chapter_content[:1500])
+                    counts['checked'] += 1
+                chapter_store.set_artifact(chapter_number, "continuity", continuity_key, True)
+            else:
+                counts['reused'] += 1
+        
+        text_key = artifact_key(chapter_content)
+        if not last:
+            summary = chapter_store.artifact(chapter_number, "summary", text_key)
+            if summary is None:
+                summary = summarize_chapter(chapter_content)
+                if summary:
+                    chapter_store.set_artifact(chapter_number, "summary", text_key, summary)
+                    counts['summarized'] += 1
+            else:
+                counts['reused'] += 1
+            if summary:
+                previous_chapters_summary += f"Chapter {chapter_number}: {summary}\n\n"
+            
+            if story_state:
+                updates = chapter_store.artifact(chapter_number, "state", text_key)
+                if updates is None:
+                    updates = extract_story_state("", chapter_content, chapter_number, story_state.names())
+                    chapter_store.set_artifact(chapter_number, "state", text_key, updates)
+                    counts['state'] += 1
+                else:
+                    counts['reused'] += 1
+                story_state.apply(updates, chapter_number)
+        
+        previous_chapter_ending = extract_chapter_ending(chapter_content)
+        if passage_index:
+            passage_index.add_chapter(chapter_number, chapter_content)
+    
+    color_print(f"\nChapters rewritten: {counts['regenerated']}, openings re-checked: {counts['checked']}, "
+                f"summaries redone: {counts['summarized']}, state extractions redone: {counts['state']}, "
+                f"stored results reused: {counts['reused']}", Fore.GREEN)
+    
+    outputs = export_novel(meta['title'], author, meta['story_plan'], chapter_store, output_dir)
+    emit_event("export_completed", files=sorted(outputs))
+    return outputs
 
-PREVIOUS CHAPTER ENDING:
-{previous_ending}
+def series_path(name):
+    return os.path.join("novelgen_series", f"{title_slug(name)}.json")
 
-CURRENT CHAPTER BEGINNING (to be replaced):
-{chapter_beginning}
+def load_series(name):
+    """Load a stored series, or return None if there is none by that name"""
+    path = series_path(name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        color_print(f"Warning: Could not read series {path}: {e}", Fore.YELLOW)
+        return None
 
-CONTINUITY ISSUES TO FIX:
-{issues_text}
+def save_series(series):
+    path = series_path(series['name'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(series, f, indent=2)
+    os.replace(temp_path, path)
 
-Write a NEW beginning that directly continues from the previous chapter's ending, fixing all continuity issues.
-Maintain the same characters, setting, and situation, but make sure it flows naturally from the previous ending.
-The new beginning should be approximately the same length as the original.
+def format_world_bible(series):
+    """Build the prompt prefix for a series: the bible, then the books written so far
+    
+    Book summaries are appended at the end, so each new book shares everything before them with
+    the previous one and the backend's cached prefix stays valid.
+    """
+    books = "".join(f"Book {i}: {book['title']}\n{book['summary']}\n\n" for i, book in enumerate(series['books'], 1))
+    books = books or "None yet.\n\n"
+    return f"""WORLD BIBLE FOR THE SERIES "{series['name']}"
+Every book in the series shares this world. Stay consistent with it.
+
+{series['bible'].strip()}
+
+PREVIOUS BOOKS:
+{books}---
 
-NEW CHAPTER BEGINNING:
 """
 
+def create_series(name, premise, theme=None, genre=None, bible_text=None):
+    """Write (or import) the world bible for a new series and store it"""
+    if bible_text is None:
+        color_print(f"\nBuilding the world bible for {name}...", Fore.CYAN)
+        details = "".join(f"{label}: {value}\n" for label, value in (("Theme", theme), ("Genre", genre)) if value)
+        prompt = f"""Create the WORLD BIBLE for a multi-book fiction series called "{name}".
+Premise: {premise}
+{details}
+Write these sections, concise and concrete, using headings exactly as shown:
+CAST: the recurring characters, each with appearance, personality, skills, relationships and goals
+LOCATIONS: the recurring places, each with its look, atmosphere and significance
+RULES: how the world works (history, politics, technology or magic) and the limits every book must respect
+TONE AND STYLE: narrative voice, point of view and recurring motifs
+
+CAST:"""
+        bible_text = stream_completion(prompt, 1500, prefix="CAST:")
+        if not bible_text:
+            color_print("Failed to build the world bible.", Fore.RED)
+            return None
+    series = {'name': name, 'premise': premise, 'bible': bible_text, 'books': []}
+    save_series(series)
+    color_print(f"\nSeries saved to {series_path(name)}", Fore.GREEN)
+    return series
+
+def summarize_book(title, chapter_summaries, max_tokens=800):
+    """Condense a finished book's chapter summaries into the summary later books are given"""
+    prompt = f"""Summarize the book "{title}" from its chapter summaries below, for the author of the next book in the series.
+Cover the main plot, how it ends, what changed for each character, and the open threads. No more than 400 words.
+
+{chapter_summaries}
+
+BOOK SUMMARY:
+"""
     try:
-        color_print("Fixing chapter beginning for better continuity...", Fore.YELLOW)
-        
-        response = requests.post(
-            "http://localhost:8080/completion",
-            json={
-                "prompt": prompt,
-                "max_tokens": 2000,
-                "stream": False
-            }
-        )
-        
+        response = hedged_request(prompt, max_tokens, "summarize_book")
         if response.status_code != 200:
-            color_print(f"\nAPI Error during continuity fix: {response.status_code}", Fore.RED)
-            return chapter_content  # Return original content if fix fails
-            
-        result = response.json()
-        new_beginning = result.get('content', '')
-        
-        if new_beginning:
-            # Replace the beginning of the chapter with the fixed version
-            fixed_chapter = f"Chapter {chapter_number}: {chapter_title}\n\n{new_beginning.strip()}{rest_of_chapter}"
-            color_print("Successfully fixed chapter beginning for continuity.", Fore.GREEN)
-            return fixed_chapter
-        
-        return chapter_content  # Return original if no fix generated
-        
+            color_print(f"API Error during book summary: {response.status_code}", Fore.RED)
+            return None
+        return response.json().get('content', '').strip() or None
     except Exception as e:
-        color_print(f"Error fixing chapter beginning: {e}", Fore.RED)
-        return chapter_content  
+        color_print(f"Error summarizing book: {e}", Fore.RED)
+        return None
 
-def verify_chapter_continuity(previous_ending, new_beginning, chapter_number):
-    """Verify that the new chapter continues properly from the previous one"""
+def run_series_book(series_name, title, author, theme=None, genre=None, min_words=2000, resume=False, output_dir="novelgen_output"):
+    """Write the next book of a series with its world bible as the prefix of every prompt, then add it to the series"""
+    series = load_series(series_name)
+    if series is None:
+        color_print(f"No series named '{series_name}'. Create it with series-create first.", Fore.RED)
+        return None
     
-    # Skip for first chapter
-    if chapter_number <= 1:
-        return True, None
+    set_world_bible(format_world_bible(series))
+    color_print(f"Writing book {len(series['books']) + 1} of {series['name']} with a {estimate_tokens(world_bible)}-token world bible prefix", Fore.CYAN)
+    warm_up_slots()
     
-    prompt = f"""CONTINUITY CHECK:
-Compare the ending of the previous chapter with the beginning of the new chapter and identify any continuity issues:
+    resume_state = load_checkpoint(title) if resume else None
+    outputs = run_novel(title, author, theme, genre, min_words, resume_state=resume_state,
+                        output_dir=os.path.join(output_dir, title_slug(series['name'])))
+    if not outputs:
+        return None
+    
+    # The stored chapter summaries are enough to summarize the book without reading it again
+    chapter_store = ChapterStore(chapter_store_path(title))
+    summaries = []
+    for chapter_number, chapter_title, text in chapter_store.iter_chapters():
+        summary = chapter_store.artifact(chapter_number, "summary", artifact_key(text)) or summarize_chapter(text)
+        if summary:
+            summaries.append(f"Chapter {chapter_number}: {chapter_title}\n{summary}")
+    book_summary = summarize_book(title, "\n\n".join(summaries))
+    if book_summary:
+        series['books'] = [book for book in series['books'] if book['title'] != title]
+        series['books'].append({'title': title, 'summary': book_summary})
+        save_series(series)
+        color_print(f"Added '{title}' to the series as book {len(series['books'])}.", Fore.GREEN)
+    return outputs
+
+AUDIT_GRAMMAR = r'''
+root ::= "SCORE: " score "\nFIX: " ("yes" | "no") "\n" issue*
+score ::= [1-9] | "10"
+issue ::= "- " [^\n]+ "\n"
+'''
+
+# A heading starts its line, after the "# " or "## " marker of a Markdown-style export if there is one, so
+# that "Chapter 4" in the middle of a sentence is not taken for one; the marker belongs to the heading
+MANUSCRIPT_HEADING_PATTERN = re.compile(r'^((?:#{1,2}[ \t]+)?Chapter[ \t]+\d+(?:[: \t][^\n]*)?\n)', re.IGNORECASE | re.MULTILINE)
+HEADING_MARKER_PATTERN = re.compile(r'#*[ \t]*')
+MANUSCRIPT_TITLE_LINE_PATTERN = re.compile(r'\n\s*#[^\S\n]+[^\n]*\s*$')  # "# Title" the text export puts before the next heading
+
+def audit_boundary(previous_ending, new_beginning, chapter_number):
+    """Judge one chapter boundary; unlike verify_chapter_continuity, a failed check returns None instead of passing"""
+    prompt = f"""CONTINUITY AUDIT:
+Compare the ending of Chapter {chapter_number - 1} with the beginning of Chapter {chapter_number} and judge whether the new chapter continues directly and consistently from it.
 
 PREVIOUS CHAPTER ENDING:
 {previous_ending}
@@ -730,486 +4732,887 @@ PREVIOUS CHAPTER ENDING:
 NEW CHAPTER BEGINNING:
 {new_beginning}
 
-Return a single JSON object with these properties:
-1. "continuity_score": A number from 1-10, with 10 meaning perfect continuity
-2. "issues": An array of specific continuity issues found
-3. "fix_needed": Boolean indicating if the new chapter beginning needs to be rewritten
+Consider character locations, ongoing conversations, emotional states, time and logical story flow.
+Answer in exactly this format: a score from 1 to 10 (10 meaning perfect continuity), whether the beginning needs to be rewritten, and one line per specific issue.
 
-Be strict in your evaluation. Consider character locations, ongoing conversations, emotional states, and logical story flow.
+SCORE: <1-10>
+FIX: <yes or no>
+- <issue>
 """
-
+    
     try:
-        color_print("Verifying chapter continuity...", Fore.YELLOW)
-        
-        response = requests.post(
-            "http://localhost:8080/completion",
-            json={
-                "prompt": prompt,
-                "max_tokens": 1000,
-                "stream": False
-            }
-        )
-        
+        # The grammar holds the verdict to the format above on backends that support it
+        response = hedged_request(prompt, 400, "audit", grammar=AUDIT_GRAMMAR, temperature=0.2)
         if response.status_code != 200:
-            color_print(f"\nAPI Error during continuity verification: {response.status_code}", Fore.RED)
-            return True, None  # Return true to continue anyway
-            
-        result = response.json()
-        analysis = result.get('content', '')
-        
-        # Try to extract JSON from the response
-        try:
-            import json
-            # Find JSON-like content in the response
-            json_match = re.search(r'(\{.*\})', analysis, re.DOTALL)
-            if json_match:
-                continuity_data = json.loads(json_match.group(1))
-                score = continuity_data.get('continuity_score', 0)
-                issues = continuity_data.get('issues', [])
-                fix_needed = continuity_data.get('fix_needed', False)
-                
-                color_print(f"Continuity score: {score}/10", Fore.GREEN if score >= 7 else Fore.YELLOW)
-                
-                if issues:
-                    color_print("Continuity issues detected:", Fore.YELLOW)
-                    for issue in issues:
-                        color_print(f"- {issue}", Fore.YELLOW)
-                
-                return not fix_needed, issues if fix_needed else None
-            
-        except Exception as e:
-            color_print(f"Error parsing continuity check: {e}", Fore.RED)
-        
-        # Default to continuing if we can't parse the response
-        return True, None
-        
+            color_print(f"API Error auditing Chapter {chapter_number}: {response.status_code}", Fore.RED)
+            return None
+        text = response.json().get('content', '')
     except Exception as e:
-        color_print(f"Error during continuity verification: {e}", Fore.RED)
-        return True, None
+        color_print(f"Error auditing Chapter {chapter_number}: {e}", Fore.RED)
+        return None
+    
+    score = re.search(r'SCORE:\s*(\d+)', text)
+    fix = re.search(r'FIX:\s*(yes|no)', text, re.IGNORECASE)
+    if not score or not fix:
+        return None
+    issues = [line[2:].strip() for line in text[fix.end():].split("\n") if line.startswith("- ") and line[2:].strip()]
+    return {'score': max(1, min(10, int(score.group(1)))), 'fix_needed': fix.group(1).lower() == "yes", 'issues': issues}
 
-def summarize_chapter(chapter_content, max_tokens=1000):
-    """NovelGen by RFS11G: Generate a detailed summary of the chapter for context in subsequent chapters"""
+def split_manuscript(text):
+    """Split a manuscript at its chapter headings, keeping every character so it can be put back together
     
-    prompt = f"""Create a DETAILED summary of the following chapter that captures key elements needed for narrative continuity:
+    Returns the split parts (text before the first heading, then alternating heading and body) and one
+    entry per chapter with the index of its heading in the parts, the heading's Markdown marker, the
+    heading without it, its number, title and body without the book title line before the next heading.
+    """
+    parts = MANUSCRIPT_HEADING_PATTERN.split(text)
+    chapters = []
+    for index in range(1, len(parts), 2):
+        marker = HEADING_MARKER_PATTERN.match(parts[index]).group()
+        heading = parts[index][len(marker):]
+        match = re.match(r'Chapter\s+(\d+)[:\s]+(.*?)\s*$', heading, re.IGNORECASE | re.DOTALL)
+        body = MANUSCRIPT_TITLE_LINE_PATTERN.sub('', parts[index + 1])
+        chapters.append({'part': index, 'marker': marker, 'heading': heading, 'number': int(match.group(1)),
+                         'title': match.group(2), 'body': body})
+    return parts, chapters
 
-{chapter_content[:5000]}  # Only use the first part of the chapter to avoid token limits
+def audit_manuscript(path, fix=False, output_dir=None):
+    """Check every chapter boundary of a finished manuscript concurrently, write a ranked report and optionally repair
+    
+    Verdicts are kept in the report's JSON file under a hash of the two passages, so auditing the same
+    book again only checks the boundaries that changed.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manuscript = f.read()
+    except OSError as e:
+        color_print(f"Could not read {path}: {e}", Fore.RED)
+        return None
+    
+    parts, chapters = split_manuscript(manuscript)
+    if len(chapters) < 2:
+        color_print(f"Found {len(chapters)} chapter(s) in {path}; nothing to audit.", Fore.YELLOW)
+        return None
+    
+    output_dir = output_dir or os.path.dirname(os.path.abspath(path))
+    os.makedirs(output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(path))[0]
+    report_path = os.path.join(output_dir, f"{name}_audit.txt")
+    json_path = os.path.join(output_dir, f"{name}_audit.json")
+    
+    cached = {}
+    if os.path.exists(json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                cached = {entry['key']: entry['verdict'] for entry in json.load(f)['boundaries'] if entry['verdict']}
+        except (OSError, ValueError, KeyError):
+            cached = {}
+    
+    boundaries = []
+    for previous, chapter in zip(chapters, chapters[1:]):
+        ending = extract_chapter_ending(previous['body'].rstrip())
+        beginning = chapter_opening(chapter['body'].strip())
+        boundaries.append({'previous': previous, 'chapter': chapter, 'ending': ending, 'beginning': beginning,
+                           'key': artifact_key(ending, beginning)})
+    
+    pending = [boundary for boundary in boundaries if boundary['key'] not in cached]
+    color_print(f"\nAuditing {len(boundaries)} chapter boundaries in {path} ({len(boundaries) - len(pending)} cached)", Fore.CYAN)
+    started = time.time()
+    
+    # The backend pool limits how many checks really run at once; the threads only wait for slots
+    with ThreadPoolExecutor(max_workers=max(1, len(backend_pool.slots))) as executor:
+        verdicts = executor.map(lambda boundary: audit_boundary(boundary['ending'], boundary['beginning'], boundary['chapter']['number']), pending)
+        for boundary, verdict in zip(pending, verdicts):
+            cached[boundary['key']] = verdict
+    for boundary in boundaries:
+        boundary['verdict'] = cached.get(boundary['key'])
+    color_print(f"Checked {len(pending)} boundaries in {time.time() - started:.1f}s", Fore.GREEN)
+    
+    # Worst first: boundaries that need a fix, then by score; unchecked ones go last
+    checked = sorted((boundary for boundary in boundaries if boundary['verdict']),
+                     key=lambda boundary: (not boundary['verdict']['fix_needed'], boundary['verdict']['score']))
+    unchecked = [boundary for boundary in boundaries if not boundary['verdict']]
+    to_fix = [boundary for boundary in checked if boundary['verdict']['fix_needed']]
+    
+    fixed_path = None
+    if fix and to_fix:
+        color_print(f"Rewriting the beginnings of {len(to_fix)} chapters...", Fore.YELLOW)
+        
+        def repair(boundary):
+            chapter = boundary['chapter']
+            content = chapter['heading'] + chapter['body']
+            return fix_chapter_beginning(content, boundary['ending'], boundary['verdict']['issues'], chapter['number'], chapter['title'])
+        
+        # Repairs only touch chapter beginnings and read the original endings, so they are independent
+        with ThreadPoolExecutor(max_workers=max(1, len(backend_pool.slots))) as executor:
+            for boundary, content in zip(to_fix, executor.map(repair, to_fix)):
+                chapter = boundary['chapter']
+                if content != chapter['heading'] + chapter['body']:
+                    boundary['fixed'] = True
+                    parts[chapter['part'] + 1] = content + parts[chapter['part'] + 1][len(chapter['body']):]
+                    parts[chapter['part']] = chapter['marker']
+        fixed_path = os.path.join(output_dir, f"{name}_fixed.txt")
+        with open(fixed_path, 'w', encoding='utf-8') as f:
+            f.write("".join(parts))
+    
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write(f"Continuity audit of {path}\n")
+        f.write(f"{len(boundaries)} boundaries: {len(to_fix)} need a fix, {len(unchecked)} could not be checked\n\n")
+        for rank, boundary in enumerate(checked, 1):
+            verdict = boundary['verdict']
+            status = ("FIXED" if boundary.get('fixed') else "FIX") if verdict['fix_needed'] else "ok"
+            f.write(f"{rank:>3}. Chapter {boundary['previous']['number']} -> {boundary['chapter']['number']}: "
+                    f"{boundary['chapter']['title']}  score {verdict['score']}/10  {status}\n")
+            for issue in verdict['issues']:
+                f.write(f"       - {issue}\n")
+        for boundary in unchecked:
+            f.write(f"  ?  Chapter {boundary['previous']['number']} -> {boundary['chapter']['number']}: {boundary['chapter']['title']}  not checked\n")
+        if fixed_path:
+            f.write(f"\nRepaired manuscript: {fixed_path}\n")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({'manuscript': path, 'boundaries': [
+            {'previous': boundary['previous']['number'], 'chapter': boundary['chapter']['number'], 'key': boundary['key'],
+             'verdict': boundary['verdict'], 'fixed': boundary.get('fixed', False)}
+            for boundary in boundaries
+        ]}, f, indent=2)
+    
+    for boundary in checked[:5]:
+        verdict = boundary['verdict']
+        color_print(f"Chapter {boundary['previous']['number']} -> {boundary['chapter']['number']}: score {verdict['score']}/10"
+                    f"{' (needs a fix)' if verdict['fix_needed'] else ''}", Fore.YELLOW if verdict['fix_needed'] else Fore.GREEN)
+    color_print(f"Audit report written to {report_path}", Fore.GREEN)
+    if fixed_path:
+        color_print(f"Repaired manuscript written to {fixed_path}", Fore.GREEN)
+    return report_path
 
-Your summary MUST include:
-1. Character locations and states at the END of the chapter
-2. Ongoing conversations and unfinished plot points
-3. Emotional states and tensions between characters
-4. Setting details and time of day/period at chapter end
-5. Key revelations or plot developments that affect future chapters
+class NovelJob:
+    """A novel generation job submitted to the job server"""
+    
+    def __init__(self, params, output_dir):
+        self.id = uuid.uuid4().hex[:12]
+        self.params = params
+        self.output_dir = os.path.join(output_dir, self.id)
+        self.status = "queued"
+        self.created = time.time()
+        self.outputs = {}
+        self.error = None
+        self.events = []
+        self.condition = threading.Condition()
+    
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed")
+    
+    def add_event(self, event_type, data):
+        with self.condition:
+            self.events.append({"event": event_type, "data": data, "time": time.time()})
+            self.condition.notify_all()
+    
+    def set_status(self, status, **data):
+        self.status = status
+        self.add_event(status, data)
+    
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "params": self.params,
+            "created": self.created,
+            "files": sorted(self.outputs),
+            "error": self.error,
+            "events": len(self.events)
+        }
 
-Focus especially on the ENDING SCENE of the chapter, as this is critical for maintaining continuity.
-The summary should be comprehensive but no more than 500 words.
-"""
+class JobServer:
+    """Run submitted novel jobs on worker threads that share one backend pool and response cache"""
+    
+    def __init__(self, max_jobs=2, output_dir="novelgen_output/jobs"):
+        self.output_dir = output_dir
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+    
+    def submit(self, params):
+        job = NovelJob(params, self.output_dir)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.add_event("queued", {"title": params['title']})
+        self.executor.submit(self.run_job, job)
+        return job
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+    
+    def run_job(self, job):
+        job_context.job = job
+        job.set_status("running")
+        try:
+            outputs = run_novel(output_dir=job.output_dir, **job.params)
+            if outputs:
+                job.outputs = outputs
+                job.set_status("completed", files=sorted(outputs))
+            else:
+                job.error = "Novel generation failed"
+                job.set_status("failed", error=job.error)
+        except Exception as e:
+            job.error = str(e)
+            job.set_status("failed", error=job.error)
+        finally:
+            job_context.job = None
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
+def parse_job_params(body):
+    """Validate a job submission and fill in the same defaults as the interactive prompts"""
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object")
     try:
-        color_print("Generating chapter summary with continuity elements...", Fore.YELLOW)
-        
-        keep_alive_running = setup_keep_alive()
-        
-        response = requests.post(
-            "http://localhost:8080/completion",
-            json={
-                "prompt": prompt,
-                "max_tokens": max_tokens,
-                "stream": False
-            }
-        )
-        
-        cancel_keep_alive()
-        
-        if response.status_code != 200:
-            color_print(f"\nAPI Error: Status code {response.status_code}", Fore.RED)
-            return None
-            
-        result = response.json()
-        summary = result.get('content', '')
-        
-        color_print("Enhanced continuity summary generated.", Fore.GREEN)
-        return summary
-        
-    except requests.RequestException as e:
-        color_print(f"\nAPI Connection Error: {e}", Fore.RED)
-        cancel_keep_alive()
-        return None
-    except Exception as e:
-        color_print(f"\nUnexpected Error: {e}", Fore.RED)
-        cancel_keep_alive()
-        return None
+        min_words = int(body.get('min_words') or 2000)
+    except (TypeError, ValueError):
+        raise ValueError("min_words must be an integer")
+    return {
+        'title': str(body.get('title') or "The Generated Novel").strip(),
+        'author': str(body.get('author') or "AI Writer").strip(),
+        'theme': str(body.get('theme') or "").strip() or None,
+        'genre': str(body.get('genre') or "").strip() or None,
+        'min_words': min_words
+    }
 
-def generate_novel_chapters(title, story_plan, chapters_data, min_words_per_chapter=4000, max_tokens_per_chapter=8000):
-    """NovelGen by RFS11G: Generate a novel chapter by chapter with improved continuity between chapters"""
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """HTTP API of the job server
     
-    color_print(f"\nGenerating novel: {title}\n", Fore.CYAN)
-    color_print(f"Min words per chapter: {min_words_per_chapter}, Max tokens per chapter: {max_tokens_per_chapter}\n", Fore.YELLOW)
+    POST /jobs                      submit a job (JSON: title, author, theme, genre, min_words)
+    GET  /jobs                      list jobs
+    GET  /jobs/<id>                 job status
+    GET  /jobs/<id>/events          progress events as server-sent events
+    GET  /jobs/<id>/result.<ext>    download the txt or epub result (or plan.txt)
+    """
     
-    if not chapters_data:
-        color_print("No chapter data available. Attempting to extract chapter plans.", Fore.YELLOW)
-        chapters_data = extract_chapters(story_plan)
-        
-        if not chapters_data:
-            color_print("Failed to extract any usable chapter plans. Using basic structure.", Fore.RED)
-            # Create some basic chapters if extraction failed
-            chapters_data = []
-            for i in range(1, 6):  # Create 5 basic chapters
-                chapters_data.append({
-                    'number': i,
-                    'title': f"Chapter {i}",
-                    'description': f"Events from story plan section {i}"
-                })
+    server_version = "NovelGen"
+    job_server = None
+    
+    def log_message(self, format, *args):
+        color_print(f"[serve] {self.address_string()} {format % args}", Fore.BLUE)
     
-    color_print(f"Ready to generate {len(chapters_data)} chapters.", Fore.GREEN)
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
     
-    # Generate chapters sequentially
-    full_novel = ""
-    previous_chapters_summary = ""
-    previous_chapter_ending = None
+    def do_POST(self):
+        if self.path.rstrip('/') != "/jobs":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = parse_job_params(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, json.JSONDecodeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        job = self.job_server.submit(params)
+        self.send_json(202, job.to_dict())
     
-    for i, chapter in enumerate(chapters_data):
-        chapter_number = chapter['number']
-        chapter_title = chapter['title']
-        chapter_description = chapter['description']
-        
-        color_print(f"\nStarting generation of Chapter {chapter_number}/{len(chapters_data)}: {chapter_title}", Fore.CYAN)
-        
-        # Generate the chapter with continuity from previous chapter
-        chapter_content = generate_chapter(
-            chapter_title, 
-            chapter_description, 
-            chapter_number, 
-            previous_chapters_summary,
-            previous_chapter_ending,  # Pass the ending of the previous chapter
-            min_words_per_chapter,
-            max_tokens_per_chapter
-        )
-        
-        if not chapter_content:
-            color_print(f"Failed to generate Chapter {chapter_number}. Skipping.", Fore.RED)
-            continue
+    def do_GET(self):
+        parts = [part for part in self.path.split('?')[0].split('/') if part]
+        if parts == ["jobs"]:
+            self.send_json(200, {"jobs": self.job_server.list()})
+            return
+        if len(parts) < 2 or parts[0] != "jobs":
+            self.send_json(404, {"error": "Not found"})
+            return
         
-        # Check if chapter has proper header, if not, add it
-        if not re.match(r'^Chapter\s+\d+', chapter_content, re.IGNORECASE):
-            chapter_content = f"Chapter {chapter_number}: {chapter_title}\n\n{chapter_content}"
-            color_print("Added missing chapter header.", Fore.YELLOW)
-        
-        # Verify continuity with previous chapter if not the first chapter
-        if i > 0:
-            # Get first 1000 characters of current chapter (after removing header)
-            new_beginning = re.sub(r'^Chapter\s+\d+[:\s]+.*?\n\n', '', chapter_content[:1500], flags=re.IGNORECASE)
-            
-            continuity_ok, issues = verify_chapter_continuity(previous_chapter_ending, new_beginning, chapter_number)
-            
-            if not continuity_ok and issues:
-                color_print("Fixing continuity issues between chapters...", Fore.YELLOW)
-                chapter_content = fix_chapter_beginning(chapter_content, previous_chapter_ending, issues, chapter_number, chapter_title)
-        
-        # Add chapter to the novel with proper formatting
-        if i > 0:  # If this isn't the first chapter
-            # Add a proper scene break/transition marker
-            full_novel += "\n\n# " + chapter_title + "\n\n## " + f"Chapter {chapter_number}: {chapter_title}" + "\n\n"
-            # Add the chapter content without repeating the header that's already in the transition
-            chapter_content_without_header = re.sub(r'^Chapter\s+\d+[:\s]+.*?\n\n', '', chapter_content, flags=re.IGNORECASE)
-            full_novel += chapter_content_without_header
+        job = self.job_server.get(parts[1])
+        if job is None:
+            self.send_json(404, {"error": "Unknown job"})
+        elif len(parts) == 2:
+            self.send_json(200, job.to_dict())
+        elif parts[2] == "events":
+            self.stream_events(job)
+        elif parts[2] in ("result.txt", "result.epub", "plan.txt"):
+            self.send_result(job, parts[2])
         else:
-            # First chapter doesn't need the transition marker
-            full_novel += chapter_content
+            self.send_json(404, {"error": "Not found"})
+    
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
         
-        # Save progress after each chapter
+        index = 0
         try:
-            progress_dir = "novelgen_progress"
-            if not os.path.exists(progress_dir):
-                os.makedirs(progress_dir)
-            
-            progress_filename = os.path.join(progress_dir, f"{title.replace(' ', '_').lower()}_progress.txt")
-            with open(progress_filename, 'w', encoding='utf-8') as f:
-                f.write(full_novel)
-            color_print(f"Progress saved to {progress_filename}", Fore.GREEN)
-        except Exception as e:
-            color_print(f"Warning: Could not save progress: {e}", Fore.YELLOW)
-        
-        # Store the ending of the current chapter for continuity in the next chapter
-        chapter_ending_match = re.search(r'(?:.*\n){1,20}$', chapter_content, re.DOTALL)
-        if chapter_ending_match:
-            previous_chapter_ending = chapter_ending_match.group(0)
-        else:
-            # If regex fails, just take the last 1000 characters
-            previous_chapter_ending = chapter_content[-1000:] if len(chapter_content) > 1000 else chapter_content
-        
-        # Create a detailed summary for context in subsequent chapters
-        if i < len(chapters_data) - 1:  # Don't need a summary for the last chapter
-            summary = summarize_chapter(chapter_content)
-            if summary:
-                previous_chapters_summary += f"Chapter {chapter_number}: {summary}\n\n"
+            while True:
+                with job.condition:
+                    if index >= len(job.events) and not job.finished:
+                        job.condition.wait(15)
+                    events = job.events[index:]
+                    finished = job.finished
+                index += len(events)
+                
+                if events:
+                    for event in events:
+                        self.wfile.write(f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n".encode('utf-8'))
+                else:
+                    # Comment line so proxies and clients keep the connection open
+                    self.wfile.write(b": keep-alive\n\n")
+                self.wfile.flush()
+                
+                if finished and index >= len(job.events):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
+    def send_result(self, job, name):
+        key, content_type = {
+            "result.txt": ('txt', "text/plain; charset=utf-8"),
+            "result.epub": ('epub', "application/epub+zip"),
+            "plan.txt": ('plan', "text/plain; charset=utf-8")
+        }[name]
+        path = job.outputs.get(key)
+        if not path or not os.path.exists(path):
+            self.send_json(404 if job.finished else 409, {"error": f"{name} is not available", "status": job.status})
+            return
         
-        # Force garbage collection to free up memory
-        gc_attempt = "Attempted garbage collection" 
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+def serve(host="127.0.0.1", port=8765, max_jobs=2):
+    """Run the local job server until interrupted"""
+    job_server = JobServer(max_jobs)
+    JobRequestHandler.job_server = job_server
+    httpd = ThreadingHTTPServer((host, port), JobRequestHandler)
+    httpd.daemon_threads = True
+    
+    color_print(f"NovelGen job server listening on http://{host}:{port} ({max_jobs} concurrent jobs)", Fore.GREEN)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        job_server.shutdown()
+        print_telemetry()
+
+WORK_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS work_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    job_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    deps TEXT NOT NULL DEFAULT '[]',
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS work_items_status ON work_items (status, id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (job_id, name)
+);
+"""
+
+class WorkQueue:
+    """Shared SQLite queue of pipeline work items with lease and heartbeat semantics
+    
+    Worker processes, possibly on different hosts sharing the database file, claim items
+    whose dependencies are done. A claimed item is leased for a limited time and the worker
+    keeps extending the lease while it works; an item whose lease runs out is handed to
+    another worker.
+    """
+    
+    def __init__(self, path, lease_seconds=None):
+        self.path = path
+        self.lease_seconds = lease_seconds or QUEUE_LEASE_SECONDS
+        self.conn = self.connect()
+        self.conn.executescript(WORK_QUEUE_SCHEMA)
+    
+    def connect(self):
+        # Autocommit mode; writes use explicit BEGIN IMMEDIATE transactions
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    @contextmanager
+    def transaction(self, conn=None):
+        conn = conn or self.conn
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            gc.collect()
-            gc_attempt = "Successfully ran garbage collection"
-        except:
-            pass
-                
-        color_print(f"\n{gc_attempt} to free memory", Fore.CYAN)
-        color_print(f"Completed Chapter {chapter_number}/{len(chapters_data)}\n", Fore.GREEN)
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
     
-    # Apply deduplication to remove any duplicate chapters
+    def add_item(self, conn, job_id, kind, number, deps=()):
+        conn.execute(
+            "INSERT OR IGNORE INTO work_items (key, job_id, kind, number, deps, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (f"{job_id}:{kind}:{number}", job_id, kind, number, json.dumps([f"{job_id}:{dep}" for dep in deps]), time.time())
+        )
+    
+    def submit_job(self, params):
+        """Queue a new novel and return its job id"""
+        job_id = uuid.uuid4().hex[:12]
+        params = dict(params)
+        params.setdefault('output_dir', os.path.join("novelgen_output", "queue", job_id))
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO jobs (id, params, created) VALUES (?, ?, ?)", (job_id, json.dumps(params), time.time()))
+            self.add_item(conn, job_id, "plan", 0)
+        return job_id
+    
+    def claim(self, worker_id):
+        """Lease the oldest item that is ready to run, or return None"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                """
+                SELECT w.* FROM work_items w JOIN jobs j ON j.id = w.job_id
+                WHERE j.status = 'running'
+                  AND (w.status = 'pending' OR (w.status = 'leased' AND w.lease_expires < ?))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM json_each(w.deps) d LEFT JOIN work_items x ON x.key = d.value
+                      WHERE x.status IS NOT 'done'
+                  )
+                ORDER BY j.created, w.id
+                LIMIT 1
+                """,
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row['status'] == 'leased':
+                color_print(f"Reclaiming {row['key']} from {row['lease_owner']} (lease expired)", Fore.YELLOW)
+            conn.execute(
+                "UPDATE work_items SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker_id, now + self.lease_seconds, now, row['id'])
+            )
+        item = dict(row)
+        item['attempts'] += 1
+        return item
+    
+    def heartbeat(self, item, worker_id, conn=None):
+        """Extend a lease; returns False if the lease has been lost to another worker"""
+        conn = conn or self.conn
+        with self.transaction(conn):
+            cursor = conn.execute(
+                "UPDATE work_items SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, item['id'], worker_id)
+            )
+        return cursor.rowcount == 1
+    
+    def complete(self, item, worker_id, artifacts=None, new_items=(), job_status=None):
+        """Store an item's results and mark it done, unless its lease was lost meanwhile"""
+        job_id = item['job_id']
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE work_items SET status = 'done', lease_owner = NULL, lease_expires = NULL, error = NULL, updated = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (time.time(), item['id'], worker_id)
+            )
+            if cursor.rowcount != 1:
+                return False
+            for name, value in (artifacts or {}).items():
+                conn.execute("INSERT OR REPLACE INTO artifacts (job_id, name, value) VALUES (?, ?, ?)", (job_id, name, value))
+            for kind, number, deps in new_items:
+                self.add_item(conn, job_id, kind, number, deps)
+            if job_status:
+                conn.execute("UPDATE jobs SET status = ? WHERE id = ?", (job_status, job_id))
+        return True
+    
+    def fail(self, item, worker_id, error):
+        """Release a failed item for a retry, or fail the whole job once it runs out of attempts"""
+        give_up = item['attempts'] >= QUEUE_MAX_ATTEMPTS
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE work_items SET status = ?, lease_owner = NULL, lease_expires = NULL, error = ?, updated = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                ('failed' if give_up else 'pending', error, time.time(), item['id'], worker_id)
+            )
+            if give_up:
+                conn.execute("UPDATE jobs SET status = 'failed' WHERE id = ?", (item['job_id'],))
+    
+    def job_params(self, job_id):
+        row = self.conn.execute("SELECT params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row['params']) if row else None
+    
+    def artifact(self, job_id, name, default=None):
+        row = self.conn.execute("SELECT value FROM artifacts WHERE job_id = ? AND name = ?", (job_id, name)).fetchone()
+        return row['value'] if row else default
+    
+    def has_open_work(self):
+        row = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()
+        return row[0] > 0
+    
+    def status(self):
+        """Return each job with its item counts by status"""
+        jobs = []
+        for job in self.conn.execute("SELECT * FROM jobs ORDER BY created"):
+            counts = dict(self.conn.execute(
+                "SELECT status, COUNT(*) FROM work_items WHERE job_id = ? GROUP BY status", (job['id'],)
+            ).fetchall())
+            jobs.append({"id": job['id'], "status": job['status'], "title": json.loads(job['params']).get('title'), "items": counts})
+        return jobs
+
+def plan_work_items(chapter_count):
+    """Work items that follow the plan, with the same dependencies as generate_novel_chapters"""
+    items = []
+    for number in range(1, chapter_count + 1):
+        # Each chapter needs the summary (and so the continuity-checked text) of the one before it
+        items.append(("chapter", number, ["plan:0"] if number == 1 else [f"summary:{number - 1}"]))
+        if number > 1:
+            # Continuity of the boundary between chapter number - 1 and chapter number
+            items.append(("continuity", number, [f"chapter:{number}"]))
+        final_text = f"continuity:{number}" if number > 1 else f"chapter:{number}"
+        if number < chapter_count:
+            items.append(("summary", number, [final_text]))
+    items.append(("export", 0, [f"continuity:{chapter_count}" if chapter_count > 1 else "chapter:1"]))
+    return items
+
+def handle_plan_item(queue, item, params):
+    story_plan, chapters_data = get_story_plan_with_chapters(params['title'], params.get('theme'), params.get('genre'))
+    if not story_plan:
+        raise RuntimeError("Failed to generate story plan")
+    artifacts = {"plan": story_plan, "chapters": json.dumps(chapters_data)}
+    return artifacts, plan_work_items(len(chapters_data)), None
+
+def handle_chapter_item(queue, item, params):
+    job_id, number = item['job_id'], item['number']
+    chapter = json.loads(queue.artifact(job_id, "chapters"))[number - 1]
+    previous_chapters_summary = ""
+    for previous in range(1, number):
+        summary = queue.artifact(job_id, f"summary:{previous}")
+        if summary:
+            previous_chapters_summary += f"Chapter {previous}: {summary}\n\n"
+    
+    chapter_content = generate_chapter(
+        chapter['title'],
+        chapter['description'],
+        number,
+        previous_chapters_summary,
+        queue.artifact(job_id, f"ending:{number - 1}"),
+        params.get('min_words', 2000)
+    )
+    if not chapter_content:
+        raise RuntimeError(f"Failed to generate Chapter {number}")
+    chapter_content = ensure_chapter_header(chapter_content, number, chapter['title'])
+    return {f"chapter:{number}": chapter_content, f"ending:{number}": extract_chapter_ending(chapter_content)}, [], None
+
+def handle_continuity_item(queue, item, params):
+    job_id, number = item['job_id'], item['number']
+    chapter = json.loads(queue.artifact(job_id, "chapters"))[number - 1]
+    chapter_content = check_and_fix_continuity(
+        queue.artifact(job_id, f"chapter:{number}"),
+        queue.artifact(job_id, f"ending:{number - 1}"),
+        number,
+        chapter['title']
+    )
+    return {f"chapter:{number}": chapter_content}, [], None
+
+def handle_summary_item(queue, item, params):
+    number = item['number']
+    summary = summarize_chapter(queue.artifact(item['job_id'], f"chapter:{number}"))
+    # A missing summary only weakens context for later chapters, as in the single-process pipeline
+    return {f"summary:{number}": summary or ""}, [], None
+
+def handle_export_item(queue, item, params):
+    job_id = item['job_id']
+    chapters_data = json.loads(queue.artifact(job_id, "chapters"))
+    full_novel = ""
+    for index, chapter in enumerate(chapters_data):
+        chapter_content = queue.artifact(job_id, f"chapter:{index + 1}")
+        if chapter_content:
+            full_novel = append_chapter(full_novel, chapter_content, index + 1, chapter['title'], first=(index == 0))
     full_novel = deduplicate_chapters(full_novel)
     
-    return full_novel
+    outputs = export_novel(params['title'], params.get('author') or "AI Writer", queue.artifact(job_id, "plan"), full_novel, params['output_dir'])
+    if 'txt' not in outputs:
+        raise RuntimeError("Failed to write the novel")
+    return {f"output:{kind}": path for kind, path in outputs.items()}, [], "completed"
 
-def create_epub(title, author, story_plan, full_novel, output_filename=None):
-    """Create an EPUB file from the generated novel and story plan"""
+WORK_ITEM_HANDLERS = {
+    "plan": handle_plan_item,
+    "chapter": handle_chapter_item,
+    "continuity": handle_continuity_item,
+    "summary": handle_summary_item,
+    "export": handle_export_item
+}
+
+def run_work_item(queue, item, worker_id):
+    """Run one leased item while a heartbeat thread keeps its lease alive"""
+    color_print(f"\n[{worker_id}] Running {item['key']} (attempt {item['attempts']})", Fore.CYAN)
+    stop_heartbeat = threading.Event()
+    lease_lost = threading.Event()
     
-    output_dir = "novelgen_output"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    if not output_filename:
-        output_filename = os.path.join(output_dir, f"{title.replace(' ', '_').lower()}.epub")
+    def heartbeat():
+        conn = queue.connect()
+        try:
+            while not stop_heartbeat.wait(queue.lease_seconds / 3):
+                if not queue.heartbeat(item, worker_id, conn):
+                    lease_lost.set()
+                    break
+        except sqlite3.Error as e:
+            color_print(f"Heartbeat error: {e}", Fore.YELLOW)
+        finally:
+            conn.close()
     
-    color_print(f"\nCreating EPUB file: {output_filename}", Fore.CYAN)
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        params = queue.job_params(item['job_id'])
+        artifacts, new_items, job_status = WORK_ITEM_HANDLERS[item['kind']](queue, item, params)
+    except Exception as e:
+        stop_heartbeat.set()
+        color_print(f"[{worker_id}] {item['key']} failed: {e}", Fore.RED)
+        queue.fail(item, worker_id, str(e))
+        return False
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
     
-    # First deduplicate chapters to ensure clean content
-    full_novel = deduplicate_chapters(full_novel)
+    if lease_lost.is_set() or not queue.complete(item, worker_id, artifacts, new_items, job_status):
+        color_print(f"[{worker_id}] Lease on {item['key']} was lost; discarding the result.", Fore.YELLOW)
+        return False
     
-    # Create a new EPUB book
-    book = epub.EpubBook()
+    color_print(f"[{worker_id}] Completed {item['key']}", Fore.GREEN)
+    return True
+
+def run_worker(queue_path, worker_id=None, poll_interval=2.0, exit_when_idle=False, lease_seconds=None):
+    """Claim and run work items from a shared queue until interrupted"""
+    queue = WorkQueue(queue_path, lease_seconds)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    color_print(f"Worker {worker_id} polling {queue_path}", Fore.GREEN)
     
-    # Set metadata
-    book.set_identifier(f"novel-{int(time.time())}")
-    book.set_title(title)
-    book.set_language('en')
-    book.add_author(author)
+    while not shutdown_requested.is_set():
+        item = queue.claim(worker_id)
+        if item is None:
+            if exit_when_idle and not queue.has_open_work():
+                color_print(f"Worker {worker_id}: no open jobs left, exiting.", Fore.GREEN)
+                break
+            time.sleep(poll_interval)
+            continue
+        run_work_item(queue, item, worker_id)
+
+class MockBackendHandler(BaseHTTPRequestHandler):
+    """Minimal llama.cpp-style completion server with canned output, for testing without a model"""
     
-    # Add CSS
-    style = """
-    @namespace epub "http://www.idpf.org/2007/ops";
-    body {
-        font-family: Cambria, Liberation Serif, Bitstream Vera Serif, Georgia, Times, Times New Roman, serif;
-        margin: 5%;
-        text-align: justify;
-    }
-    h1, h2 {
-        text-align: center;
-        page-break-before: always;
-    }
-    .title {
-        margin-top: 20%;
-        text-align: center;
-    }
-    .chapter {
-        margin-top: 10%;
-        page-break-before: always;
+    protocol_version = "HTTP/1.1"
+    token_delay = 0.0
+    words = ("the", "night", "rain", "Mara", "opened", "door", "quietly", "and", "looked", "toward", "harbor",
+             "where", "Tomas", "waited", "with", "lantern", "while", "wind", "carried", "distant", "bells")
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def send_body(self, data, content_type="application/json"):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        self.send_body({"status": "ok", "total_slots": SLOTS_PER_BACKEND, "default_generation_settings": {"n_ctx": 8192}})
+    
+    def canned_text(self, prompt, max_tokens):
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')))
+        if "CONTINUITY CHECK" in prompt:
+            return ['{"continuity_score": 8, "issues": [], "fix_needed": false}']
+        if "CONTINUITY AUDIT" in prompt:
+            score = rng.randint(3, 10)
+            return [f"SCORE: {score}\nFIX: {'yes' if score < 6 else 'no'}\n"] + ([f"- Mara is at the {rng.choice(self.words)} instead\n"] if score < 8 else [])
+        if "CHAPTER BREAKDOWN" in prompt:
+            text = "1. PREMISE: A mock story.\n\n7. DETAILED CHAPTER BREAKDOWN:\n\n"
+            for number in range(1, 6):
+                text += f"Chapter {number}: Mock Title {number}\n" + " ".join(rng.choice(self.words) for _ in range(30)) + ".\n\n"
+            return [word + " " for word in text.split(" ")]
+        tokens = []
+        for index in range(max_tokens):
+            tokens.append(rng.choice(self.words) + (". " if index % 12 == 11 else " "))
+        return tokens
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip('/') == "/tokenize":
+            self.send_body({"tokens": list(range(estimate_tokens(request.get('content', ""))))})
+            return
+        max_tokens = request.get('n_predict', request.get('max_tokens', 256))
+        tokens = self.canned_text(request.get('prompt', ""), min(max_tokens if max_tokens and max_tokens > 0 else 256, 2000))
+        
+        if not request.get('stream'):
+            self.send_body({"content": "".join(tokens), "stop": True})
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for token in tokens:
+                self.wfile.write(f"data: {json.dumps({'content': token, 'stop': False})}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                if self.token_delay:
+                    time.sleep(self.token_delay)
+            self.wfile.write(f"data: {json.dumps({'content': '', 'stop': True})}\n\n".encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+def run_mock_backend(host="127.0.0.1", port=8080, token_delay=0.0):
+    MockBackendHandler.token_delay = token_delay
+    httpd = ThreadingHTTPServer((host, port), MockBackendHandler)
+    httpd.daemon_threads = True
+    color_print(f"Mock backend listening on http://{host}:{port}/completion", Fore.GREEN)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+def bench_text(size=4000000, repeat=5, scale=4):
+    """Time the text utilities on adversarial inputs at two sizes and flag any that grow faster than linearly"""
+    inputs = {
+        "no newlines": lambda n: "word " * (n // 5),
+        "one long line": lambda n: "x" * n + "\nlast line",
+        "short lines": lambda n: "a short line\n" * (n // 13),
+        "paragraphs": lambda n: ("The rain fell. " * 40 + "\n\n") * (n // 602),
+        "header whitespace": lambda n: "Chapter 1" + " " * n + "text",
+        "header lines": lambda n: "Chapter 9: \n" * (n // 12),
     }
-    p {
-        text-indent: 1em;
-        margin-top: 0.5em;
-        margin-bottom: 0.5em;
+    utilities = {
+        "chapter_body_start": chapter_body_start,
+        "chapter_opening": chapter_opening,
+        "split_paragraphs": split_paragraphs,
+        "paragraphs_html": paragraphs_html,
     }
-    """
     
-    css = epub.EpubItem(
-        uid="style_default",
-        file_name="style/default.css",
-        media_type="text/css",
-        content=style
-    )
-    book.add_item(css)
+    def best_time(function, text):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function(text)
+            times.append(time.perf_counter() - started)
+        return min(times)
     
-    # Create title page
-    title_page = epub.EpubHtml(title='Title Page', file_name='title_page.xhtml', lang='en')
-    title_page.content = f"""
-    <html>
-    <head>
-        <title>{html.escape(title)}</title>
-        <link rel="stylesheet" href="style/default.css" type="text/css" />
-    </head>
-    <body>
-        <div class="title">
-            <h1>{html.escape(title)}</h1>
-            <h3>By {html.escape(author)}</h3>
-            <p>Generated: {datetime.now().strftime('%Y-%m-%d')}</p>
-            <p>Created with NovelGen by RFS11G</p>
-        </div>
-    </body>
-    </html>
-    """
-    book.add_item(title_page)
+    # Linear work grows about scale-fold and quadratic work scale squared; growth is flagged once it is
+    # closer to quadratic. Both sizes are well past the CPU caches, so cache misses do not count as growth
+    linear = True
+    bound = (scale + scale ** 2) / 2
+    color_print(f"{'utility':<20} {'input':<18} {'ms':>9} {f'ms at {scale}x':>9} {'growth':>7}", Fore.CYAN)
+    for input_name, make in inputs.items():
+        small, large = make(size), make(size * scale)
+        for utility_name, function in utilities.items():
+            small_time, large_time = best_time(function, small), best_time(function, large)
+            growth = large_time / max(small_time, 1e-6)
+            within = growth <= bound or large_time < 0.001
+            linear = linear and within
+            color_print(f"{utility_name:<20} {input_name:<18} {small_time * 1000:>9.3f} {large_time * 1000:>9.3f} {growth:>6.1f}x",
+                        Fore.GREEN if within else Fore.RED)
+    return linear
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="NovelGen by RFS11G")
+    parser.add_argument("--profile", action="store_true", help="Time each pipeline stage and write a profile report on exit")
+    parser.add_argument("--profile-mode", choices=("timing", "cprofile", "tracemalloc"), default="timing",
+                        help="Add cProfile function statistics or tracemalloc allocation sizes to the stage timings")
+    parser.add_argument("--profile-dir", default="novelgen_profile", help="Where the profile report is written (default: novelgen_profile)")
+    subparsers = parser.add_subparsers(dest="command")
     
-    # Create story plan page
-    plan_page = epub.EpubHtml(title='Story Plan', file_name='story_plan.xhtml', lang='en')
+    serve_parser = subparsers.add_parser("serve", help="Run a local HTTP job server")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    serve_parser.add_argument("--max-jobs", type=int, default=2, help="Number of novels generated at the same time (default: 2)")
     
-    # Process story plan to proper HTML
-    story_plan_html = html.escape(story_plan)
-    story_plan_html = story_plan_html.replace('\n', '<br/>')
+    submit_parser = subparsers.add_parser("submit", help="Queue a novel on a shared work queue")
+    submit_parser.add_argument("--queue", required=True, help="Path of the shared SQLite queue")
+    submit_parser.add_argument("--title", required=True)
+    submit_parser.add_argument("--author", default="AI Writer")
+    submit_parser.add_argument("--theme")
+    submit_parser.add_argument("--genre")
+    submit_parser.add_argument("--min-words", type=int, default=2000)
+    submit_parser.add_argument("--output-dir", help="Where the export step writes the novel (default: novelgen_output/queue/<job id>)")
     
-    plan_page.content = f"""
-    <html>
-    <head>
-        <title>Story Plan</title>
-        <link rel="stylesheet" href="style/default.css" type="text/css" />
-    </head>
-    <body>
-        <h1>Story Plan</h1>
-        <div>
-            {story_plan_html}
-        </div>
-    </body>
-    </html>
-    """
-    book.add_item(plan_page)
+    worker_parser = subparsers.add_parser("worker", help="Run work items from a shared work queue")
+    worker_parser.add_argument("--queue", required=True, help="Path of the shared SQLite queue")
+    worker_parser.add_argument("--worker-id", help="Name of this worker (default: host-pid)")
+    worker_parser.add_argument("--poll-interval", type=float, default=2.0)
+    worker_parser.add_argument("--lease", type=float, help=f"Lease length in seconds (default: {QUEUE_LEASE_SECONDS:g})")
+    worker_parser.add_argument("--exit-when-idle", action="store_true", help="Exit once no queued novel is still running")
     
-    # Extract chapters and add them to the book
-    chapters = []
-    toc = []
+    status_parser = subparsers.add_parser("queue-status", help="Show the jobs on a shared work queue")
+    status_parser.add_argument("--queue", required=True, help="Path of the shared SQLite queue")
     
-    # Parse and split the novel into chapters using improved pattern
-    chapter_pattern = re.compile(r'(Chapter\s+\d+[:\s]+.*?\n)', re.IGNORECASE)
-    chapter_splits = chapter_pattern.split(full_novel)
+    subparsers.add_parser("probe", help="Show the API and capabilities of each configured backend")
     
-    if len(chapter_splits) <= 1:
-        # Fallback if no chapters found
-        color_print("No chapter divisions found. Treating novel as single chapter.", Fore.YELLOW)
-        ch = epub.EpubHtml(title='Chapter 1', file_name='chapter_1.xhtml', lang='en')
-        ch.content = f"""
-        <html>
-        <head>
-            <title>Chapter 1</title>
-            <link rel="stylesheet" href="style/default.css" type="text/css" />
-        </head>
-        <body>
-            <div class="chapter">
-                <h2>Chapter 1</h2>
-                <div>
-                    {html.escape(full_novel).replace('\n\n', '</p><p>').replace('\n', '<br/>')}
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        book.add_item(ch)
-        chapters.append(ch)
-        toc.append(epub.Link('chapter_1.xhtml', 'Chapter 1', 'chapter1'))
-    else:
-        # Process each chapter with improved handling
-        current_chapter_title = "Introduction"
-        current_chapter_content = ""
-        chapter_count = 0
-        
-        for i, section in enumerate(chapter_splits):
-            if i == 0 and section.strip():  # Prologue or intro before Chapter 1
-                current_chapter_content = section
-                continue
-                
-            if section.strip() and chapter_pattern.match(section):
-                # This is a chapter header
-                
-                # Save the previous chapter if there is content
-                if current_chapter_content.strip():
-                    chapter_count += 1
-                    ch_filename = f'chapter_{chapter_count}.xhtml'
-                    ch = epub.EpubHtml(title=current_chapter_title, file_name=ch_filename, lang='en')
-                    
-                    # Convert newlines to proper HTML paragraphs
-                    processed_content = current_chapter_content.strip()
-                    processed_content = html.escape(processed_content)
-                    processed_content = re.sub(r'\n\s*\n', '</p><p>', processed_content)
-                    processed_content = processed_content.replace('\n', '<br/>')
-                    processed_content = f"<p>{processed_content}</p>"
-                    
-                    ch.content = f"""
-                    <html>
-                    <head>
-                        <title>{html.escape(current_chapter_title)}</title>
-                        <link rel="stylesheet" href="style/default.css" type="text/css" />
-                    </head>
-                    <body>
-                        <div class="chapter">
-                            <h2>{html.escape(current_chapter_title)}</h2>
-                            <div>
-                                {processed_content}
-                            </div>
-                        </div>
-                    </body>
-                    </html>
-                    """
-                    book.add_item(ch)
-                    chapters.append(ch)
-                    toc.append(epub.Link(ch_filename, current_chapter_title, f'chapter{chapter_count}'))
-                
-                # Extract the new chapter title with improved pattern
-                title_match = re.search(r'Chapter\s+\d+[:\s]+(.*?)\n', section, re.IGNORECASE)
-                if title_match:
-                    current_chapter_title = title_match.group(0).strip()
-                else:
-                    current_chapter_title = f"Chapter {chapter_count+1}"
-                
-                current_chapter_content = ""
-            else:
-                # Add to current chapter content
-                current_chapter_content += section
-        
-        # Add the final chapter
-        if current_chapter_content.strip():
-            chapter_count += 1
-            ch_filename = f'chapter_{chapter_count}.xhtml'
-            ch = epub.EpubHtml(title=current_chapter_title, file_name=ch_filename, lang='en')
-            
-            # Convert newlines to proper HTML paragraphs
-            processed_content = current_chapter_content.strip()
-            processed_content = html.escape(processed_content)
-            processed_content = re.sub(r'\n\s*\n', '</p><p>', processed_content)
-            processed_content = processed_content.replace('\n', '<br/>')
-            processed_content = f"<p>{processed_content}</p>"
-            
-            ch.content = f"""
-            <html>
-            <head>
-                <title>{html.escape(current_chapter_title)}</title>
-                <link rel="stylesheet" href="style/default.css" type="text/css" />
-            </head>
-            <body>
-                <div class="chapter">
-                    <h2>{html.escape(current_chapter_title)}</h2>
-                    <div>
-                        {processed_content}
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            book.add_item(ch)
-            chapters.append(ch)
-            toc.append(epub.Link(ch_filename, current_chapter_title, f'chapter{chapter_count}'))
+    series_create_parser = subparsers.add_parser("series-create", help="Build and store the world bible for a new series")
+    series_create_parser.add_argument("--name", required=True, help="Name of the series")
+    series_create_parser.add_argument("--premise", default="", help="What the series is about")
+    series_create_parser.add_argument("--theme")
+    series_create_parser.add_argument("--genre")
+    series_create_parser.add_argument("--bible-file", help="Use this text file as the world bible instead of generating one")
     
-    # Add table of contents
-    book.toc = [
-        epub.Link('title_page.xhtml', 'Title Page', 'title'),
-        epub.Link('story_plan.xhtml', 'Story Plan', 'story_plan'),
-        (
-            epub.Section('Chapters'),
-            toc
-        )
-    ]
+    series_book_parser = subparsers.add_parser("series-book", help="Write the next book of a series")
+    series_book_parser.add_argument("--name", required=True, help="Name of the series")
+    series_book_parser.add_argument("--title", required=True)
+    series_book_parser.add_argument("--author", default="AI Writer")
+    series_book_parser.add_argument("--theme")
+    series_book_parser.add_argument("--genre")
+    series_book_parser.add_argument("--min-words", type=int, default=2000)
+    series_book_parser.add_argument("--resume", action="store_true", help="Continue from this book's checkpoint, if there is one")
+    series_book_parser.add_argument("--output-dir", default="novelgen_output", help="Books are written to <output dir>/<series>/")
     
-    # Add navigation files
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
+    regenerate_parser = subparsers.add_parser("regenerate", help="Rewrite chapters of a generated novel and export it again")
+    regenerate_parser.add_argument("--title", required=True, help="Title of the novel, as entered when it was generated")
+    regenerate_parser.add_argument("--chapters", type=int, nargs="+", required=True, help="Numbers of the chapters to rewrite")
+    regenerate_parser.add_argument("--author", default="AI Writer")
+    regenerate_parser.add_argument("--output-dir", default="novelgen_output")
     
-    # Define book spine
-    book.spine = ['nav', title_page, plan_page] + chapters
+    export_parser = subparsers.add_parser("export", help="Export stored novels again, in every requested format")
+    export_parser.add_argument("--title", required=True, nargs="+", help="Titles of the novels, as entered when they were generated")
+    export_parser.add_argument("--formats", default=",".join(EXPORT_FORMATS), help="Comma-separated formats: txt, epub, md, html (default: NOVELGEN_EXPORT_FORMATS)")
+    export_parser.add_argument("--author", default="AI Writer")
+    export_parser.add_argument("--workers", type=int, help="Export worker processes (default: NOVELGEN_EXPORT_WORKERS)")
+    export_parser.add_argument("--output-dir", default="novelgen_output")
     
-    # Write the EPUB file
-    try:
-        epub.write_epub(output_filename, book, {})
-        color_print(f"EPUB file created successfully: {output_filename}", Fore.GREEN)
-        return output_filename
-    except Exception as e:
-        color_print(f"Error creating EPUB file: {e}", Fore.RED)
-        return None
+    audit_parser = subparsers.add_parser("audit", help="Check every chapter boundary of a finished manuscript and rank the problems")
+    audit_parser.add_argument("manuscript", help="Text file of the novel, e.g. novelgen_output/my_novel.txt")
+    audit_parser.add_argument("--fix", action="store_true", help="Rewrite the beginnings that need it and write <name>_fixed.txt")
+    audit_parser.add_argument("--output-dir", help="Where the report goes (default: next to the manuscript)")
+    
+    bench_parser = subparsers.add_parser("bench-text", help="Time the chapter text utilities on adversarial inputs")
+    bench_parser.add_argument("--size", type=int, default=4000000, help="Characters in each input (default: 4000000)")
+    bench_parser.add_argument("--scale", type=int, default=4, help="Each input is also timed at this many times its size (default: 4)")
+    bench_parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement, the fastest is reported (default: 5)")
+    
+    mock_parser = subparsers.add_parser("mock-backend", help="Run a canned llama.cpp-style backend for testing")
+    mock_parser.add_argument("--host", default="127.0.0.1")
+    mock_parser.add_argument("--port", type=int, default=8080)
+    mock_parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed tokens")
+    
+    return parser.parse_args(argv)
 
 def main():
     """Main function to run the NovelGen by RFS11G application"""
@@ -1239,54 +5642,27 @@ def main():
     except ValueError:
         color_print(f"Invalid input. Using default: {min_words} words per chapter", Fore.YELLOW)
     
-    # Generate story plan with retry logic
-    color_print("\nGenerating story plan...", Fore.CYAN)
-    story_plan, chapters_data = get_story_plan_with_chapters(title, theme, genre)
-    
-    if not story_plan:
-        color_print("Failed to generate story plan. Exiting.", Fore.RED)
-        return
-    
-    # Save story plan
-    try:
-        output_dir = "novelgen_output"
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-            
-        plan_filename = os.path.join(output_dir, f"{title.replace(' ', '_').lower()}_plan.txt")
-        with open(plan_filename, 'w', encoding='utf-8') as f:
-            f.write(story_plan)
-        color_print(f"Story plan saved to {plan_filename}", Fore.GREEN)
-    except Exception as e:
-        color_print(f"Warning: Could not save story plan: {e}", Fore.YELLOW)
-    
-    # Generate novel
-    full_novel = generate_novel_chapters(title, story_plan, chapters_data, min_words)
-    
-    if not full_novel:
-        color_print("Failed to generate novel. Exiting.", Fore.RED)
-        return
-    
-    # Save the full novel text
-    try:
-        output_dir = "novelgen_output"
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+    # Offer to pick up an interrupted run where it stopped
+    resume_state = None
+    checkpoint = load_checkpoint(title)
+    if checkpoint and checkpoint.get('chapters_data'):
+        next_chapter = checkpoint.get('next_index', 0) + 1
+        resume_input = input(f"Found a checkpoint for this title at chapter {next_chapter}/{len(checkpoint['chapters_data'])}. Resume? (y/n): ").strip()
+        if resume_input.lower().startswith('y'):
+            resume_state = checkpoint
             
-        novel_filename = os.path.join(output_dir, f"{title.replace(' ', '_').lower()}.txt")
-        with open(novel_filename, 'w', encoding='utf-8') as f:
-            f.write(full_novel)
-        color_print(f"Novel saved to {novel_filename}", Fore.GREEN)
-    except Exception as e:
-        color_print(f"Warning: Could not save novel: {e}", Fore.YELLOW)
-    
-    # Create EPUB
-    try:
-        create_epub(title, author, story_plan, full_novel)
-    except Exception as e:
-        color_print(f"Error creating EPUB: {e}", Fore.RED)
+            # Offer the text streamed before the interruption as a prefix for the next chapter
+            partial_path = partial_chapter_path(title, next_chapter)
+            if os.path.exists(partial_path):
+                with open(partial_path, 'r', encoding='utf-8', errors='ignore') as f:
+                    partial_text = f.read()
+                if partial_text.strip():
+                    partial_input = input(f"Found {len(partial_text.split())} words of partial Chapter {next_chapter}. Continue from them? (y/n): ").strip()
+                    if partial_input.lower().startswith('y'):
+                        resume_state['partial_chapter_text'] = partial_text
     
-    color_print("\nNovel generation complete!", Fore.GREEN)
+    run_novel(title, author, theme, genre, min_words, resume_state=resume_state)
+    print_telemetry()
 
 if __name__ == "__main__":
     try:
@@ -1298,11 +5674,63 @@ if __name__ == "__main__":
         color_print("https://github.com/RFS11G/NovelGen", Fore.BLUE)
         color_print("=" * 60 + "\n", Fore.CYAN)
         
-        main()
+        args = parse_args()
+        install_cassette()
+        if args.profile:
+            start_profiling(args.profile_mode)
+        install_signal_handlers()
+        if args.command == "serve":
+            serve(args.host, args.port, args.max_jobs)
+        elif args.command == "submit":
+            params = {'title': args.title, 'author': args.author, 'theme': args.theme, 'genre': args.genre, 'min_words': args.min_words}
+            if args.output_dir:
+                params['output_dir'] = args.output_dir
+            job_id = WorkQueue(args.queue).submit_job(params)
+            color_print(f"Queued '{args.title}' as job {job_id}", Fore.GREEN)
+        elif args.command == "worker":
+            run_worker(args.queue, args.worker_id, args.poll_interval, args.exit_when_idle, args.lease)
+        elif args.command == "queue-status":
+            for job in WorkQueue(args.queue).status():
+                items = ", ".join(f"{count} {status}" for status, count in sorted(job['items'].items()))
+                color_print(f"{job['id']}  {job['status']:<9}  {job['title']}  ({items})", Fore.CYAN)
+        elif args.command == "probe":
+            for url in BACKEND_URLS:
+                driver = get_backend_driver(url)
+                color_print(f"{url}  ({driver.name} at {driver.completion_url})", Fore.GREEN)
+                for key, value in driver.capabilities.items():
+                    color_print(f"  {key}: {value}", Fore.CYAN)
+        elif args.command == "series-create":
+            bible_text = None
+            if args.bible_file:
+                with open(args.bible_file, 'r', encoding='utf-8') as f:
+                    bible_text = f.read()
+            create_series(args.name, args.premise, args.theme, args.genre, bible_text)
+        elif args.command == "series-book":
+            run_series_book(args.name, args.title, args.author, args.theme, args.genre, args.min_words, args.resume, args.output_dir)
+            print_telemetry()
+        elif args.command == "regenerate":
+            regenerate_chapters(args.title, args.chapters, args.author, args.output_dir)
+            print_telemetry()
+        elif args.command == "export":
+            formats = [fmt.strip().lower() for fmt in args.formats.split(",") if fmt.strip()]
+            export_stored_novels(args.title, args.author, formats, args.output_dir, args.workers)
+        elif args.command == "audit":
+            audit_manuscript(args.manuscript, args.fix, args.output_dir)
+            print_telemetry()
+        elif args.command == "bench-text":
+            if not bench_text(args.size, args.repeat, args.scale):
+                raise SystemExit(1)
+        elif args.command == "mock-backend":
+            run_mock_backend(args.host, args.port, args.token_delay)
+        else:
+            main()
     except KeyboardInterrupt:
         print("\nProcess interrupted by user.")
     except Exception as e:
         print(f"\nAn unexpected error occurred: {e}")
     finally:
-        # Ensure keep-alive is canceled
-        cancel_keep_alive()
\ No newline at end of file
+        # Ensure keep-alive is canceled and connections are closed
+        cancel_keep_alive()
+        close_connections()
+        if stage_profiler is not None:
+            stage_profiler.write_report(args.profile_dir)
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""Peak memory of chapter generation with NOVELGEN_CHAPTER_STORE=1, against the built-in mock backend"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import tracemalloc
+import unittest
+from http.server import ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlsplit
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# The backend address is read when novelgen is imported, so it is set first
+os.environ["NOVELGEN_BACKENDS"] = f"http://127.0.0.1:{free_port()}/completion"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import novelgen  # noqa: E402
+
+# Another test module may have imported novelgen first, so the mock backend listens wherever it points
+PORT = urlsplit(novelgen.BACKEND_URLS[0]).port
+
+# Words in each generated chapter; the mock backend writes about one word per token, at most 2000 per request
+CHAPTER_WORDS = 1500
+LONG_CHAPTER_WORDS = 2000
+# Peak traced memory allowed for any run, however long the novel
+PEAK_LIMIT = 64e6
+# The million-word run takes several minutes, so it only runs when this is set
+SLOW_TESTS = os.environ.get("NOVELGEN_SLOW_TESTS", "0") != "0"
+
+
+def chapter_plans(count):
+    return [{'number': number, 'title': f"Part {number}", 'description': f"The crew sails on, leg {number} of the voyage."}
+            for number in range(1, count + 1)]
+
+
+class ChapterStoreMemoryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The response cache is bounded by its number of entries rather than by the novel's length, but a
+        # short novel never fills it, so it would make a long one look like it needed more memory
+        for name, value in (("CHAPTER_STORE", True), ("RENDER_CACHE_DIR", ""), ("RESPONSE_CACHE_SIZE", 0)):
+            patcher = mock.patch.object(novelgen, name, value)
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        cls.server = ThreadingHTTPServer(("127.0.0.1", PORT), novelgen.MockBackendHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.previous_directory = os.getcwd()
+        cls.directory = tempfile.TemporaryDirectory()
+        os.chdir(cls.directory.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.previous_directory)
+        cls.directory.cleanup()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def generate(self, title, chapter_count, chapter_words=CHAPTER_WORDS):
+        """Generate a novel in store-only mode and return the store and the peak traced memory in bytes"""
+        tracemalloc.start()
+        try:
+            store = novelgen.generate_novel_chapters(title, "A voyage along the coast.", chapter_plans(chapter_count),
+                                                     min_words_per_chapter=chapter_words, max_tokens_per_chapter=chapter_words)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return store, peak
+
+    def test_peak_does_not_grow_with_novel_length(self):
+        short_store, short_peak = self.generate("Short Voyage", 4)
+        long_store, long_peak = self.generate("Long Voyage", 16)
+
+        self.assertIsInstance(long_store, novelgen.ChapterStore)
+        self.assertEqual(len(long_store), 16)
+        self.assertGreaterEqual(long_store.word_count(), 16 * CHAPTER_WORDS)
+        # Four times the text may not need much more memory than the short novel did
+        self.assertLess(long_peak, short_peak * 1.5, f"peak {long_peak / 1e6:.1f} MB for 16 chapters, {short_peak / 1e6:.1f} MB for 4")
+        self.assertLess(long_peak, PEAK_LIMIT)
+
+    @unittest.skipUnless(SLOW_TESTS, "set NOVELGEN_SLOW_TESTS=1 to generate a million-word novel")
+    def test_million_word_novel(self):
+        short_store, short_peak = self.generate("Short Crossing", 10, LONG_CHAPTER_WORDS)
+        store, peak = self.generate("Long Crossing", 500, LONG_CHAPTER_WORDS)
+
+        self.assertEqual(len(store), 500)
+        self.assertGreaterEqual(store.word_count(), 1000000)
+        self.assertLess(peak, PEAK_LIMIT, f"peak {peak / 1e6:.1f} MB for {store.word_count()} words")
+        # The passage index grows by about a byte per word, while keeping the text would take six or more
+        growth = (peak - short_peak) / (store.word_count() - short_store.word_count())
+        self.assertLess(growth, 2, f"peak {peak / 1e6:.1f} MB for 500 chapters, {short_peak / 1e6:.1f} MB for 10")
+
+
+if __name__ == "__main__":
+    unittest.main()
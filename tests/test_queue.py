@@ -0,0 +1,101 @@
+"""Several worker processes sharing one SQLite work queue, against the built-in mock backend"""
+
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# The backend address is read when novelgen is imported, so it is set first
+os.environ["NOVELGEN_BACKENDS"] = f"http://127.0.0.1:{free_port()}/completion"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import novelgen  # noqa: E402
+
+# Another test module may have imported novelgen first, so the mock backend listens wherever it points,
+# and the workers are sent there too
+BACKEND_URL = novelgen.BACKEND_URLS[0]
+PORT = urlsplit(BACKEND_URL).port
+
+WORKERS = 3
+# Long enough that no worker loses a lease while it works; the stalled claim uses a much shorter one
+WORKER_LEASE = 60
+STALLED_LEASE = 1
+WORKER_TIMEOUT = 300
+
+
+class WorkQueueWorkersTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", PORT), novelgen.MockBackendHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.directory = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def start_worker(self, queue_path, worker_id):
+        log = open(os.path.join(self.directory.name, f"{worker_id}.log"), "w+", encoding="utf-8")
+        self.addCleanup(log.close)
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "novelgen.py"), "worker", "--queue", queue_path, "--worker-id", worker_id,
+             "--poll-interval", "0.2", "--lease", str(WORKER_LEASE), "--exit-when-idle"],
+            cwd=self.directory.name, env=dict(os.environ, NOVELGEN_BACKENDS=BACKEND_URL), stdout=log, stderr=subprocess.STDOUT
+        )
+        self.addCleanup(process.kill)
+        return process, log
+
+    def test_workers_complete_every_item_once(self):
+        queue_path = os.path.join(self.directory.name, "queue.db")
+        queue = novelgen.WorkQueue(queue_path, STALLED_LEASE)
+        self.addCleanup(queue.conn.close)
+        job_ids = [queue.submit_job({'title': f"Harbor Lights {number}", 'min_words': 300}) for number in (1, 2)]
+
+        # A worker that claims the first plan and then stalls; its lease runs out and another worker takes over
+        stalled = queue.claim("stalled-worker")
+        self.assertEqual(stalled['key'], f"{job_ids[0]}:plan:0")
+
+        workers = [self.start_worker(queue_path, f"worker-{number}") for number in range(1, WORKERS + 1)]
+        logs = []
+        for process, log in workers:
+            self.assertEqual(process.wait(WORKER_TIMEOUT), 0)
+            log.seek(0)
+            logs.append(log.read())
+        output = "".join(logs)
+        completed = Counter(re.findall(r"\] Completed (\w+:\w+:\d+)", output))
+
+        self.assertEqual([job['status'] for job in queue.status()], ["completed", "completed"])
+        items = queue.conn.execute("SELECT key, status FROM work_items").fetchall()
+        self.assertGreater(len(items), 2)
+        self.assertEqual(sum(completed.values()), len(items))
+        for row in items:
+            self.assertEqual(row['status'], "done", row['key'])
+            self.assertEqual(completed[row['key']], 1, row['key'])
+
+        self.assertIn(f"Reclaiming {stalled['key']} from stalled-worker (lease expired)", output)
+        self.assertFalse(queue.complete(stalled, "stalled-worker", {"plan": "stale"}))
+        self.assertNotEqual(queue.artifact(job_ids[0], "plan"), "stale")
+        self.assertTrue(all(os.path.exists(os.path.join(self.directory.name, queue.artifact(job_id, "output:txt"))) for job_id in job_ids))
+        self.assertGreaterEqual(sum(f"[worker-{number}] Completed" in output for number in range(1, WORKERS + 1)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+"""Chapter text helpers on ordinary and adversarial inputs"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from novelgen import (CHAPTER_HEADER_SCAN, chapter_body_start, chapter_opening, extract_chapter_ending, paragraphs_html,  # noqa: E402
+                      split_manuscript, split_paragraphs)
+
+# A chapter of one megabyte without a single newline
+ONE_LINE_CHAPTER = "word " * 200000
+
+
+class ChapterHeaderTest(unittest.TestCase):
+    def test_header_and_blank_line_are_skipped(self):
+        text = "Chapter 3: The Harbor\n\nThe rain fell."
+        self.assertEqual(text[chapter_body_start(text):], "The rain fell.")
+        self.assertEqual(chapter_opening(text), "The rain fell.")
+
+    def test_header_line_without_blank_line(self):
+        text = "Chapter 3: The Harbor\nThe rain fell."
+        self.assertEqual(chapter_body_start(text), 0)
+        self.assertEqual(text[chapter_body_start(text, blank_line=False):], "The rain fell.")
+
+    def test_header_ending_inside_the_scan(self):
+        header = "Chapter 12: " + "x" * (CHAPTER_HEADER_SCAN - len("Chapter 12: ") - 2) + "\n\n"
+        self.assertEqual(len(header), CHAPTER_HEADER_SCAN)
+        self.assertEqual(chapter_body_start(header + "Body"), CHAPTER_HEADER_SCAN)
+
+    def test_header_ending_past_the_scan(self):
+        header = "Chapter 12: " + "x" * CHAPTER_HEADER_SCAN + "\n\n"
+        self.assertEqual(chapter_body_start(header + "Body"), 0)
+
+    def test_header_starting_past_the_scan(self):
+        text = " " * CHAPTER_HEADER_SCAN + "Chapter 1: Late\n\nBody"
+        self.assertEqual(chapter_body_start(text), 0)
+
+    def test_header_not_at_the_start(self):
+        text = "She read Chapter 4: The Storm\n\naloud."
+        self.assertEqual(chapter_body_start(text), 0)
+
+    def test_header_only(self):
+        self.assertEqual(chapter_opening("Chapter 2: Alone\n\n"), "")
+        self.assertEqual(chapter_body_start("Chapter 2: Alone\n", blank_line=False), len("Chapter 2: Alone\n"))
+        self.assertEqual(chapter_body_start("Chapter 2: Alone"), 0)
+
+    def test_crlf_header(self):
+        text = "Chapter 5: Dawn\r\n\r\nThe bells rang."
+        self.assertEqual(text[chapter_body_start(text):], "The bells rang.")
+
+    def test_chapter_without_newlines(self):
+        self.assertEqual(chapter_body_start(ONE_LINE_CHAPTER), 0)
+        self.assertEqual(chapter_opening(ONE_LINE_CHAPTER), ONE_LINE_CHAPTER[:1500])
+        self.assertEqual(chapter_body_start("Chapter 1: " + ONE_LINE_CHAPTER), 0)
+
+
+class ParagraphTest(unittest.TestCase):
+    def test_runs_of_blank_lines(self):
+        text = "\n\nFirst paragraph.\n\n\n\n   \n\nSecond paragraph.\n\n\n"
+        self.assertEqual(split_paragraphs(text), ["First paragraph.", "Second paragraph."])
+        self.assertEqual(paragraphs_html(text), "<p>First paragraph.</p><p>Second paragraph.</p>")
+
+    def test_crlf_paragraphs(self):
+        paragraphs = split_paragraphs("First line\r\nsecond line.\r\n\r\nNext paragraph.")
+        self.assertEqual([paragraph.strip() for paragraph in paragraphs], ["First line\r\nsecond line.", "Next paragraph."])
+        self.assertEqual(paragraphs_html("One.\r\n\r\n\r\nTwo.").count("<p>"), 2)
+
+    def test_line_breaks_and_escaping(self):
+        self.assertEqual(paragraphs_html('"A" & <b>\nnext'), "<p>&quot;A&quot; &amp; &lt;b&gt;<br/>next</p>")
+
+    def test_chapter_without_newlines(self):
+        self.assertEqual(split_paragraphs(ONE_LINE_CHAPTER), [ONE_LINE_CHAPTER.strip()])
+        self.assertEqual(paragraphs_html(ONE_LINE_CHAPTER), "<p>" + ONE_LINE_CHAPTER.strip() + "</p>")
+
+
+class ChapterEndingTest(unittest.TestCase):
+    def test_last_thousand_characters(self):
+        text = "".join(f"Line {number} of the chapter.\n" for number in range(500))
+        self.assertEqual(extract_chapter_ending(text), text[-1000:])
+        self.assertEqual(len(extract_chapter_ending(text)), 1000)
+
+    def test_short_chapter_is_kept_whole(self):
+        self.assertEqual(extract_chapter_ending("The end."), "The end.")
+
+    def test_chapter_without_newlines(self):
+        self.assertEqual(extract_chapter_ending(ONE_LINE_CHAPTER), ONE_LINE_CHAPTER[-1000:])
+
+
+class ManuscriptSplitTest(unittest.TestCase):
+    def check_split(self, text):
+        parts, chapters = split_manuscript(text)
+        self.assertEqual("".join(parts), text)
+        return chapters
+
+    def test_text_export_transitions(self):
+        text = "# Voyage\n\n## Chapter 1: Out\n\nThe ship left.\n\n# Voyage\n\n## Chapter 2: Back\n\nThe ship came home.\n"
+        chapters = self.check_split(text)
+        self.assertEqual([chapter['title'] for chapter in chapters], ["Out", "Back"])
+        self.assertEqual([chapter['marker'] for chapter in chapters], ["## ", "## "])
+        self.assertEqual(extract_chapter_ending(chapters[0]['body'].rstrip()), "\nThe ship left.")
+
+    def test_markdown_headings_without_title_lines(self):
+        chapters = self.check_split("## Chapter 1: Out\n\nThe ship left.\n\n## Chapter 2: Back\n\nHome.\n")
+        self.assertEqual(chapters[0]['body'].rstrip(), "\nThe ship left.")
+        self.assertEqual(chapters[1]['heading'], "Chapter 2: Back\n")
+
+    def test_plain_headings_and_mentions(self):
+        chapters = self.check_split("Chapter 1: Out\n\nShe read Chapter 4: The Storm aloud.\n\nChapter 2: Back\n\nHome.")
+        self.assertEqual([chapter['number'] for chapter in chapters], [1, 2])
+        self.assertEqual(chapters[0]['marker'], "")
+
+
+if __name__ == "__main__":
+    unittest.main()